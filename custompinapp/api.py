@@ -0,0 +1,395 @@
+"""
+Headless JSON HTTP API for the Custom Pins application.
+
+This module serves pin types and pins over HTTP on top of the storage backend chosen by
+CUSTOMPINS_STORAGE (see db.repository), without importing Flet.
+Responses are compressed with gzip or deflate when the client accepts it. Every response
+carries an ETag built from the data version, the sequence number of the latest change
+journal entry (a change counter with the 'memory' backend), so a client that sends it back
+in If-None-Match gets a 304 until the data changes. Pin listings are streamed as they are read from the database.
+
+Every route works on the default map unless a ?map=id query parameter selects another.
+
+Routes:
+    GET /pin-types: All pin types.
+    GET /pin-types/{name}: A pin type with its fields.
+    GET /stats/pin-types: All pin types with the count and bounds of their pins.
+    GET /pins: Pins, optionally filtered by ?bbox=south,west,north,east and ?pin_type=name.
+    GET /pins/{pin_id}: A single pin.
+    POST /pins/batch: Create, update and delete pins in a single transaction.
+    POST /pins/deduplicate: Find, and optionally merge, duplicate pins.
+    GET /jobs: Recent background jobs, or only the queued and running ones with ?active=1.
+    POST /jobs: Queue a background job of a kind of db.jobs.JOB_KINDS.
+    GET /jobs/{job_id}: A background job with its progress and time left.
+    POST /jobs/{job_id}/cancel: Cancel a background job.
+    GET /tiles/pins/{z}/{x}/{y}.mvt: Pins as a Mapbox Vector Tile.
+
+Run with:
+    python api.py --port 8080
+"""
+import argparse
+import contextlib
+import json
+import math
+import zlib
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from db.repository import get_repository, DuplicatePinError, DEFAULT_MAP_ID, DEFAULT_DISTANCE_M
+from db.jobs import job_runner
+from db.change_bus import change_bus
+from vector_tiles import PinTileSource
+
+repository = get_repository()
+pin_tiles = {}
+
+class BadRequest(ValueError):
+    """
+    Raised for a malformed request, which is answered with a 400 rather than a 404.
+    """
+
+def _map_id(request):
+    try:
+        return int(request.query_params.get('map', DEFAULT_MAP_ID))
+    except ValueError:
+        raise BadRequest("map must be a map ID.")
+
+def _data_version(map_id):
+    return repository.get_data_version(map_id)
+
+def _tile_source(map_id):
+    if map_id not in pin_tiles:
+        pin_tiles[map_id] = PinTileSource(map_id=map_id)
+    return pin_tiles[map_id]
+
+def _dumps(data):
+    # Pin records are mappings rather than dicts
+    return json.dumps(data, separators=(',', ':'), default=dict).encode('utf-8')
+
+def _choose_encoding(request):
+    accepted = [part.split(';')[0].strip() for part in request.headers.get('accept-encoding', '').split(',')]
+    if 'gzip' in accepted:
+        return 'gzip'
+    if 'deflate' in accepted:
+        return 'deflate'
+    return None
+
+def _compressor(encoding):
+    # wbits 31 writes a gzip container, 15 a zlib container as HTTP deflate expects
+    return zlib.compressobj(6, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+
+def _etag(version):
+    return f'"v{version}"'
+
+def _not_modified(request, etag):
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+def _headers(etag, encoding):
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return headers
+
+async def json_response(request, load, status_code=200):
+    """
+    Build a cached, compressed JSON response.
+
+    Args:
+        request (Request): The request being answered.
+        load (function): Function called in a worker thread with the ID of the requested
+            map to get the data to send.
+        status_code (int, optional): The status code of the response. Defaults to 200.
+
+    Returns:
+        Response: The response, or a 304 if the client already has the current version.
+    """
+    try:
+        map_id = _map_id(request)
+        version = await run_in_threadpool(_data_version, map_id)
+    except BadRequest as e:
+        return error_response(400, str(e))
+    except ValueError as e:
+        return error_response(404, str(e))
+    etag = _etag(version)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    try:
+        data = await run_in_threadpool(load, map_id)
+    except ValueError as e:
+        return error_response(404, str(e))
+
+    body = _dumps(data)
+    encoding = _choose_encoding(request)
+    if encoding:
+        compressor = _compressor(encoding)
+        body = compressor.compress(body) + compressor.flush()
+    return Response(body, status_code=status_code, media_type='application/json', headers=_headers(etag, encoding))
+
+def error_response(status_code, message):
+    """
+    Build a JSON error response.
+
+    Args:
+        status_code (int): The status code of the response.
+        message (str): The error message.
+
+    Returns:
+        Response: The response.
+    """
+    return Response(_dumps({'error': message}), status_code=status_code, media_type='application/json')
+
+def stream_json_array(items, encoding):
+    """
+    Serialize items as a JSON array, one item at a time.
+
+    Args:
+        items (iterable): The items to serialize.
+        encoding (str): The content encoding to apply, or None.
+
+    Yields:
+        bytes: Chunks of the response body.
+    """
+    compressor = _compressor(encoding) if encoding else None
+
+    def emit(chunk):
+        return compressor.compress(chunk) if compressor else chunk
+
+    yield emit(b'[')
+    for index, item in enumerate(items):
+        chunk = emit((b',' if index else b'') + _dumps(item))
+        if chunk:
+            yield chunk
+    yield emit(b']')
+    if compressor:
+        yield compressor.flush()
+
+async def list_pin_types(request):
+    return await json_response(request, lambda map_id: repository.get_all_pin_types(map_id=map_id))
+
+async def get_pin_type(request):
+    name = request.path_params['name']
+    return await json_response(request, lambda map_id: repository.get_pin_type_by_name(name, map_id=map_id))
+
+async def list_pin_type_stats(request):
+    return await json_response(request, lambda map_id: repository.get_pin_type_stats(map_id=map_id))
+
+async def list_pins(request):
+    bounds = None
+    if 'bbox' in request.query_params:
+        try:
+            bounds = tuple(float(value) for value in request.query_params['bbox'].split(','))
+        except ValueError:
+            bounds = ()
+        if len(bounds) != 4:
+            return error_response(400, "bbox must be south,west,north,east.")
+    pin_type_name = request.query_params.get('pin_type')
+
+    try:
+        map_id = _map_id(request)
+        version = await run_in_threadpool(_data_version, map_id)
+    except BadRequest as e:
+        return error_response(400, str(e))
+    except ValueError as e:
+        return error_response(404, str(e))
+    etag = _etag(version)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    encoding = _choose_encoding(request)
+    pins = repository.iter_pins(bounds=bounds, pin_type_name=pin_type_name, map_id=map_id)
+    return StreamingResponse(stream_json_array(pins, encoding), media_type='application/json', headers=_headers(etag, encoding))
+
+async def get_pin(request):
+    pin_id = request.path_params['pin_id']
+    return await json_response(request, lambda map_id: repository.get_pin_by_id(pin_id, map_id=map_id))
+
+def _is_number(value, limit):
+    # A JSON number within [-limit, limit]; bool is an int in Python but not a coordinate.
+    # The range is compared first, since isfinite cannot convert huge integers
+    return (isinstance(value, (int, float)) and not isinstance(value, bool)
+            and -limit <= value <= limit and math.isfinite(value))
+
+def _check_batch_entry(key, entry):
+    # Rejects entries that the database would store but nothing could read back
+    if key == 'create':
+        if not _is_number(entry.get('latitude'), 90) or not _is_number(entry.get('longitude'), 180):
+            raise BadRequest("Each entry of create must have a latitude between -90 and 90 "
+                             "and a longitude between -180 and 180.")
+    if key == 'update' and (not isinstance(entry.get('id'), int) or isinstance(entry.get('id'), bool)):
+        raise BadRequest("Each entry of update must have a pin ID.")
+    if not isinstance(entry.get('fields', {} if key == 'create' else None), dict):
+        raise BadRequest(f"The fields of each entry of {key} must be an object.")
+
+def apply_batch(batch, map_id=DEFAULT_MAP_ID):
+    """
+    Create, update and delete pins in a single transaction.
+
+    Args:
+        batch (dict): The operations, with optional 'create' (pin_type, latitude, longitude
+            and fields of each new pin), 'update' (id and fields of each pin) and 'delete'
+            (pin IDs) lists, and an optional 'on_duplicate' ("allow", "merge" or "reject")
+            applied to the created pins.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        dict: The IDs of the 'created' pins; a merged pin gives the ID of the existing pin.
+
+    Raises:
+        BadRequest: If the batch, one of its lists or one of their entries has the wrong
+            type, or a created pin is not at valid coordinates.
+    """
+    if not isinstance(batch, dict):
+        raise BadRequest("Body must be a JSON object.")
+    for key, entry_type in (('create', dict), ('update', dict), ('delete', int)):
+        entries = batch.get(key, [])
+        if not isinstance(entries, list):
+            raise BadRequest(f"{key} must be a list.")
+        for entry in entries:
+            if not isinstance(entry, entry_type) or isinstance(entry, bool):
+                raise BadRequest(f"Each entry of {key} must be {'an object' if entry_type is dict else 'a pin ID'}.")
+            if entry_type is dict:
+                _check_batch_entry(key, entry)
+    created = []
+    on_duplicate = batch.get('on_duplicate', 'allow')
+    with repository.atomic(map_id):
+        for pin in batch.get('create', []):
+            created.append(repository.add_pin(pin['pin_type'], pin['latitude'], pin['longitude'], pin.get('fields', {}),
+                                             on_duplicate=on_duplicate, map_id=map_id).id)
+        for pin in batch.get('update', []):
+            repository.update_pin(pin['id'], pin['fields'], map_id=map_id)
+        for pin_id in batch.get('delete', []):
+            repository.delete_pin(pin_id, map_id=map_id)
+    return {'created': created}
+
+async def batch_pins(request):
+    try:
+        batch = await request.json()
+    except ValueError:
+        return error_response(400, "Body must be JSON.")
+    try:
+        map_id = _map_id(request)
+        result = await run_in_threadpool(apply_batch, batch, map_id)
+    except DuplicatePinError as e:
+        return error_response(409, str(e))
+    except (ValueError, KeyError, TypeError) as e:
+        return error_response(400, str(e))
+    return Response(_dumps(result), media_type='application/json', headers={'ETag': _etag(await run_in_threadpool(_data_version, map_id))})
+
+async def deduplicate_pins(request):
+    if repository.database is None:
+        return error_response(501, f"The '{repository.backend}' storage backend cannot deduplicate pins.")
+    import db.crud as pins_crud
+    try:
+        options = await request.json()
+    except ValueError:
+        return error_response(400, "Body must be JSON.")
+    try:
+        map_id = _map_id(request)
+        result = await run_in_threadpool(
+            pins_crud.deduplicate_pins,
+            float(options.get('distance_m', DEFAULT_DISTANCE_M)),
+            options.get('key_fields'),
+            options.get('pin_type'),
+            bool(options.get('merge', False)),
+            map_id,
+        )
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return error_response(400, str(e))
+    return Response(_dumps(result), media_type='application/json', headers={'ETag': _etag(await run_in_threadpool(_data_version, map_id))})
+
+def _job_response(job, status_code=200):
+    # Progress changes without a new data version, so job responses are never cached
+    return Response(_dumps(job), status_code=status_code, media_type='application/json', headers={'Cache-Control': 'no-store'})
+
+async def list_jobs(request):
+    active = request.query_params.get('active') in ('1', 'true')
+    return _job_response(await run_in_threadpool(job_runner.list_jobs, active))
+
+async def submit_job(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return error_response(400, "Body must be JSON.")
+    try:
+        job = await run_in_threadpool(job_runner.submit, body['kind'], body.get('params'), _map_id(request))
+    except (ValueError, KeyError, TypeError) as e:
+        return error_response(400, str(e))
+    return _job_response(job, status_code=202)
+
+async def get_job(request):
+    try:
+        job = await run_in_threadpool(job_runner.get_job, request.path_params['job_id'])
+    except ValueError as e:
+        return error_response(404, str(e))
+    return _job_response(job)
+
+async def cancel_job(request):
+    try:
+        job = await run_in_threadpool(job_runner.cancel, request.path_params['job_id'])
+    except ValueError as e:
+        return error_response(404, str(e))
+    return _job_response(job)
+
+async def get_pin_tile(request):
+    z, x, y = request.path_params['z'], request.path_params['x'], request.path_params['y']
+    if z > 22 or x >= 2 ** z or y >= 2 ** z:
+        return error_response(404, "Tile out of range.")
+    if repository.database is None:
+        return error_response(501, f"The '{repository.backend}' storage backend cannot serve vector tiles.")
+
+    try:
+        map_id = _map_id(request)
+        version = await run_in_threadpool(_data_version, map_id)
+    except BadRequest as e:
+        return error_response(400, str(e))
+    except ValueError as e:
+        return error_response(404, str(e))
+    etag = _etag(version)
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers={'ETag': etag})
+
+    body = await run_in_threadpool(_tile_source(map_id).get_tile, z, x, y)
+    encoding = _choose_encoding(request)
+    if encoding:
+        compressor = _compressor(encoding)
+        body = compressor.compress(body) + compressor.flush()
+    return Response(body, media_type='application/vnd.mapbox-vector-tile', headers=_headers(etag, encoding))
+
+routes = [
+    Route('/pin-types', list_pin_types),
+    Route('/pin-types/{name}', get_pin_type),
+    Route('/stats/pin-types', list_pin_type_stats),
+    Route('/pins', list_pins),
+    Route('/pins/batch', batch_pins, methods=['POST']),
+    Route('/pins/deduplicate', deduplicate_pins, methods=['POST']),
+    Route('/pins/{pin_id:int}', get_pin),
+    Route('/jobs', list_jobs),
+    Route('/jobs', submit_job, methods=['POST']),
+    Route('/jobs/{job_id:int}', get_job),
+    Route('/jobs/{job_id:int}/cancel', cancel_job, methods=['POST']),
+    Route('/tiles/pins/{z:int}/{x:int}/{y:int}.mvt', get_pin_tile),
+]
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Picks up the jobs queued or interrupted before a restart
+    await run_in_threadpool(job_runner.start)
+    # Pins changed by the app's processes must not be served from this one's cache
+    for map_row in await run_in_threadpool(repository.get_all_maps):
+        await run_in_threadpool(change_bus.follow, map_row['id'])
+    yield
+
+app = Starlette(routes=routes, lifespan=lifespan)
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Serve the Custom Pins JSON API.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
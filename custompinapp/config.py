@@ -31,4 +31,35 @@ WARNING_COLOR = ft.colors.YELLOW_500
 SUCCESS_COLOR = ft.colors.GREEN_500
 INFO_COLOR = ft.colors.LIGHT_BLUE_500
 
-ICON_COLOR = ft.colors.GREY_700
\ No newline at end of file
+ICON_COLOR = ft.colors.GREY_700
+
+# Pin rendering
+CIRCLE_MODE_PIN_THRESHOLD = 500 # Above this many pins, draw circles instead of markers
+CIRCLE_MODE_MAX_ZOOM = 12 # At or below this zoom, draw circles instead of markers
+PIN_CIRCLE_RADIUS = 6
+PIN_TAP_TOLERANCE_PX = 20
+HEATMAP_MAX_ZOOM = 7 # At or below this zoom, draw a density heatmap instead of pins
+HEATMAP_CELL_PX = 32
+HEATMAP_COLOR = ft.colors.DEEP_ORANGE
+HEATMAP_WEIGHT_FIELD = None # Name of a numeric field to weight pins by, or None to count them
+
+# Pin details
+ATTRIBUTE_ROW_HEIGHT_PX = 59 # Height of a field row in the pin overlay, with the space between rows
+ATTRIBUTE_ROWS_AHEAD = 5 # Field rows kept built above and below those on screen, so scrolling never reaches an unbuilt row
+ATTRIBUTE_SCROLL_INTERVAL_MS = 100 # Time between scroll events sent by the pin overlay
+
+# Duplicate pins
+DUPLICATE_PIN_DISTANCE_M = 5 # A new pin this close to a pin of the same type is merged into it
+
+# Location
+LOCATION_MAX_AGE_S = 30 # A fix younger than this answers "find myself" without waiting for the GPS
+LOCATION_GOOD_ACCURACY_M = 25 # A fix less accurate than this is refined in the background
+LOCATION_TIMEOUT_S = 25
+TRACKING_DISTANCE_FILTER_M = 5 # Position updates closer than this to the last one are not sent
+TRACKING_MIN_INTERVAL_S = 1.5 # Minimum time between camera moves while tracking
+TRACKING_MIN_MOVE_M = 10 # Smaller position changes do not move the camera while tracking
+
+# Timeline
+TIMELINE_MAX_BUCKETS = 48 # The histogram groups days into weeks, months or years to stay under this many bars
+TIMELINE_HISTOGRAM_HEIGHT = 40
+TIMELINE_STEP_S = 0.4 # Time between steps while the timeline plays
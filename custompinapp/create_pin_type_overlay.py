@@ -7,9 +7,8 @@ Classes:
     CreatePinTypeOverlay: A class for creating and managing pin type overlays.
 """
 import flet as ft
-from db.crud import create_pin_type
+from db.repository import get_repository
 from flet_contrib.color_picker import ColorPicker
-from map_overlay import update_dot_position, DotOverlay
 
 class CreatePinTypeOverlay(ft.Column):
     """
@@ -18,8 +17,9 @@ class CreatePinTypeOverlay(ft.Column):
     Args:
         page (ft.Page): The main page object provided by Flet.
         on_pin_type_created (function): Callback function to be called when a pin type is created.
+        on_close (function): Function called without arguments to close the overlay.
     """
-    def __init__(self, page: ft.Page, on_pin_type_created):
+    def __init__(self, page: ft.Page, on_pin_type_created, on_close):
         super().__init__()
         self.page = page
         self.pin_type_name_field = ft.TextField(label="Pin Type Name", expand=True)
@@ -28,12 +28,13 @@ class CreatePinTypeOverlay(ft.Column):
         self.save_button = ft.ElevatedButton(text="Save", on_click=self.save_pin_type)
         self.cancel_button = ft.ElevatedButton(text="Cancel", on_click=self.cancel)
         self.on_pin_type_created = on_pin_type_created
+        self.on_close = on_close
         
         async def open_color_picker(e):
             self.page.dialog = d
             self.color_picker.color = self.color_icon.icon_color
             d.open = True
-            await self.page.update()
+            self.page.update()
 
         self.color_icon = ft.IconButton(icon="add_location", on_click=open_color_picker, icon_color="#36aedc")
         self.color_picker = ColorPicker(color=self.color_icon.icon_color, width=300)
@@ -41,11 +42,11 @@ class CreatePinTypeOverlay(ft.Column):
         async def change_color(e):
             self.color_icon.icon_color = self.color_picker.color
             d.open = False
-            await self.page.update()
+            self.page.update(self.color_icon, d)
 
         async def close_dialog(e):
             d.open = False
-            await self.page.update()
+            d.update()
 
         d = ft.AlertDialog(
             content=self.color_picker,
@@ -141,7 +142,6 @@ class CreatePinTypeOverlay(ft.Column):
         pin_type_name = self.pin_type_name_field.value
         if pin_type_name == "":
             self.pin_type_name_field.error_text = "Pin Type Name is required."
-            self.page.update()
             erro = True
         
         #Adiciona campos ao tipo de pin
@@ -158,26 +158,21 @@ class CreatePinTypeOverlay(ft.Column):
         #Display dos erros
         if erro:
             print (erro)
-            self.page.update()
+            self.update()
             return
         
         #Criação do pin
         color = self.color_picker.color
         try:
-            create_pin_type(pin_type_name, fields, color=color)
+            get_repository().create_pin_type(pin_type_name, fields, color=color)
         except ValueError as e:
             self.pin_type_name_field.error_text = str(e)
-            self.page.update()
+            self.pin_type_name_field.update()
             return
         
         # Call the callback function to update the dropdown
         self.on_pin_type_created()
-    
-        self.page.overlay.clear()
-        dot_overlay = DotOverlay()
-        self.page.overlay.append(dot_overlay)
-        update_dot_position(self.page, dot_overlay)
-        #self.page.update()
+        self.on_close()
 
     def cancel(self, e):
         """
@@ -186,7 +181,5 @@ class CreatePinTypeOverlay(ft.Column):
         Args:
             e: The event object.
         """
-        self.page.overlay.clear()
-        dot_overlay = DotOverlay()
-        self.page.overlay.append(dot_overlay)
-        update_dot_position(self.page, dot_overlay)    
\ No newline at end of file
+        self.on_close()
+    
\ No newline at end of file
@@ -0,0 +1,197 @@
+"""
+Change notification across processes for the Custom Pins application.
+
+Several app processes can serve the same database. Every change made through the CRUD
+layer is journaled in the same transaction as the change itself, so the change journal is
+also a feed of changes: ChangeBus polls it from one thread per process and tells its
+listeners which pins and pin types changed, in this process or in any other. It needs no
+broker, and since the journal is read by sequence number, no change is skipped.
+
+The bus also drops the cached details of the pins that changed, so a pin changed by
+another process is not served stale from this process's cache.
+
+A storage backend without a change journal, such as 'memory', gives the bus nothing to
+poll, so its listeners are never called.
+
+Classes:
+    ChangeBus: Polls the change journal and tells listeners what changed.
+
+Attributes:
+    change_bus (ChangeBus): The bus shared by the application.
+"""
+import threading
+import time
+from db.db import get_session, Pin, DEFAULT_MAP_ID
+from db.repository import get_repository
+from db.journal import get_data_version
+from db.sync import get_changes_since
+from db.pin_cache import pin_details
+
+database = get_session()
+repository = get_repository()
+
+POLL_INTERVAL = 0.5  # seconds between two reads of the journal
+BATCH_SIZE = 500
+
+class _MapFeed:
+    # The journal position, pin IDs and listeners of one map
+    __slots__ = ('seq', 'pin_ids', 'listeners', 'followed')
+
+    def __init__(self, seq, pin_ids):
+        self.seq = seq
+        self.pin_ids = pin_ids
+        self.listeners = []
+        self.followed = False
+
+class ChangeBus:
+    """
+    Polls the change journal and tells listeners what changed.
+
+    Listeners are called from the polling thread with a dictionary describing the changes
+    read in one poll:
+
+    - 'map_id': The ID of the map.
+    - 'seq': The sequence number of the last change read.
+    - 'pins': The PinRecords of the pins added or changed, with their uid.
+    - 'deleted': The IDs of the pins deleted.
+    - 'pin_types': Whether a pin type was added, changed or deleted; its pins may have
+      changed color or name without being listed.
+
+    Attributes:
+        interval (float): The number of seconds between two reads of the journal.
+        on_error (function): Function called with a listener and the exception it raised,
+            or None to print the exception.
+    """
+    def __init__(self, interval=POLL_INTERVAL):
+        """
+        Initialize a ChangeBus instance.
+
+        Args:
+            interval (float, optional): The number of seconds between two reads of the
+                journal. Defaults to POLL_INTERVAL.
+        """
+        self.interval = interval
+        self.on_error = None
+        self._feeds = {}
+        self._thread = None
+        self._lock = threading.Lock()
+        self._poll_lock = threading.Lock()
+
+    def subscribe(self, listener, map_id=DEFAULT_MAP_ID):
+        """
+        Call a function with the changes to a map made from now on, and start polling.
+
+        Args:
+            listener (function): The function.
+            map_id (int, optional): The ID of the map. Defaults to the default map.
+        """
+        with self._lock:
+            self._feed(map_id).listeners.append(listener)
+
+    def follow(self, map_id=DEFAULT_MAP_ID):
+        """
+        Keep the pin cache of this process up to date with the changes to a map, without
+        listening to them.
+
+        Args:
+            map_id (int, optional): The ID of the map. Defaults to the default map.
+        """
+        with self._lock:
+            self._feed(map_id).followed = True
+
+    def _feed(self, map_id):
+        # Must be called with the lock held
+        feed = self._feeds.get(map_id)
+        if repository.database is None:
+            # Nothing to poll: the backend has no change journal
+            if feed is None:
+                feed = self._feeds[map_id] = _MapFeed(0, {})
+            return feed
+        if feed is None:
+            feed = self._feeds[map_id] = self._open_feed(map_id)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return feed
+
+    def unsubscribe(self, listener, map_id=DEFAULT_MAP_ID):
+        """
+        Stop calling a function subscribed with subscribe().
+
+        Args:
+            listener (function): The function.
+            map_id (int, optional): The ID of the map. Defaults to the default map.
+        """
+        with self._lock:
+            feed = self._feeds.get(map_id)
+            if feed is not None and listener in feed.listeners:
+                feed.listeners.remove(listener)
+                if not feed.listeners and not feed.followed:
+                    del self._feeds[map_id]
+
+    def _open_feed(self, map_id):
+        # A read transaction, so the pins are the ones as of the journal position
+        with database.use_map(map_id), database.atomic(lock_type='DEFERRED'):
+            seq = get_data_version()
+            pin_ids = dict(Pin.select(Pin.uid, Pin.id).where(Pin.map == map_id).tuples())
+        return _MapFeed(seq, pin_ids)
+
+    def poll(self):
+        """
+        Read the changes journaled since the last poll and tell the listeners.
+
+        Called every interval by the polling thread.
+        """
+        with self._lock:
+            feeds = list(self._feeds.items())
+        with self._poll_lock:
+            for map_id, feed in feeds:
+                while True:
+                    with database.use_map(map_id):
+                        changes = get_changes_since(feed.seq, limit=BATCH_SIZE)
+                    if not changes:
+                        break
+                    self._publish(map_id, feed, changes)
+                    if len(changes) < BATCH_SIZE:
+                        break
+
+    def _publish(self, map_id, feed, changes):
+        feed.seq = changes[-1]['seq']
+        pin_types_changed = False
+        changed_uids = set()
+        for change in changes:
+            if change['entity'] == 'pin_type':
+                pin_types_changed = True
+            else:
+                changed_uids.add(change['entity_uid'])
+
+        # Pins are read as they are now: a pin changed then deleted is only deleted
+        pins = list(repository.iter_pins(uids=changed_uids, map_id=map_id)) if changed_uids else []
+        for pin in pins:
+            feed.pin_ids[pin['uid']] = pin['id']
+        deleted = [feed.pin_ids.pop(uid) for uid in changed_uids - {pin['uid'] for pin in pins} if uid in feed.pin_ids]
+
+        if pin_types_changed:
+            pin_details.invalidate_map(map_id)
+        else:
+            pin_details.invalidate(map_id, [pin['id'] for pin in pins] + deleted)
+
+        update = {"map_id": map_id, "seq": feed.seq, "pins": pins, "deleted": deleted, "pin_types": pin_types_changed}
+        for listener in list(feed.listeners):
+            try:
+                listener(update)
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(listener, e)
+                else:
+                    print(f"Error: {e}")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error reading the change journal: {e}")
+
+change_bus = ChangeBus()
@@ -2,27 +2,180 @@
 CRUD operations for the Custom Pins application.
 
 This module provides functions for creating, reading, updating, and deleting pin types, pins, and their associated fields and values.
+Every mutation is recorded in the change journal in the same transaction.
+Pin listings return compact db.records.PinRecord objects, which read like dictionaries.
+get_pin_by_id is served from the db.pin_cache LRU cache, which the functions that change
+pins and pin types keep up to date.
+
+Pin types and pins belong to a map, given by the map_id argument of each function and
+defaulting to the default map. Every query runs against the map's own database file and
+only reads the map's rows, so work on one map never touches another.
 
 Functions:
-    create_pin_type(name, fields, color=None, style="add_location"): Create a new pin type.
-    get_all_pin_types(): Get all pin types.
-    get_pin_type_by_name(name): Get a pin type by its name.
-    add_pin(pin_type_name, latitude, longitude, field_values): Add a new pin.
-    get_pin_by_id(pin_id): Get a pin by its ID.
-    get_pins(pin_type_name): Get all pins of a specific pin type.
-    get_all_pins(): Get all pins.
-    update_pin(pin_id, updated_field_values): Update a pin.
-    delete_pin(pin_id): Delete a pin.
-    update_pin_type(pin_type_id, new_name=None, updated_fields=None, new_color=None, new_style=None): Update a pin type.
-    delete_pin_type_and_pins(pin_type_name, map_id=0): Delete a pin type and all associated pins.
+    create_map(name, separate_file=False): Create a new map.
+    get_all_maps(): Get all maps.
+    delete_map(map_id): Delete a map with its pin types and pins.
+    create_pin_type(name, fields, color=None, style="add_location", map_id=DEFAULT_MAP_ID): Create a new pin type.
+    get_all_pin_types(map_id=DEFAULT_MAP_ID): Get all pin types.
+    get_pin_type_by_name(name, map_id=DEFAULT_MAP_ID): Get a pin type by its name.
+    get_pin_type_stats(map_id=DEFAULT_MAP_ID): Get all pin types with the statistics of their pins.
+    add_pin(pin_type_name, latitude, longitude, field_values, on_duplicate="allow", duplicate_distance_m=DEFAULT_DISTANCE_M, key_fields=None, map_id=DEFAULT_MAP_ID): Add a new pin.
+    get_pin_by_id(pin_id, map_id=DEFAULT_MAP_ID): Get a pin by its ID.
+    get_pins(pin_type_name, map_id=DEFAULT_MAP_ID): Get all pins of a specific pin type.
+    get_all_pins(map_id=DEFAULT_MAP_ID): Get all pins.
+    get_pins_in_bounds(south, west, north, east, map_id=DEFAULT_MAP_ID): Get all pins inside a bounding box.
+    iter_pins(bounds=None, pin_type_name=None, uids=None, with_fields=True, map_id=DEFAULT_MAP_ID): Iterate over pins without loading them all at once.
+    get_date_field_names(map_id=DEFAULT_MAP_ID): Get the names of the date fields.
+    get_date_counts(field_name=None, map_id=DEFAULT_MAP_ID): Get the number of pins per day.
+    get_pin_ids_by_date(start, end, field_name=None, map_id=DEFAULT_MAP_ID): Get the IDs of the pins with a date in a range.
+    update_pin(pin_id, updated_field_values, map_id=DEFAULT_MAP_ID): Update a pin.
+    update_pins(updates, map_id=DEFAULT_MAP_ID): Update several pins in a single transaction.
+    delete_pin(pin_id, map_id=DEFAULT_MAP_ID): Delete a pin.
+    update_pin_type(pin_type_id, new_name=None, updated_fields=None, new_color=None, new_style=None, map_id=DEFAULT_MAP_ID, progress=None): Update a pin type.
+    delete_pin_type_and_pins(pin_type_name, map_id=DEFAULT_MAP_ID, progress=None): Delete a pin type and all associated pins.
+    deduplicate_pins(distance_m=DEFAULT_DISTANCE_M, key_fields=None, pin_type_name=None, merge=False, map_id=DEFAULT_MAP_ID): Find, and optionally merge, duplicate pins.
 """
+import functools
+import inspect
+from peewee import JOIN, fn
 from db.db import get_session
-from db.db import PinType, Pin, Field, FieldValue
+from db.db import Map, PinType, Pin, Field, FieldValue, PinTypeStats, DateCount, DEFAULT_MAP_ID, new_uid, create_default_pin_type
+from db.journal import record_change, pin_type_snapshot, pin_snapshot
+from db.records import pin_records
+from db.pin_cache import pin_details
+from db.repository import DuplicatePinError
+from db.defaults import CHUNK_SIZE, DEFAULT_PIN_TYPE_NAME
+from db.dedup import DEFAULT_DISTANCE_M, find_duplicate, merge_field_values, find_duplicate_clusters, merge_clusters
 
 database = get_session()
 
 
-def create_pin_type(name, fields, color=None, style="add_location"):
+def scoped_to_map(function):
+    """
+    Run a CRUD function against the database file of the map given by its map_id argument.
+
+    Generator functions are stepped inside the map's scope too, so a caller iterating over
+    them can interleave queries to other maps.
+
+    Args:
+        function (function): A function taking a map_id argument.
+
+    Returns:
+        function: The wrapped function.
+    """
+    signature = inspect.signature(function)
+
+    def map_id_of(args, kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return bound.arguments['map_id']
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            map_id = map_id_of(args, kwargs)
+            with database.use_map(map_id):
+                items = function(*args, **kwargs)
+            while True:
+                with database.use_map(map_id):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with database.use_map(map_id_of(args, kwargs)):
+            return function(*args, **kwargs)
+    return wrapper
+
+def _in_chunks(ids, apply_chunk, progress=None, committed=None):
+    # Short transactions let other sessions write in between
+    total = len(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        with database.atomic():
+            apply_chunk(chunk)
+        if committed is not None:
+            committed(chunk)
+        if progress is not None:
+            progress(start + len(chunk), total)
+
+def create_map(name, separate_file=False):
+    """
+    Create a new map.
+
+    Args:
+        name (str): The name of the map.
+        separate_file (bool, optional): Whether to store the map's pin types and pins in their
+            own SQLite file instead of the shared database. Defaults to False.
+
+    Returns:
+        Map: The created Map object.
+    """
+    with database.use_shared():
+        if Map.get_or_none(Map.name == name):
+            raise ValueError(f"Map '{name}' already exists.")
+        uid = new_uid()
+        map_row = Map.create(uid=uid, name=name, file_name=f"map_{uid}.db" if separate_file else None)
+        database.forget(map_row.id)
+
+    # A separate file is created with its default pin type the first time it is used
+    with database.use_map(map_row.id), database.atomic():
+        pin_type = create_default_pin_type(map_row)
+        # Unlike the default map's, this pin type does not exist on other devices
+        record_change('pin_type', pin_type.uid, 'upsert', pin_type_snapshot(pin_type))
+    return map_row
+
+def get_all_maps():
+    """
+    Get all maps.
+
+    Returns:
+        list: A list of dictionaries representing all maps.
+    """
+    with database.use_shared():
+        return [
+            {'id': map_row.id, 'uid': map_row.uid, 'name': map_row.name, 'separate_file': map_row.file_name is not None}
+            for map_row in Map.select().order_by(Map.id)
+        ]
+
+def delete_map(map_id):
+    """
+    Delete a map with its pin types and pins.
+
+    Args:
+        map_id (int): The ID of the map.
+    """
+    if map_id == DEFAULT_MAP_ID:
+        raise ValueError("The default map cannot be deleted.")
+    with database.use_shared():
+        map_row = Map.get_or_none(Map.id == map_id)
+        if not map_row:
+            raise ValueError(f"Map with ID '{map_id}' does not exist.")
+
+    if map_row.file_name:
+        database.remove_file(map_id)
+    else:
+        with database.use_shared(), database.atomic():
+            for pin_type in PinType.select().where(PinType.map == map_id):
+                for pin in pin_type.pins:
+                    pin.delete_instance(recursive=True)
+                    record_change('pin', pin.uid, 'delete')
+                pin_type.delete_instance(recursive=True)
+                record_change('pin_type', pin_type.uid, 'delete')
+
+    with database.use_shared():
+        map_row.delete_instance()
+    database.forget(map_id)
+    pin_details.invalidate_map(map_id)
+    print(f"Map {map_row.name} deleted successfully.")
+
+
+@scoped_to_map
+def create_pin_type(name, fields, color=None, style="add_location", map_id=DEFAULT_MAP_ID):
     """
     Create a new pin type.
 
@@ -31,33 +184,41 @@ def create_pin_type(name, fields, color=None, style="add_location"):
         fields (list): A list of fields associated with the pin type.
         color (str, optional): The color of the pin type. Defaults to None.
         style (str, optional): The style of the pin type. Defaults to "add_location".
+        map_id (int, optional): The ID of the map. Defaults to the default map.
 
     Returns:
         PinType: The created PinType object.
     """
-    existing_pin_type = PinType.get_or_none(PinType.name == name)
+    existing_pin_type = PinType.get_or_none((PinType.map == map_id) & (PinType.name == name))
     if existing_pin_type:
         raise ValueError(f"PinType '{name}' already exists.")
     
-    pin_type = PinType.create(name=name, color=color, style=style)
-    
-    for field_name, field_type, is_required in fields:
-        Field.create(pin_type=pin_type, name=field_name, field_type=field_type, is_required=is_required)
-    
+    with database.atomic():
+        pin_type = PinType.create(map=map_id, name=name, color=color, style=style)
+        
+        for field_name, field_type, is_required in fields:
+            Field.create(pin_type=pin_type, name=field_name, field_type=field_type, is_required=is_required)
+        
+        record_change('pin_type', pin_type.uid, 'upsert', pin_type_snapshot(pin_type))
     return pin_type
 
-def get_all_pin_types():
+@scoped_to_map
+def get_all_pin_types(map_id=DEFAULT_MAP_ID):
     """
     Get all pin types.
 
+    Args:
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
     Returns:
         list: A list of dictionaries representing all pin types.
     """
-    pin_types = PinType.select()
+    pin_types = PinType.select().where(PinType.map == map_id)
     result = []
     
     for pin_type in pin_types:
         info = {
+            'id': pin_type.id,
             'name': pin_type.name,
             'color': pin_type.color,
             'style': pin_type.style
@@ -66,17 +227,19 @@ def get_all_pin_types():
     
     return result
 
-def get_pin_type_by_name(name):
+@scoped_to_map
+def get_pin_type_by_name(name, map_id=DEFAULT_MAP_ID):
     """
     Get a pin type by its name.
 
     Args:
         name (str): The name of the pin type.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
 
     Returns:
         dict: A dictionary representing the pin type.
     """
-    pin_type = PinType.get_or_none(PinType.name == name)
+    pin_type = PinType.get_or_none((PinType.map == map_id) & (PinType.name == name))
     if not pin_type:
         raise ValueError(f"PinType '{name}' does not exist.")
     
@@ -96,224 +259,514 @@ def get_pin_type_by_name(name):
     
     return result
 
-def add_pin(pin_type_name, latitude, longitude, field_values):
+@scoped_to_map
+def get_pin_type_stats(map_id=DEFAULT_MAP_ID):
+    """
+    Get all pin types with the statistics of their pins.
+
+    The statistics are read from the PinTypeStats table, which SQLite keeps current, so no
+    pin is scanned.
+
+    Args:
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        list: A list of dictionaries representing all pin types, in the same shape as
+        get_all_pin_types plus their 'pin_count', the (south, west, north, east) 'bounds'
+        of their pins or None if they have none, and the 'last_modified' time of their pins.
+    """
+    pin_types = (PinType
+                 .select(PinType, PinTypeStats)
+                 .join(PinTypeStats, JOIN.LEFT_OUTER, on=(PinTypeStats.pin_type == PinType.id), attr='pin_stats')
+                 .where(PinType.map == map_id))
+    result = []
+
+    for pin_type in pin_types:
+        stats = getattr(pin_type, 'pin_stats', None)
+        has_pins = stats is not None and stats.pin_count > 0
+        result.append({
+            'id': pin_type.id,
+            'name': pin_type.name,
+            'color': pin_type.color,
+            'style': pin_type.style,
+            'pin_count': stats.pin_count if stats is not None else 0,
+            'bounds': (stats.min_latitude, stats.min_longitude, stats.max_latitude, stats.max_longitude) if has_pins else None,
+            'last_modified': stats.last_modified if stats is not None else None,
+        })
+
+    return result
+
+@scoped_to_map
+def add_pin(pin_type_name, latitude, longitude, field_values, on_duplicate="allow",
+            duplicate_distance_m=DEFAULT_DISTANCE_M, key_fields=None, map_id=DEFAULT_MAP_ID):
     """
     Add a new pin.
 
+    A pin of the same type within duplicate_distance_m of the new pin, with the same values
+    in the key fields, is a duplicate. on_duplicate decides what happens then: "allow"
+    adds the pin anyway, "merge" fills the empty fields of the existing pin with the new
+    values and returns it, and "reject" raises DuplicatePinError.
+
     Args:
         pin_type_name (str): The name of the pin type.
         latitude (float): The latitude of the pin.
         longitude (float): The longitude of the pin.
         field_values (dict): A dictionary of field values for the pin.
+        on_duplicate (str, optional): "allow", "merge" or "reject". Defaults to "allow".
+        duplicate_distance_m (float, optional): The distance in meters under which pins are duplicates. Defaults to 5.
+        key_fields (list, optional): The fields whose values must be equal for pins to be duplicates. Defaults to None.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
 
     Returns:
-        Pin: The created Pin object.
+        Pin: The created Pin object, or the existing one if the pin was merged.
     """
-    pin_type = PinType.get_or_none(PinType.name == pin_type_name)
+    if on_duplicate not in ("allow", "merge", "reject"):
+        raise ValueError(f"Unknown on_duplicate '{on_duplicate}'.")
+    pin_type = PinType.get_or_none((PinType.map == map_id) & (PinType.name == pin_type_name))
     if not pin_type:
         raise ValueError(f"PinType '{pin_type_name}' does not exist.")
     
-    pin = Pin.create(pin_type=pin_type, latitude=latitude, longitude=longitude)
-    
-    for field_name, value in field_values.items():
-        field = Field.get_or_none((Field.pin_type == pin_type) & (Field.name == field_name))
-        if not field:
-            raise ValueError(f"Field '{field_name}' does not exist for PinType '{pin_type_name}'.")
-        
-        FieldValue.create(pin=pin, field=field, value=value)
-    
+    duplicate = None
+    with database.atomic():
+        if on_duplicate != "allow":
+            duplicate = find_duplicate(pin_type, latitude, longitude, field_values, duplicate_distance_m, key_fields)
+            if duplicate is not None:
+                if on_duplicate == "reject":
+                    raise DuplicatePinError(duplicate)
+                if merge_field_values(duplicate, field_values):
+                    record_change('pin', duplicate.uid, 'upsert', pin_snapshot(duplicate))
+
+        if duplicate is None:
+            pin = Pin.create(map=map_id, pin_type=pin_type, latitude=latitude, longitude=longitude)
+            
+            for field_name, value in field_values.items():
+                field = Field.get_or_none((Field.pin_type == pin_type) & (Field.name == field_name))
+                if not field:
+                    raise ValueError(f"Field '{field_name}' does not exist for PinType '{pin_type_name}'.")
+                
+                FieldValue.create(pin=pin, field=field, value=value)
+            
+            record_change('pin', pin.uid, 'upsert', pin_snapshot(pin))
+    if duplicate is not None:
+        pin_details.invalidate(map_id, [duplicate.id])
+        return duplicate
     return pin
 
-def get_pin_by_id(pin_id):
+@scoped_to_map
+def get_pin_by_id(pin_id, map_id=DEFAULT_MAP_ID):
     """
     Get a pin by its ID.
 
+    Recently read pins are served from the cache without querying the database.
+
     Args:
         pin_id (int): The ID of the pin.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
 
     Returns:
         dict: A dictionary representing the pin.
     """
-    pin = Pin.get_or_none(Pin.id == pin_id)
-    if not pin:
-        raise ValueError(f"Pin with id '{pin_id}' does not exist.")
-    
-    pin_data = {
-        "id": pin.id,
-        "latitude": pin.latitude,
-        "longitude": pin.longitude,
-        "pin_type": pin.pin_type.name,
-        "color": pin.pin_type.color,
-        "style": pin.pin_type.style,
-        "fields": {}
-    }
-    
-    for field_value in pin.field_values:
-        pin_data["fields"][field_value.field.name] = {
-            "value": field_value.value,
-            "type": field_value.field.field_type
+    def load():
+        pin = (Pin
+               .select(Pin, PinType)
+               .join(PinType)
+               .where((Pin.map == map_id) & (Pin.id == pin_id))
+               .first())
+        if not pin:
+            raise ValueError(f"Pin with id '{pin_id}' does not exist.")
+        
+        pin_data = {
+            "id": pin.id,
+            "latitude": pin.latitude,
+            "longitude": pin.longitude,
+            "pin_type": pin.pin_type.name,
+            "color": pin.pin_type.color,
+            "style": pin.pin_type.style,
+            "fields": {}
         }
-    
-    return pin_data
+        
+        field_values = (FieldValue
+                        .select(FieldValue.value, Field.name, Field.field_type)
+                        .join(Field)
+                        .where(FieldValue.pin == pin)
+                        .tuples())
+        for value, name, field_type in field_values:
+            pin_data["fields"][name] = {
+                "value": value,
+                "type": field_type
+            }
+        
+        return pin_data, pin.pin_type.id
+
+    return pin_details.get(map_id, pin_id, load)
 
-def get_pins(pin_type_name):
+@scoped_to_map
+def get_pins(pin_type_name, map_id=DEFAULT_MAP_ID):
     """
     Get all pins of a specific pin type.
 
     Args:
         pin_type_name (str): The name of the pin type.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
 
     Returns:
-        list: A list of dictionaries representing the pins.
+        list: A list of PinRecord objects, readable as dictionaries, representing the pins.
     """
-    pin_type = PinType.get_or_none(PinType.name == pin_type_name)
+    pin_type = PinType.get_or_none((PinType.map == map_id) & (PinType.name == pin_type_name))
     if not pin_type:
         raise ValueError(f"PinType '{pin_type_name}' does not exist.")
     
-    pins = Pin.select().where(Pin.pin_type == pin_type)
-    result = []
-    for pin in pins:
-        pin_data = {
-            "id": pin.id,
-            "latitude": pin.latitude,
-            "longitude": pin.longitude,
-            "fields": {}
-        }
-        for field_value in pin.field_values:
-            pin_data["fields"][field_value.field.name] = field_value.value
-        result.append(pin_data)
-    
-    return result
+    pins = (Pin
+            .select(Pin.id, Pin.pin_type, Pin.latitude, Pin.longitude)
+            .where((Pin.map == map_id) & (Pin.pin_type == pin_type)))
+    return list(pin_records(pins.tuples().iterator(), map_id))
 
-def get_all_pins():
+@scoped_to_map
+def get_all_pins(map_id=DEFAULT_MAP_ID):
     """
     Get all pins.
 
+    Args:
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
     Returns:
-        list: A list of dictionaries representing all pins.
+        list: A list of PinRecord objects, readable as dictionaries, representing all pins.
     """
-    pins = Pin.select()
-    result = []
-    for pin in pins:
-        pin_data = {
-            "id": pin.id,
-            "pin_type": pin.pin_type.name,
-            "latitude": pin.latitude,
-            "longitude": pin.longitude,
-            "color": pin.pin_type.color,
-            "style": pin.pin_type.style,
-            "fields": {}
-        }
-        for field_value in pin.field_values:
-            pin_data["fields"][field_value.field.name] = field_value.value
-        result.append(pin_data)
-    
-    return result
+    pins = Pin.select(Pin.id, Pin.pin_type, Pin.latitude, Pin.longitude).where(Pin.map == map_id)
+    return list(pin_records(pins.tuples().iterator(), map_id))
+
+def get_pins_in_bounds(south, west, north, east, map_id=DEFAULT_MAP_ID):
+    """
+    Get all pins inside a bounding box.
+
+    Args:
+        south (float): The minimum latitude.
+        west (float): The minimum longitude.
+        north (float): The maximum latitude.
+        east (float): The maximum longitude.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        list: A list of PinRecord objects representing the pins, in the same shape as get_all_pins.
+    """
+    return list(iter_pins(bounds=(south, west, north, east), map_id=map_id))
+
+@scoped_to_map
+def iter_pins(bounds=None, pin_type_name=None, uids=None, with_fields=True, map_id=DEFAULT_MAP_ID):
+    """
+    Iterate over pins without loading them all at once.
+
+    Args:
+        bounds (tuple, optional): The (south, west, north, east) box the pins must be in. Defaults to None.
+        pin_type_name (str, optional): The name of the pin type the pins must have. Defaults to None.
+        uids (list, optional): The uids the pins must have. Defaults to None.
+        with_fields (bool, optional): Whether the pins have their field values. Defaults to True.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Yields:
+        PinRecord: A record representing a pin, in the same shape as get_all_pins plus its uid.
+    """
+    pins = Pin.select(Pin.id, Pin.pin_type, Pin.latitude, Pin.longitude, Pin.uid).where(Pin.map == map_id)
+    if bounds is not None:
+        south, west, north, east = bounds
+        pins = pins.where(Pin.latitude.between(south, north) & Pin.longitude.between(west, east))
+    if pin_type_name is not None:
+        pins = pins.join(PinType).where(PinType.name == pin_type_name)
+    if uids is not None:
+        pins = pins.where(Pin.uid.in_(list(uids)))
+
+    yield from pin_records(pins.tuples().iterator(), map_id, with_fields)
+
+def _date_field_ids(field_name, map_id):
+    query = (Field
+             .select(Field.id)
+             .join(PinType)
+             .where((PinType.map == map_id) & (Field.field_type == 'date')))
+    if field_name is not None:
+        query = query.where(Field.name == field_name)
+    return [field_id for (field_id,) in query.tuples()]
+
+@scoped_to_map
+def get_date_field_names(map_id=DEFAULT_MAP_ID):
+    """
+    Get the names of the date fields of every pin type.
+
+    Args:
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        list: The distinct names, sorted.
+    """
+    query = (Field
+             .select(Field.name)
+             .join(PinType)
+             .where((PinType.map == map_id) & (Field.field_type == 'date'))
+             .distinct()
+             .order_by(Field.name)
+             .tuples())
+    return [name for (name,) in query]
+
+@scoped_to_map
+def get_date_counts(field_name=None, map_id=DEFAULT_MAP_ID):
+    """
+    Get the number of pins per day of the date fields.
+
+    The counts are kept by triggers, so this reads one row per day instead of the pins.
+
+    Args:
+        field_name (str, optional): The name of the date fields to count. Defaults to None,
+            counting every date field; a pin is counted once per date field.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        list: The (day, count) pairs, days as ISO date strings, sorted by day.
+    """
+    field_ids = _date_field_ids(field_name, map_id)
+    if not field_ids:
+        return []
+    query = (DateCount
+             .select(DateCount.day, fn.SUM(DateCount.pin_count))
+             .where(DateCount.field.in_(field_ids))
+             .group_by(DateCount.day)
+             .order_by(DateCount.day)
+             .tuples())
+    return list(query)
+
+@scoped_to_map
+def get_pin_ids_by_date(start, end, field_name=None, pin_ids=None, map_id=DEFAULT_MAP_ID):
+    """
+    Get the IDs of the pins with a date in a range.
 
-def update_pin(pin_id, updated_field_values):
+    The range is read from the index on field and value; dates are stored as ISO strings,
+    which sort like the dates, so no value is parsed.
+
+    Args:
+        start (str): The first day of the range, as an ISO date string.
+        end (str): The day after the range, as an ISO date string.
+        field_name (str, optional): The name of the date fields to look at. Defaults to None,
+            looking at every date field.
+        pin_ids (list, optional): The IDs of the pins to look at. Defaults to None, looking
+            at every pin.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        list: The pin IDs, once for each of their date values in the range.
+    """
+    field_ids = _date_field_ids(field_name, map_id)
+    if not field_ids or start >= end:
+        return []
+    query = (FieldValue
+             .select(FieldValue.pin)
+             .where(FieldValue.field.in_(field_ids) & (FieldValue.value >= start) & (FieldValue.value < end)))
+    if pin_ids is not None:
+        query = query.where(FieldValue.pin.in_(pin_ids))
+    return [pin_id for (pin_id,) in query.tuples()]
+
+@scoped_to_map
+def update_pin(pin_id, updated_field_values, map_id=DEFAULT_MAP_ID):
     """
     Update a pin.
 
     Args:
         pin_id (int): The ID of the pin.
         updated_field_values (dict): A dictionary of updated field values for the pin.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
 
     Returns:
         Pin: The updated Pin object.
     """
-    pin = Pin.get_or_none(Pin.id == pin_id)
+    pin = Pin.get_or_none((Pin.map == map_id) & (Pin.id == pin_id))
     if not pin:
         raise ValueError(f"Pin with ID '{pin_id}' does not exist.")
     
-    for field_name, new_value in updated_field_values.items():
-        field = Field.get_or_none((Field.pin_type == pin.pin_type) & (Field.name == field_name))
-        if not field:
-            raise ValueError(f"Field '{field_name}' does not exist for PinType ID '{pin.pin_type.id}'.")
+    with database.atomic():
+        for field_name, new_value in updated_field_values.items():
+            field = Field.get_or_none((Field.pin_type == pin.pin_type) & (Field.name == field_name))
+            if not field:
+                raise ValueError(f"Field '{field_name}' does not exist for PinType ID '{pin.pin_type.id}'.")
+            
+            field_value = FieldValue.get_or_none((FieldValue.pin == pin) & (FieldValue.field == field))
+            if field_value:
+                field_value.value = new_value
+                field_value.save()
+            else:
+                FieldValue.create(pin=pin, field=field, value=new_value)
         
-        field_value = FieldValue.get_or_none((FieldValue.pin == pin) & (FieldValue.field == field))
-        if field_value:
-            field_value.value = new_value
-            field_value.save()
-        else:
-            FieldValue.create(pin=pin, field=field, value=new_value)
-    
+        record_change('pin', pin.uid, 'upsert', pin_snapshot(pin))
+    pin_details.invalidate(map_id, [pin.id])
     return pin
 
-def delete_pin(pin_id):
+@scoped_to_map
+def update_pins(updates, map_id=DEFAULT_MAP_ID):
+    """
+    Update several pins in a single transaction.
+
+    Each pin is written inside its own savepoint, so a pin that fails does not undo the
+    others, while the whole batch is still committed once.
+
+    Args:
+        updates (dict): The updated field values for each pin, keyed by pin ID.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        dict: The errors raised for the pins that could not be updated, keyed by pin ID.
+    """
+    errors = {}
+    with database.atomic():
+        for pin_id, updated_field_values in updates.items():
+            try:
+                with database.atomic():
+                    update_pin(pin_id, updated_field_values, map_id=map_id)
+            except Exception as e:
+                errors[pin_id] = e
+    return errors
+
+@scoped_to_map
+def delete_pin(pin_id, map_id=DEFAULT_MAP_ID):
     """
     Delete a pin.
 
     Args:
         pin_id (int): The ID of the pin.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
     """
-    pin = Pin.get_or_none(Pin.id == pin_id)
+    pin = Pin.get_or_none((Pin.map == map_id) & (Pin.id == pin_id))
     if not pin:
         raise ValueError(f"Pin with ID '{pin_id}' does not exist.")
     
-    pin.delete_instance(recursive=True)
+    with database.atomic():
+        pin.delete_instance(recursive=True)
+        record_change('pin', pin.uid, 'delete')
+    pin_details.invalidate(map_id, [pin.id])
     print(f"Pin {pin_id} deleted successfully.")
 
-def update_pin_type(pin_type_id, new_name=None, updated_fields=None, new_color=None, new_style=None):
+@scoped_to_map
+def update_pin_type(pin_type_id, new_name=None, updated_fields=None, new_color=None, new_style=None, map_id=DEFAULT_MAP_ID, progress=None):
     """
     Update a pin type.
 
+    The values of removed fields are deleted first, CHUNK_SIZE at a time in their own
+    transactions, and the pin type is then updated in one transaction.
+
     Args:
         pin_type_id (int): The ID of the pin type.
         new_name (str, optional): The new name of the pin type. Defaults to None.
         updated_fields (list, optional): A list of updated fields for the pin type. Defaults to None.
         new_color (str, optional): The new color of the pin type. Defaults to None.
         new_style (str, optional): The new style of the pin type. Defaults to None.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+        progress (function, optional): Function called with the number of values deleted
+            and the total after each chunk; it can raise to stop. Defaults to None.
 
     Returns:
         PinType: The updated PinType object.
     """
-    pin_type = PinType.get_or_none(PinType.id == pin_type_id)
+    pin_type = PinType.get_or_none((PinType.map == map_id) & (PinType.id == pin_type_id))
     if not pin_type:
         raise ValueError(f"PinType with ID '{pin_type_id}' does not exist.")
     
-    if new_name:
-        pin_type.name = new_name
-    if new_color:
-        pin_type.color = new_color
-    if new_style:
-        pin_type.style = new_style
-    pin_type.save()
-    
     if updated_fields is not None:
-        existing_fields = {field.id: field for field in pin_type.fields}
-        for field_data in updated_fields:
-            field_id = field_data.get('id')
-            if field_id and field_id in existing_fields:
-                field = existing_fields[field_id]
-                field.name = field_data['name']
-                field.field_type = field_data['field_type']
-                field.is_required = field_data['is_required']
-                field.save()
-            else:
-                Field.create(pin_type=pin_type, name=field_data['name'], field_type=field_data['field_type'], is_required=field_data['is_required'])
-        
-        for field_id in set(existing_fields) - {field_data.get('id') for field_data in updated_fields}:
-            existing_fields[field_id].delete_instance()
+        kept_field_ids = {field_data.get('id') for field_data in updated_fields}
+        removed_field_ids = [field.id for field in pin_type.fields if field.id not in kept_field_ids]
+        if removed_field_ids:
+            value_ids = [value_id for (value_id,) in FieldValue.select(FieldValue.id).where(FieldValue.field.in_(removed_field_ids)).tuples()]
+            _in_chunks(value_ids, lambda chunk: FieldValue.delete().where(FieldValue.id.in_(chunk)).execute(), progress,
+                       lambda chunk: pin_details.invalidate_pin_type(map_id, pin_type.id))
     
+    with database.atomic():
+        if new_name:
+            pin_type.name = new_name
+        if new_color:
+            pin_type.color = new_color
+        if new_style:
+            pin_type.style = new_style
+        pin_type.save()
+        
+        if updated_fields is not None:
+            existing_fields = {field.id: field for field in pin_type.fields}
+            for field_data in updated_fields:
+                field_id = field_data.get('id')
+                if field_id and field_id in existing_fields:
+                    field = existing_fields[field_id]
+                    field.name = field_data['name']
+                    field.field_type = field_data['field_type']
+                    field.is_required = field_data['is_required']
+                    field.save()
+                else:
+                    Field.create(pin_type=pin_type, name=field_data['name'], field_type=field_data['field_type'], is_required=field_data['is_required'])
+            
+            for field_id in set(existing_fields) - {field_data.get('id') for field_data in updated_fields}:
+                existing_fields[field_id].delete_instance()
+        
+        record_change('pin_type', pin_type.uid, 'upsert', pin_type_snapshot(pin_type))
+    pin_details.invalidate_pin_type(map_id, pin_type.id)
     return pin_type
 
-def delete_pin_type_and_pins(pin_type_name, map_id=0):
+@scoped_to_map
+def delete_pin_type_and_pins(pin_type_name, map_id=DEFAULT_MAP_ID, progress=None):
     """
     Delete a pin type and all associated pins.
 
+    The pins are deleted CHUNK_SIZE at a time in their own transactions, so other sessions
+    can keep writing, and the pin type is deleted last. If it stops early, the pins
+    deleted so far stay deleted and the pin type keeps the others.
+
     Args:
         pin_type_name (str): The name of the pin type.
-        map_id (int, optional): The ID of the map. Defaults to 0.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+        progress (function, optional): Function called with the number of pins deleted and
+            the total after each chunk; it can raise to stop. Defaults to None.
+
+    Raises:
+        ValueError: If the pin type does not exist or is the default pin type.
     """
-    pin_type = PinType.get_or_none(PinType.name == pin_type_name)
+    if pin_type_name == DEFAULT_PIN_TYPE_NAME:
+        raise ValueError(f"PinType '{DEFAULT_PIN_TYPE_NAME}' cannot be deleted.")
+    pin_type = PinType.get_or_none((PinType.map == map_id) & (PinType.name == pin_type_name))
     if not pin_type:
         raise ValueError(f"PinType with ID '{pin_type_name}' does not exist.")
     
-    # Delete all pins of this type
-    pins = Pin.select().where(Pin.pin_type == pin_type)
-    for pin in pins:
-        pin.delete_instance(recursive=True)
+    pins = Pin.select(Pin.id, Pin.uid).where((Pin.map == map_id) & (Pin.pin_type == pin_type)).tuples()
+    uids = dict(pins)
+
+    def delete_chunk(pin_ids):
+        FieldValue.delete().where(FieldValue.pin.in_(pin_ids)).execute()
+        Pin.delete().where(Pin.id.in_(pin_ids)).execute()
+        for pin_id in pin_ids:
+            record_change('pin', uids[pin_id], 'delete')
+
+    _in_chunks(list(uids), delete_chunk, progress, lambda pin_ids: pin_details.invalidate(map_id, pin_ids))
     
-    # Delete the pin type
-    pin_type.delete_instance()
-    print(f"PinType {pin_type_name} and all associated pins deleted successfully.")
\ No newline at end of file
+    with database.atomic():
+        # Also deletes the fields, and any pin added since the pins were listed
+        pin_type.delete_instance(recursive=True)
+        record_change('pin_type', pin_type.uid, 'delete')
+    pin_details.invalidate_pin_type(map_id, pin_type.id)
+    print(f"PinType {pin_type_name} and all associated pins deleted successfully.")
+
+@scoped_to_map
+def deduplicate_pins(distance_m=DEFAULT_DISTANCE_M, key_fields=None, pin_type_name=None, merge=False, map_id=DEFAULT_MAP_ID):
+    """
+    Find duplicate pins and optionally merge each group into its oldest pin.
+
+    Args:
+        distance_m (float, optional): The distance in meters under which pins are duplicates. Defaults to 5.
+        key_fields (list, optional): The fields whose values must be equal. Defaults to None.
+        pin_type_name (str, optional): Only check pins of this pin type. Defaults to None.
+        merge (bool, optional): Whether to merge the duplicates. Defaults to False.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        dict: The 'clusters' of duplicates, as returned by find_duplicate_clusters, and the
+        number of 'duplicates' (pins beyond the first of each cluster) and of 'deleted' pins.
+    """
+    with database.atomic():
+        clusters = find_duplicate_clusters(distance_m, key_fields, pin_type_name, map_id)
+        deleted = merge_clusters(clusters)["deleted"] if merge else 0
+    if merge:
+        pin_details.invalidate(map_id, [pin_id for cluster in clusters for pin_id in cluster["pin_ids"]])
+    return {
+        "clusters": clusters,
+        "duplicates": sum(len(cluster["pin_ids"]) - 1 for cluster in clusters),
+        "deleted": deleted,
+    }
\ No newline at end of file
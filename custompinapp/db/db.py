@@ -1,31 +1,84 @@
 """
 Database models and initialization for the Custom Pins application.
 
-This module defines the database models and initializes the SQLite database.
+This module defines the database models and initializes the SQLite database. The
+database is map_pins.db at the root of the repository, or the file named by the
+CUSTOMPINS_DB environment variable.
+
+Pin types and pins belong to a map. A map lives either in the shared database or in its
+own SQLite file; db.router sends each query to the right file.
+
+Files are opened in write-ahead log mode, so readers never wait for a writer and several
+app processes on the same host can share them. CUSTOMPINS_JOURNAL_MODE overrides the mode
+for file systems without shared memory, such as network shares.
+
+Setting CUSTOMPINS_DB to ":memory:" keeps the database, and the files of the maps stored
+in their own file, in shared-cache in-memory SQLite databases instead: every thread of
+the process sees the same data, nothing is written to disk, and the data is gone when the
+process exits. This suits tests, benchmarks and demo maps. CUSTOMPINS_STORAGE set to
+"sqlite-memory" does the same, whatever CUSTOMPINS_DB is.
 
 Classes:
     BaseModel: Base model class for all database models.
+    Map: Model class for maps.
     PinType: Model class for pin types.
     Field: Model class for fields associated with pin types.
     Pin: Model class for pins.
+    PinTypeStats: Model class for the statistics of the pins of each pin type.
     FieldValue: Model class for field values associated with pins.
+    DateCount: Model class for the number of pins per day of each date field.
+    ChangeLog: Model class for the journal of changes used by sync.
+    SyncState: Model class for sync settings and watermarks.
+    Job: Model class for background jobs.
 
 Functions:
-    create_default_pin_type(): Create the default pin type with name and date fields.
+    new_uid(): Generate a unique identifier shared by a row across devices.
+    initialize_schema(): Create or upgrade the tables of the selected database file.
+    create_default_map(): Create the default map.
+    prepare_map_file(map_id): Create the tables of a map stored in its own file.
+    create_default_pin_type(map=None): Create the default pin type with name and date fields.
 """
 from peewee import (
-    Model, SqliteDatabase, IntegerField, FloatField, TextField, ForeignKeyField, CharField
+    Model, IntegerField, FloatField, TextField, ForeignKeyField, CharField, AutoField, CompositeKey
 )
 import os
+import uuid
+from db.defaults import DEFAULT_MAP_ID, DEFAULT_PIN_TYPE_NAME
+from db.router import MapRoutedDatabase
+from db.migrations import migrate
 
 # Define the database path and initialize the database
 path = os.path.abspath(__file__)
 path = os.path.dirname(path)
 path = os.path.dirname(path)
 path = os.path.dirname(path)
-db_path = os.path.join(path, 'map_pins.db')
-database = SqliteDatabase(db_path)
-print(db_path)
+db_path = os.environ.get('CUSTOMPINS_DB') or os.path.join(path, 'map_pins.db')  # Overridden by tools that must not touch the app's data
+if os.environ.get('CUSTOMPINS_STORAGE') == 'sqlite-memory':
+    db_path = ':memory:'
+in_memory = db_path == ':memory:'
+if in_memory:
+    # Names of the in-memory databases, not files
+    db_path, maps_path = 'custompins', 'custompins-maps'
+    # Readers skip the table locks, which stand in for WAL mode's snapshots there
+    pragmas = [('read_uncommitted', 1)]
+else:
+    maps_path = os.path.join(os.path.dirname(db_path), 'maps')
+    journal_mode = os.environ.get('CUSTOMPINS_JOURNAL_MODE', 'wal').lower()
+    pragmas = [('journal_mode', journal_mode)]
+    if journal_mode == 'wal':
+        # In WAL mode a power loss may then lose the last commits, but cannot corrupt the file
+        pragmas.append(('synchronous', 'normal'))
+database = MapRoutedDatabase(db_path, maps_path, in_memory=in_memory, pragmas=pragmas)
+print(database.shared_path)
+
+def new_uid():
+    """
+    Generate a unique identifier shared by a row across devices.
+
+    Returns:
+        str: A random hexadecimal identifier.
+    """
+    return uuid.uuid4().hex
 
 class BaseModel(Model):
     """
@@ -37,19 +90,42 @@ class BaseModel(Model):
     class Meta:
         database = database
 
+class Map(BaseModel):
+    """
+    Model class for maps.
+
+    Attributes:
+        uid (CharField): The identifier of the map across devices.
+        name (CharField): The name of the map.
+        file_name (CharField): The SQLite file holding the map's pins, or None if they are
+            kept in the shared database.
+    """
+    uid = CharField(unique=True, default=new_uid)
+    name = CharField(unique=True, null=False)
+    file_name = CharField(null=True)
+
 class PinType(BaseModel):
     """
     Model class for pin types.
 
     Attributes:
+        uid (CharField): The identifier of the pin type across devices.
+        map (ForeignKeyField): The map the pin type belongs to.
         name (CharField): The name of the pin type.
         color (CharField): The color of the pin type.
         style (CharField): The style of the pin type.
     """
-    name = CharField(unique=True, null=False)  # Ensures name is unique
+    uid = CharField(unique=True, default=new_uid)
+    map = ForeignKeyField(Map, backref='pin_types', on_delete='CASCADE', default=DEFAULT_MAP_ID, index=False)
+    name = CharField(null=False)
     color = CharField(default="36aedc", null=False)
     style = CharField(default="add_location", null=False)
 
+    class Meta:
+        indexes = (
+            (('map', 'name'), True),  # Names are unique within a map
+        )
+
 class Field(BaseModel):
     """
     Model class for fields associated with pin types.
@@ -65,19 +141,36 @@ class Field(BaseModel):
     field_type = CharField(null=False)  # 'string', 'number', 'date'
     is_required = IntegerField(default=0)  # 0 = False, 1 = True
 
+    class Meta:
+        indexes = (
+            (('pin_type', 'name'), False),
+        )
+
 class Pin(BaseModel):
     """
     Model class for pins.
 
     Attributes:
+        uid (CharField): The identifier of the pin across devices.
+        map (ForeignKeyField): The map the pin belongs to, the same as its pin type's.
         pin_type (ForeignKeyField): The pin type associated with the pin.
         latitude (FloatField): The latitude of the pin.
         longitude (FloatField): The longitude of the pin.
     """
+    uid = CharField(unique=True, default=new_uid)
+    map = ForeignKeyField(Map, backref='pins', on_delete='CASCADE', default=DEFAULT_MAP_ID, index=False)
     pin_type = ForeignKeyField(PinType, backref='pins', on_delete='CASCADE')
     latitude = FloatField(null=False)
     longitude = FloatField(null=False)
 
+    class Meta:
+        indexes = (
+            (('map', 'pin_type'), False),
+            (('map', 'latitude', 'longitude'), False),
+            (('pin_type', 'latitude'), False),  # Pin type bounds, kept by triggers
+            (('pin_type', 'longitude'), False),
+        )
+
 class FieldValue(BaseModel):
     """
     Model class for field values associated with pins.
@@ -91,21 +184,218 @@ class FieldValue(BaseModel):
     field = ForeignKeyField(Field, backref='field_values', on_delete='CASCADE')
     value = TextField(null=False)  # Store value as text
 
-# Create tables
-database.connect()
-database.create_tables([PinType, Field, Pin, FieldValue])
+    class Meta:
+        indexes = (
+            (('pin', 'field'), False),
+            (('field', 'value'), False),  # Date ranges; ISO dates sort like the dates
+        )
+
+class DateCount(BaseModel):
+    """
+    Model class for the number of pins per day of each date field.
+
+    Rows are maintained by SQLite triggers on the field value and field tables (see
+    db.migrations), like PinTypeStats. Values longer than a date count for the day they
+    start with.
+
+    Attributes:
+        field (ForeignKeyField): The date field.
+        day (CharField): The day, as an ISO date string.
+        pin_count (IntegerField): The number of pins whose value of the field is on the day.
+    """
+    field = ForeignKeyField(Field, backref='date_counts', on_delete='CASCADE')
+    day = CharField(null=False)
+    pin_count = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey('field', 'day')
+
+class PinTypeStats(BaseModel):
+    """
+    Model class for the statistics of the pins of each pin type.
+
+    Rows are maintained by SQLite triggers on the pin, field value and pin type tables (see
+    db.migrations), so they are current whichever code path changed the pins.
+
+    Attributes:
+        pin_type (ForeignKeyField): The pin type the statistics are about.
+        pin_count (IntegerField): The number of pins of the type.
+        min_latitude (FloatField): The southernmost latitude of the pins, or None without pins.
+        max_latitude (FloatField): The northernmost latitude of the pins, or None without pins.
+        min_longitude (FloatField): The westernmost longitude of the pins, or None without pins.
+        max_longitude (FloatField): The easternmost longitude of the pins, or None without pins.
+        last_modified (FloatField): The time a pin of the type last changed, in seconds since the epoch.
+    """
+    pin_type = ForeignKeyField(PinType, primary_key=True, backref='stats', on_delete='CASCADE')
+    pin_count = IntegerField(default=0)
+    min_latitude = FloatField(null=True)
+    max_latitude = FloatField(null=True)
+    min_longitude = FloatField(null=True)
+    max_longitude = FloatField(null=True)
+    last_modified = FloatField(null=True)
+
+class ChangeLog(BaseModel):
+    """
+    Model class for the journal of changes used by sync.
+
+    Every mutation made through the CRUD layer appends one entry. Entries are never
+    updated, so seq is a monotonic sequence number that devices use as a sync watermark.
+
+    Attributes:
+        seq (AutoField): The sequence number of the change.
+        entity (CharField): The kind of entity changed ('pin_type' or 'pin').
+        entity_uid (CharField): The uid of the entity changed.
+        operation (CharField): The operation ('upsert' or 'delete').
+        payload (TextField): The JSON snapshot of the entity after the change.
+        origin (CharField): The device ID where the change was made.
+        timestamp (FloatField): The time of the change, in seconds since the epoch.
+    """
+    seq = AutoField()
+    entity = CharField(null=False)
+    entity_uid = CharField(null=False)
+    operation = CharField(null=False)
+    payload = TextField(default="{}")
+    origin = CharField(null=False)
+    timestamp = FloatField(null=False)
+
+    class Meta:
+        indexes = (
+            (('entity', 'entity_uid', 'seq'), False),
+        )
+
+class SyncState(BaseModel):
+    """
+    Model class for sync settings and watermarks.
+
+    Attributes:
+        key (CharField): The name of the setting.
+        value (TextField): The value of the setting.
+    """
+    key = CharField(primary_key=True)
+    value = TextField(null=False)
+
+class Job(BaseModel):
+    """
+    Model class for background jobs.
+
+    Jobs are kept in the shared database and run by db.jobs.
+
+    Attributes:
+        kind (CharField): The kind of job, a key of db.jobs.JOB_KINDS.
+        params (TextField): The JSON arguments of the job.
+        map_id (IntegerField): The map the job works on.
+        status (CharField): 'queued', 'running', 'done', 'failed' or 'cancelled'.
+        done (IntegerField): The number of steps done.
+        total (IntegerField): The number of steps, or 0 if not known yet.
+        message (TextField): What the job is doing, or None.
+        result (TextField): The JSON result of a job that is done, or None.
+        error (TextField): The error of a job that failed, or None.
+        cancel_requested (IntegerField): Whether the job was asked to stop (0 = False, 1 = True).
+        created_at (FloatField): The time the job was submitted, in seconds since the epoch.
+        started_at (FloatField): The time the job started running, or None.
+        heartbeat_at (FloatField): The time the running job last reported progress, or None.
+        finished_at (FloatField): The time the job finished, or None.
+    """
+    kind = CharField(null=False)
+    params = TextField(default="{}")
+    map_id = IntegerField(default=DEFAULT_MAP_ID)
+    status = CharField(default="queued", null=False)
+    done = IntegerField(default=0)
+    total = IntegerField(default=0)
+    message = TextField(null=True)
+    result = TextField(null=True)
+    error = TextField(null=True)
+    cancel_requested = IntegerField(default=0)
+    created_at = FloatField(null=False)
+    started_at = FloatField(null=True)
+    heartbeat_at = FloatField(null=True)
+    finished_at = FloatField(null=True)
+
+    class Meta:
+        indexes = (
+            (('status', 'created_at'), False),
+        )
+
+# The default map and pin type are created on every device, so they share fixed uids
+DEFAULT_MAP_UID = "default"
+DEFAULT_PIN_TYPE_UID = "default"
+
+MODELS = [Map, PinType, Field, Pin, FieldValue, PinTypeStats, DateCount, ChangeLog, SyncState, Job]
+
+def initialize_schema():
+    """
+    Create or upgrade the tables of the selected database file.
+
+    A new file gets its tables from the models first, so that every migration finds them,
+    then existing files are brought up to date and anything still missing is created.
+    """
+    if not database.table_exists(Pin._meta.table_name):
+        database.create_tables(MODELS)
+    migrate(database)
+    database.create_tables(MODELS)
+
+def create_default_map():
+    """
+    Create the default map, which holds the pins of databases from before maps existed.
+
+    Returns:
+        Map: The default map.
+    """
+    default_map, _ = Map.get_or_create(
+        id=DEFAULT_MAP_ID,
+        defaults={"uid": DEFAULT_MAP_UID, "name": "Default"}
+    )
+    return default_map
+
+def prepare_map_file(map_id):
+    """
+    Create the tables of a map stored in its own file.
+
+    Called by the router, with the map's file selected, the first time the file is used.
+    The map row is copied from the shared database so the file is self-describing.
+
+    Args:
+        map_id (int): The ID of the map.
+    """
+    with database.use_shared():
+        map_row = Map.get_by_id(map_id)
+    if not database.in_memory:
+        os.makedirs(database.directory, exist_ok=True)
+    initialize_schema()
+    Map.insert(id=map_row.id, uid=map_row.uid, name=map_row.name, file_name=map_row.file_name).on_conflict_ignore().execute()
+    create_default_pin_type(map_row)
+
+def _resolve_map_file(map_id):
+    map_row = Map.get_or_none(Map.id == map_id)
+    if map_row is None:
+        raise ValueError(f"Map with ID '{map_id}' does not exist.")
+    return map_row.file_name
+
+database.resolve_file = _resolve_map_file
+database.on_new_file = prepare_map_file
 
 # Create the "Default" pin type with name and date fields
-def create_default_pin_type():
+def create_default_pin_type(map=None):
     """
     Creates the default pin type with predefined fields if it doesn't already exist.
 
-    This function checks if a pin type named "Default" exists. If not, it creates the pin type
+    This function checks if a pin type named "Default" exists in the map. If not, it creates the pin type
     and adds two fields: "Name" (string) and "Date" (date), both of which are required.
+
+    Args:
+        map (Map, optional): The map of the pin type. Defaults to the default map.
+
+    Returns:
+        PinType: The default pin type.
     """
+    if map is None or map.id == DEFAULT_MAP_ID:
+        map_id, uid = DEFAULT_MAP_ID, DEFAULT_PIN_TYPE_UID
+    else:
+        map_id, uid = map.id, f"{map.uid}-{DEFAULT_PIN_TYPE_UID}"
     default_pin_type, created = PinType.get_or_create(
-        name="Default",
-        defaults={"color": "36aedc", "style": "add_location"}
+        map=map_id,
+        name=DEFAULT_PIN_TYPE_NAME,
+        defaults={"uid": uid, "color": "36aedc", "style": "add_location"}
     )
     if created:
         Field.create(pin_type=default_pin_type, name="Name", field_type="string", is_required=1)
@@ -113,8 +403,15 @@ def create_default_pin_type():
         print("Default pin type and fields created.")
     else:
         print("Default pin type already exists.")
+    return default_pin_type
 
-create_default_pin_type()
+# Create or upgrade the tables. The write lock is held throughout, so processes starting
+# together run the migrations and create the defaults once
+database.connect()
+with database.atomic():
+    initialize_schema()
+    create_default_map()
+    create_default_pin_type()
 def get_session():
     """
     Retrieves the current database session.
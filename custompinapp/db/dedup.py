@@ -0,0 +1,237 @@
+"""
+Duplicate pin detection for the Custom Pins application.
+
+Two pins are duplicates when they have the same pin type, lie within a distance of each
+other and have equal values in the chosen key fields. New pins are checked against the
+pins around them with a bounding box query before they are created. Existing data is
+checked in one vectorized pass: pins are hashed into a grid of cells as large as the
+distance, so only pins in neighbouring cells are compared, and duplicates are grouped
+into clusters that can be reported or merged.
+
+NumPy is imported on first use by the batch pass only.
+
+Functions:
+    find_duplicate(pin_type, latitude, longitude, field_values, distance_m=DEFAULT_DISTANCE_M, key_fields=None): Find a pin that a new pin would duplicate.
+    merge_field_values(pin, field_values): Fill the empty fields of a pin with new values.
+    find_duplicate_clusters(distance_m=DEFAULT_DISTANCE_M, key_fields=None, pin_type_name=None, map_id=DEFAULT_MAP_ID): Group the existing duplicates.
+    merge_clusters(clusters): Merge each cluster of duplicates into its oldest pin.
+"""
+import math
+from db.db import PinType, Pin, Field, FieldValue, DEFAULT_MAP_ID
+from db.defaults import DEFAULT_DISTANCE_M
+from db.journal import record_change, pin_snapshot
+
+METERS_PER_DEGREE = 111320.0
+
+def _field_values(pin_ids):
+    values = {pin_id: {} for pin_id in pin_ids}
+    query = (FieldValue
+             .select(FieldValue.pin, FieldValue.value, Field.name)
+             .join(Field)
+             .where(FieldValue.pin.in_(list(pin_ids))))
+    for field_value in query:
+        values[field_value.pin_id][field_value.field.name] = field_value.value
+    return values
+
+def _keys_match(a, b, key_fields):
+    return all(a.get(name) == b.get(name) for name in key_fields or ())
+
+def _distance_m(lat1, lng1, lat2, lng2):
+    # Equirectangular approximation, exact enough at the few meters compared here
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * METERS_PER_DEGREE * 180 / math.pi
+
+def find_duplicate(pin_type, latitude, longitude, field_values, distance_m=DEFAULT_DISTANCE_M, key_fields=None):
+    """
+    Find a pin that a new pin would duplicate.
+
+    Args:
+        pin_type (PinType): The pin type of the new pin.
+        latitude (float): The latitude of the new pin.
+        longitude (float): The longitude of the new pin.
+        field_values (dict): The field values of the new pin.
+        distance_m (float, optional): The distance in meters under which pins are duplicates. Defaults to 5.
+        key_fields (list, optional): The fields whose values must be equal. Defaults to None.
+
+    Returns:
+        Pin: The closest duplicate, or None.
+    """
+    lat_span = distance_m / METERS_PER_DEGREE
+    lng_span = lat_span / max(math.cos(math.radians(latitude)), 1e-6)
+    candidates = list(Pin.select().where(
+        (Pin.map == pin_type.map_id)
+        & (Pin.pin_type == pin_type)
+        & Pin.latitude.between(latitude - lat_span, latitude + lat_span)
+        & Pin.longitude.between(longitude - lng_span, longitude + lng_span)
+    ))
+    candidates = [pin for pin in candidates if _distance_m(latitude, longitude, pin.latitude, pin.longitude) <= distance_m]
+    if key_fields and candidates:
+        values = _field_values([pin.id for pin in candidates])
+        candidates = [pin for pin in candidates if _keys_match(values[pin.id], field_values, key_fields)]
+    return min(candidates, key=lambda pin: _distance_m(latitude, longitude, pin.latitude, pin.longitude), default=None)
+
+def merge_field_values(pin, field_values):
+    """
+    Fill the empty fields of a pin with new values, keeping the values it already has.
+
+    Args:
+        pin (Pin): The pin.
+        field_values (dict): The new field values by field name.
+
+    Returns:
+        bool: True if a field was filled.
+    """
+    current = _field_values([pin.id])[pin.id]
+    changed = False
+    for field_name, value in field_values.items():
+        if value in (None, "") or current.get(field_name) not in (None, ""):
+            continue
+        field = Field.get_or_none((Field.pin_type == pin.pin_type) & (Field.name == field_name))
+        if field is None:
+            raise ValueError(f"Field '{field_name}' does not exist for PinType '{pin.pin_type.name}'.")
+        updated = (FieldValue.update(value=value)
+                   .where((FieldValue.pin == pin) & (FieldValue.field == field))
+                   .execute())
+        if not updated:
+            FieldValue.create(pin=pin, field=field, value=value)
+        changed = True
+    return changed
+
+def _candidate_pairs(np, x, y, types, cell_m):
+    # Hash each pin to a grid cell; a duplicate can only be in the same or a neighbouring cell
+    cx = np.floor(x / cell_m).astype(np.int64)
+    cy = np.floor(y / cell_m).astype(np.int64)
+
+    def cell_key(column, row):
+        # Collisions only add candidates, which the exact check below drops
+        return (types * 1000003 + column) * 1000033 + row
+
+    keys = cell_key(cx, cy)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    pairs_i, pairs_j = [], []
+    # Half of the neighbourhood, so every pair of cells is visited once
+    for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+        targets = cell_key(cx + dx, cy + dy)
+        low = np.searchsorted(sorted_keys, targets, side='left')
+        high = np.searchsorted(sorted_keys, targets, side='right')
+        counts = high - low
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        i = np.repeat(np.arange(len(x)), counts)
+        offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        j = order[np.repeat(low, counts) + offsets]
+        keep = (i < j) if (dx, dy) == (0, 0) else (i != j)
+        pairs_i.append(i[keep])
+        pairs_j.append(j[keep])
+
+    if not pairs_i:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    i, j = np.concatenate(pairs_i), np.concatenate(pairs_j)
+    close = (types[i] == types[j]) & (np.hypot(x[i] - x[j], y[i] - y[j]) <= cell_m)
+    return i[close], j[close]
+
+def find_duplicate_clusters(distance_m=DEFAULT_DISTANCE_M, key_fields=None, pin_type_name=None, map_id=DEFAULT_MAP_ID):
+    """
+    Group the existing duplicate pins into clusters.
+
+    Pins are joined into a cluster when they are duplicates of another pin of the cluster,
+    so a chain of close pins forms a single cluster.
+
+    Args:
+        distance_m (float, optional): The distance in meters under which pins are duplicates. Defaults to 5.
+        key_fields (list, optional): The fields whose values must be equal. Defaults to None.
+        pin_type_name (str, optional): Only check pins of this pin type. Defaults to None.
+        map_id (int, optional): The ID of the map. Defaults to the default map.
+
+    Returns:
+        list: The clusters, each a dictionary with the 'pin_type', the 'pin_ids' from oldest
+        to newest and the 'latitude' and 'longitude' of the oldest pin.
+    """
+    import numpy as np
+
+    query = (Pin
+             .select(Pin.id, Pin.pin_type, Pin.latitude, Pin.longitude)
+             .join(PinType)
+             .where(Pin.map == map_id)
+             .order_by(Pin.id))
+    if pin_type_name is not None:
+        query = query.where(PinType.name == pin_type_name)
+    rows = list(query.tuples())
+    if len(rows) < 2:
+        return []
+
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    types = np.array([row[1] for row in rows], dtype=np.int64)
+    latitudes = np.array([row[2] for row in rows], dtype=float)
+    longitudes = np.array([row[3] for row in rows], dtype=float)
+    # Local meters; the error of the projection is negligible at the distances compared
+    meters_per_radian = METERS_PER_DEGREE * 180 / np.pi
+    x = np.radians(longitudes) * np.cos(np.radians(latitudes)) * meters_per_radian
+    y = np.radians(latitudes) * meters_per_radian
+
+    i, j = _candidate_pairs(np, x, y, types, distance_m)
+    if key_fields and len(i):
+        values = _field_values({int(ids[k]) for k in np.concatenate([i, j])})
+        matching = [n for n in range(len(i)) if _keys_match(values[int(ids[i[n]])], values[int(ids[j[n]])], key_fields)]
+        i, j = i[matching], j[matching]
+
+    # Union-find over the pairs; rows are ordered by ID, so the lowest index is the oldest pin
+    parent = list(range(len(rows)))
+
+    def root(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        ra, rb = root(a), root(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+
+    members = {}
+    for k in sorted(set(i.tolist()) | set(j.tolist())):
+        members.setdefault(root(k), []).append(k)
+    pin_type_names = {pin_type.id: pin_type.name for pin_type in PinType.select().where(PinType.id.in_({int(t) for t in types}))}
+    return [
+        {
+            "pin_type": pin_type_names[int(types[first])],
+            "pin_ids": [int(ids[k]) for k in group],
+            "latitude": float(latitudes[first]),
+            "longitude": float(longitudes[first]),
+        }
+        for first, group in sorted(members.items())
+    ]
+
+def merge_clusters(clusters):
+    """
+    Merge each cluster of duplicates into its oldest pin.
+
+    The oldest pin keeps its values and gets the values of the others for the fields it
+    leaves empty; the other pins are deleted. Every change is journaled. Must be called
+    inside a transaction on the cluster's map.
+
+    Args:
+        clusters (list): The clusters, as returned by find_duplicate_clusters.
+
+    Returns:
+        dict: The number of 'kept' and 'deleted' pins.
+    """
+    report = {"kept": 0, "deleted": 0}
+    for cluster in clusters:
+        kept = Pin.get_by_id(cluster["pin_ids"][0])
+        for pin_id in cluster["pin_ids"][1:]:
+            duplicate = Pin.get_or_none(Pin.id == pin_id)
+            if duplicate is None:
+                continue
+            merge_field_values(kept, _field_values([pin_id])[pin_id])
+            duplicate.delete_instance(recursive=True)
+            record_change('pin', duplicate.uid, 'delete')
+            report["deleted"] += 1
+        record_change('pin', kept.uid, 'upsert', pin_snapshot(kept))
+        report["kept"] += 1
+    return report
@@ -0,0 +1,19 @@
+"""
+Default values shared by the storage backends of the Custom Pins application.
+
+They are kept here, apart from db.db and db.dedup, so that modules such as db.repository
+can use them without opening the database.
+
+Attributes:
+    DEFAULT_MAP_ID (int): The ID of the default map.
+    DEFAULT_PIN_TYPE_NAME (str): The name of the pin type every map has, which cannot be
+        deleted.
+    DEFAULT_DISTANCE_M (float): The distance in meters within which two pins of the same
+        type are duplicates.
+    CHUNK_SIZE (int): The number of rows written per transaction, or between two progress
+        reports, by the operations that write many rows.
+"""
+DEFAULT_MAP_ID = 1
+DEFAULT_PIN_TYPE_NAME = "Default"
+DEFAULT_DISTANCE_M = 5.0
+CHUNK_SIZE = 500
@@ -0,0 +1,430 @@
+"""
+Background jobs for the Custom Pins application.
+
+Long operations, such as deleting a pin type with many pins, run as jobs on a pool of
+worker threads instead of inside UI callbacks or requests. Jobs are rows of the job table
+in the shared database, so a job that was queued, or was running when its process
+stopped, runs again when a runner starts. A job reports its progress as it goes, from
+which its time left is estimated, and stops at its next report once it is cancelled.
+
+Classes:
+    JobCancelled: Raised inside a job that was cancelled.
+    JobContext: The handle a running job reports its progress through.
+    JobRunner: Runs jobs on a pool of worker threads.
+
+Functions:
+    job_kind(name, check=None): Register a function as a kind of job.
+    job_dict(job): Build the dictionary describing a job.
+
+Attributes:
+    JOB_KINDS (dict): The registered job functions by kind.
+    JOB_CHECKS (dict): The functions checking the parameters of a job when it is
+        submitted, by kind.
+    job_runner (JobRunner): The runner shared by the application.
+"""
+import json
+import queue
+import threading
+import time
+from db.db import get_session, Job, DEFAULT_MAP_ID
+from db.defaults import CHUNK_SIZE, DEFAULT_DISTANCE_M, DEFAULT_PIN_TYPE_NAME
+from db.repository import get_repository
+
+database = get_session()
+repository = get_repository()
+
+WORKERS = 2
+PROGRESS_INTERVAL = 0.5  # seconds between progress writes and cancellation checks
+STALE_AFTER = 300  # seconds without progress after which a running job is taken as interrupted
+STEP_PAUSE = 0.1  # seconds a job waits after each step, longer than SQLite's longest busy wait
+ACTIVE_STATUSES = ('queued', 'running')
+
+JOB_KINDS = {}
+JOB_CHECKS = {}
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job that was cancelled.
+    """
+
+def job_kind(name, check=None):
+    """
+    Register a function as a kind of job.
+
+    The function is called with a JobContext, the ID of the map and the parameters of the
+    job as keyword arguments, and returns the JSON result of the job.
+
+    Args:
+        name (str): The kind of job.
+        check (function, optional): Function called with the ID of the map and the
+            parameters as keyword arguments when a job is submitted; it raises ValueError
+            to refuse the job. Defaults to None.
+
+    Returns:
+        function: The decorator.
+    """
+    def register(function):
+        JOB_KINDS[name] = function
+        if check is not None:
+            JOB_CHECKS[name] = check
+        return function
+    return register
+
+def job_dict(job):
+    """
+    Build the dictionary describing a job.
+
+    Args:
+        job (Job): The job.
+
+    Returns:
+        dict: The 'id', 'kind', 'map_id', 'status', 'done', 'total', 'progress' (0 to 1),
+        'eta_s' (the estimated seconds left, or None), 'message', 'result', 'error',
+        'created_at', 'started_at' and 'finished_at' of the job.
+    """
+    progress = job.done / job.total if job.total else 0.0
+    if job.status == 'done':
+        progress = 1.0
+    eta = None
+    if job.status == 'running' and job.started_at is not None and 0 < progress < 1:
+        elapsed = time.time() - job.started_at
+        eta = elapsed * (1 - progress) / progress
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "map_id": job.map_id,
+        "status": job.status,
+        "done": job.done,
+        "total": job.total,
+        "progress": progress,
+        "eta_s": eta,
+        "message": job.message,
+        "result": json.loads(job.result) if job.result is not None else None,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+class JobContext:
+    """
+    The handle a running job reports its progress through.
+
+    Attributes:
+        job (Job): The job, with its progress as last reported.
+    """
+    def __init__(self, runner, job):
+        """
+        Initialize a JobContext instance.
+
+        Args:
+            runner (JobRunner): The runner of the job.
+            job (Job): The job.
+        """
+        self.job = job
+        self._runner = runner
+        self._reported_at = 0.0
+
+    def progress(self, done, total, message=None):
+        """
+        Report the progress of the job.
+
+        Reports are written at most every PROGRESS_INTERVAL seconds, and the last step
+        always is. Each write also checks whether the job was cancelled. The job then
+        pauses for STEP_PAUSE seconds: a session waiting for the write lock only retries
+        every so often, and would never get it from a job that starts its next
+        transaction right away.
+
+        Args:
+            done (int): The number of steps done.
+            total (int): The number of steps.
+            message (str, optional): What the job is doing. Defaults to None.
+
+        Raises:
+            JobCancelled: If the job was cancelled.
+        """
+        job = self.job
+        job.done, job.total = done, total
+        if message is not None:
+            job.message = message
+        if self._runner.is_cancelled(job.id):
+            raise JobCancelled()
+        now = time.monotonic()
+        if now - self._reported_at >= PROGRESS_INTERVAL or done >= total:
+            self._reported_at = now
+            job.heartbeat_at = time.time()
+            with database.use_shared():
+                Job.update(done=job.done, total=job.total, message=job.message, heartbeat_at=job.heartbeat_at).where(Job.id == job.id).execute()
+                cancelled = Job.select(Job.cancel_requested).where(Job.id == job.id).scalar()
+            if cancelled:
+                raise JobCancelled()
+            self._runner._notify(job)
+        time.sleep(STEP_PAUSE)
+
+class JobRunner:
+    """
+    Runs jobs on a pool of worker threads.
+
+    Attributes:
+        workers (int): The number of worker threads.
+    """
+    def __init__(self, workers=WORKERS):
+        """
+        Initialize a JobRunner instance.
+
+        Args:
+            workers (int, optional): The number of worker threads. Defaults to WORKERS.
+        """
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._threads = []
+        self._listeners = []
+        self._on_done = {}
+        self._cancelled = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the worker threads and queue the jobs left over by earlier runs.
+
+        Does nothing if the runner has already started.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        with database.use_shared():
+            # Jobs whose process stopped while running them start over
+            stale = time.time() - STALE_AFTER
+            Job.update(status='queued').where((Job.status == 'running') & (Job.heartbeat_at < stale)).execute()
+            queued = [job_id for (job_id,) in Job.select(Job.id).where(Job.status == 'queued').order_by(Job.created_at).tuples()]
+        for job_id in queued:
+            self._queue.put(job_id)
+        if queued:
+            print(f"Resuming {len(queued)} background job(s).")
+
+    def submit(self, kind, params=None, map_id=DEFAULT_MAP_ID, on_done=None):
+        """
+        Queue a job.
+
+        Args:
+            kind (str): The kind of job, a key of JOB_KINDS.
+            params (dict, optional): The JSON parameters of the job. Defaults to None.
+            map_id (int, optional): The ID of the map. Defaults to the default map.
+            on_done (function, optional): Function called with the job dictionary if the
+                job succeeds in this process. Defaults to None.
+
+        Returns:
+            dict: The job.
+
+        Raises:
+            ValueError: If the kind is unknown or its check refuses the parameters.
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind '{kind}'.")
+        if kind in JOB_CHECKS:
+            JOB_CHECKS[kind](map_id, **(params or {}))
+        self.start()
+        with database.use_shared():
+            job = Job.create(kind=kind, params=json.dumps(params or {}), map_id=map_id, created_at=time.time())
+        if on_done is not None:
+            self._on_done[job.id] = on_done
+        self._queue.put(job.id)
+        self._notify(job)
+        return job_dict(job)
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. A queued job never runs; a running job stops at its next progress report.
+
+        Args:
+            job_id (int): The ID of the job.
+
+        Returns:
+            dict: The job.
+        """
+        with database.use_shared():
+            job = Job.get_or_none(Job.id == job_id)
+            if job is None:
+                raise ValueError(f"Job with ID '{job_id}' does not exist.")
+            if job.status in ACTIVE_STATUSES:
+                Job.update(cancel_requested=1).where(Job.id == job_id).execute()
+                Job.update(status='cancelled', finished_at=time.time()).where((Job.id == job_id) & (Job.status == 'queued')).execute()
+                self._cancelled.add(job_id)
+            job = Job.get_by_id(job_id)
+        self._notify(job)
+        return job_dict(job)
+
+    def is_cancelled(self, job_id):
+        """
+        Check whether a job was cancelled in this process.
+
+        Args:
+            job_id (int): The ID of the job.
+
+        Returns:
+            bool: Whether the job was cancelled.
+        """
+        return job_id in self._cancelled
+
+    def get_job(self, job_id):
+        """
+        Get a job.
+
+        Args:
+            job_id (int): The ID of the job.
+
+        Returns:
+            dict: The job.
+        """
+        with database.use_shared():
+            job = Job.get_or_none(Job.id == job_id)
+        if job is None:
+            raise ValueError(f"Job with ID '{job_id}' does not exist.")
+        return job_dict(job)
+
+    def list_jobs(self, active=False, limit=50):
+        """
+        Get the most recent jobs.
+
+        Args:
+            active (bool, optional): Whether to only list queued and running jobs. Defaults to False.
+            limit (int, optional): The maximum number of jobs. Defaults to 50.
+
+        Returns:
+            list: The jobs, newest first.
+        """
+        with database.use_shared():
+            query = Job.select().order_by(Job.created_at.desc()).limit(limit)
+            if active:
+                query = query.where(Job.status.in_(ACTIVE_STATUSES))
+            return [job_dict(job) for job in query]
+
+    def subscribe(self, listener):
+        """
+        Call a function with the job dictionary whenever a job is submitted, progresses or finishes.
+
+        Listeners are called from the worker threads.
+
+        Args:
+            listener (function): The function.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        """
+        Stop calling a function subscribed with subscribe().
+
+        Args:
+            listener (function): The function.
+        """
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _notify(self, job):
+        details = job_dict(job)
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(details)
+            except Exception as e:
+                print(f"Error: {e}")
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._run(job_id)
+            except Exception as e:
+                print(f"Error running job {job_id}: {e}")
+
+    def _run(self, job_id):
+        now = time.time()
+        with database.use_shared():
+            # Another worker or process may have claimed or cancelled the job
+            claimed = (Job
+                       .update(status='running', started_at=now, heartbeat_at=now)
+                       .where((Job.id == job_id) & (Job.status == 'queued'))
+                       .execute())
+            if not claimed:
+                return
+            job = Job.get_by_id(job_id)
+        self._notify(job)
+
+        result = None
+        try:
+            result = JOB_KINDS[job.kind](JobContext(self, job), job.map_id, **json.loads(job.params))
+            job.status = 'done'
+        except JobCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+            print(f"Job {job.id} ({job.kind}) failed: {e}")
+        job.result = json.dumps(result) if result is not None else None
+        job.finished_at = time.time()
+        with database.use_shared():
+            job.save()
+        self._cancelled.discard(job.id)
+        on_done = self._on_done.pop(job.id, None)
+        print(f"Job {job.id} ({job.kind}) {job.status} in {job.finished_at - job.started_at:.1f} s.")
+        self._notify(job)
+        if on_done is not None and job.status == 'done':
+            on_done(job_dict(job))
+
+def _check_delete_pin_type(map_id, pin_type_name):
+    # Refused when submitted, so the API answers 400 instead of queuing a job that fails
+    if pin_type_name == DEFAULT_PIN_TYPE_NAME:
+        raise ValueError(f"PinType '{DEFAULT_PIN_TYPE_NAME}' cannot be deleted.")
+
+@job_kind('delete_pin_type', check=_check_delete_pin_type)
+def _delete_pin_type(context, map_id, pin_type_name):
+    repository.delete_pin_type_and_pins(pin_type_name, map_id=map_id, progress=context.progress)
+    return {"pin_type": pin_type_name}
+
+@job_kind('update_pin_type')
+def _update_pin_type(context, map_id, pin_type_id, new_name=None, updated_fields=None, new_color=None, new_style=None):
+    pin_type = repository.update_pin_type(pin_type_id, new_name, updated_fields, new_color, new_style, map_id=map_id, progress=context.progress)
+    return {"pin_type": pin_type.name}
+
+@job_kind('import_pins')
+def _import_pins(context, map_id, pins, on_duplicate="allow"):
+    created = []
+    for start in range(0, len(pins), CHUNK_SIZE):
+        with repository.atomic(map_id):
+            for pin in pins[start:start + CHUNK_SIZE]:
+                created.append(repository.add_pin(pin['pin_type'], pin['latitude'], pin['longitude'], pin.get('fields', {}),
+                                       on_duplicate=on_duplicate, map_id=map_id).id)
+        context.progress(len(created), len(pins))
+    return {"created": created}
+
+@job_kind('deduplicate_pins')
+def _deduplicate_pins(context, map_id, distance_m=DEFAULT_DISTANCE_M, key_fields=None, pin_type=None, merge=False):
+    if repository.database is None:
+        raise ValueError(f"The '{repository.backend}' storage backend cannot deduplicate pins.")
+    from db.crud import deduplicate_pins
+    context.progress(0, 1, "Finding duplicates")
+    return deduplicate_pins(float(distance_m), key_fields, pin_type, bool(merge), map_id=map_id)
+
+@job_kind('rebuild_indexes')
+def _rebuild_indexes(context, map_id):
+    if repository.database is None:
+        return {"tables": 0}
+    with database.use_map(map_id):
+        tables = database.get_tables()
+        for done, table in enumerate(tables):
+            context.progress(done, len(tables) + 1, f"Rebuilding {table}")
+            database.execute_sql(f'REINDEX "{table}"')
+        context.progress(len(tables), len(tables) + 1, "Analyzing")
+        database.execute_sql('ANALYZE')
+    context.progress(len(tables) + 1, len(tables) + 1)
+    return {"tables": len(tables)}
+
+job_runner = JobRunner()
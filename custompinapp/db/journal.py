@@ -0,0 +1,135 @@
+"""
+Change journal for the Custom Pins application.
+
+Every mutation made through the CRUD layer is recorded in the ChangeLog table with a
+snapshot of the entity after the change. The journal is what devices exchange to sync.
+
+Functions:
+    get_state(key, default=None): Get a sync setting.
+    set_state(key, value): Set a sync setting.
+    get_device_id(): Get the ID of this database, creating it on first use.
+    pin_type_snapshot(pin_type): Build the journal payload of a pin type.
+    pin_snapshot(pin): Build the journal payload of a pin.
+    record_change(entity, entity_uid, operation, payload=None, origin=None, timestamp=None): Append a change.
+    get_data_version(): Get the sequence number of the latest change.
+"""
+import json
+import time
+from peewee import fn
+from db.db import PinType, Pin, ChangeLog, SyncState, new_uid
+
+def get_state(key, default=None):
+    """
+    Get a sync setting.
+
+    Args:
+        key (str): The name of the setting.
+        default (str, optional): The value returned if the setting does not exist. Defaults to None.
+
+    Returns:
+        str: The value of the setting.
+    """
+    state = SyncState.get_or_none(SyncState.key == key)
+    return state.value if state else default
+
+def set_state(key, value):
+    """
+    Set a sync setting.
+
+    Args:
+        key (str): The name of the setting.
+        value (str): The value of the setting.
+    """
+    SyncState.insert(key=key, value=str(value)).on_conflict_replace().execute()
+
+def get_device_id():
+    """
+    Get the ID of this database, creating it on first use.
+
+    The first time an ID is created, the existing pin types and pins are journaled so that
+    data from before the journal existed can be synced too.
+
+    Returns:
+        str: The device ID.
+    """
+    device_id = get_state('device_id')
+    if device_id is None:
+        device_id = new_uid()
+        with SyncState._meta.database.atomic():
+            set_state('device_id', device_id)
+            if not ChangeLog.select().exists():
+                for pin_type in PinType.select():
+                    record_change('pin_type', pin_type.uid, 'upsert', pin_type_snapshot(pin_type), origin=device_id)
+                for pin in Pin.select():
+                    record_change('pin', pin.uid, 'upsert', pin_snapshot(pin), origin=device_id)
+    return device_id
+
+def pin_type_snapshot(pin_type):
+    """
+    Build the journal payload of a pin type.
+
+    Args:
+        pin_type (PinType): The pin type.
+
+    Returns:
+        dict: The map, name, color, style and fields of the pin type.
+    """
+    return {
+        "map": {"uid": pin_type.map.uid, "name": pin_type.map.name},
+        "name": pin_type.name,
+        "color": pin_type.color,
+        "style": pin_type.style,
+        "fields": [[field.name, field.field_type, bool(field.is_required)] for field in pin_type.fields],
+    }
+
+def pin_snapshot(pin):
+    """
+    Build the journal payload of a pin.
+
+    Args:
+        pin (Pin): The pin.
+
+    Returns:
+        dict: The pin type uid, coordinates and field values of the pin.
+    """
+    return {
+        "pin_type": pin.pin_type.uid,
+        "latitude": pin.latitude,
+        "longitude": pin.longitude,
+        "fields": {field_value.field.name: field_value.value for field_value in pin.field_values},
+    }
+
+def record_change(entity, entity_uid, operation, payload=None, origin=None, timestamp=None):
+    """
+    Append a change to the journal.
+
+    Args:
+        entity (str): The kind of entity changed ('pin_type' or 'pin').
+        entity_uid (str): The uid of the entity changed.
+        operation (str): The operation ('upsert' or 'delete').
+        payload (dict, optional): The snapshot of the entity after the change. Defaults to None.
+        origin (str, optional): The device where the change was made. Defaults to this device.
+        timestamp (float, optional): The time of the change. Defaults to now.
+
+    Returns:
+        ChangeLog: The created journal entry.
+    """
+    return ChangeLog.create(
+        entity=entity,
+        entity_uid=entity_uid,
+        operation=operation,
+        payload=json.dumps(payload or {}),
+        origin=origin or get_device_id(),
+        timestamp=timestamp if timestamp is not None else time.time(),
+    )
+
+def get_data_version():
+    """
+    Get the sequence number of the latest change.
+
+    The number grows with every mutation, so it works as a version of the whole dataset.
+
+    Returns:
+        int: The sequence number, or 0 if nothing was changed yet.
+    """
+    return ChangeLog.select(fn.MAX(ChangeLog.seq)).scalar() or 0
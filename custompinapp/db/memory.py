@@ -0,0 +1,591 @@
+"""
+In-memory storage backend for the Custom Pins application.
+
+MemoryRepository implements db.repository.PinRepository with plain Python structures and
+no SQL, so nothing is read from or written to disk:
+
+- pin types and pins are kept in dictionaries by ID, with the pins of each pin type in a
+  set and the pin IDs by uid;
+- the latitudes of the pins are kept sorted in an array, next to an array of their IDs,
+  so bounding box queries and the duplicate check bisect instead of scanning;
+- the values of each date field are kept sorted as (value, pin ID) pairs, with the number
+  of pins per day, like the index and the counts the SQLite backend keeps.
+
+Listings return the same db.records.PinRecord objects as db.crud, built from the current
+rows, so later changes do not alter the records already returned. Every operation holds
+one lock, so sessions on several threads can share a repository.
+
+Transactions hold that lock, so the operations in one are not interleaved with other
+threads', but they cannot be rolled back. The data version is a counter of the changes of
+each map.
+
+The repository has no change journal and lives in one process: it is meant for tests,
+benchmarks and demo maps, as the reference behavior of the interface, and as a cache tier
+filled with db.repository.copy_map.
+
+Classes:
+    MemoryRepository: A repository kept in memory.
+"""
+import bisect
+import contextlib
+import math
+import threading
+import time
+import uuid
+from array import array
+from db.records import PinRecord, PinTypeInfo
+from db.defaults import CHUNK_SIZE, DEFAULT_PIN_TYPE_NAME
+from db.repository import PinRepository, DuplicatePinError, DEFAULT_MAP_ID, DEFAULT_DISTANCE_M
+METERS_PER_DEGREE = 111320.0
+
+def _new_uid():
+    return uuid.uuid4().hex
+
+def _is_iso_date(value):
+    # Like the check of the SQLite triggers: empty or malformed values belong to no day
+    return len(value) >= 10 and value[4] == value[7] == '-' and (value[:4] + value[5:7] + value[8:10]).isdigit()
+
+def _distance_m(lat1, lng1, lat2, lng2):
+    # The approximation db.dedup uses
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * METERS_PER_DEGREE * 180 / math.pi
+
+class _MapRow:
+    __slots__ = ('id', 'uid', 'name', 'file_name')
+
+    def __init__(self, id, uid, name):
+        self.id = id
+        self.uid = uid
+        self.name = name
+        self.file_name = None
+
+class _FieldRow:
+    __slots__ = ('id', 'name', 'field_type', 'is_required')
+
+    def __init__(self, id, name, field_type, is_required):
+        self.id = id
+        self.name = name
+        self.field_type = field_type
+        self.is_required = int(bool(is_required))
+
+class _PinTypeRow:
+    __slots__ = ('id', 'uid', 'map_id', 'name', 'color', 'style', 'fields', 'info')
+
+    def __init__(self, id, uid, map_id, name, color, style):
+        self.id = id
+        self.uid = uid
+        self.map_id = map_id
+        self.name = name
+        self.color = color
+        self.style = style
+        self.fields = []
+        self.info = None
+
+    def field(self, name):
+        return next((field for field in self.fields if field.name == name), None)
+
+    def refresh_info(self):
+        # Records share the info, so a change gets a new one instead of editing it
+        self.info = PinTypeInfo(self.id, self.name, self.color, self.style,
+                                tuple(field.id for field in self.fields),
+                                tuple(field.name for field in self.fields))
+
+class _PinRow:
+    __slots__ = ('id', 'uid', 'map_id', 'pin_type', 'latitude', 'longitude', 'values')
+
+    def __init__(self, id, uid, map_id, pin_type, latitude, longitude):
+        self.id = id
+        self.uid = uid
+        self.map_id = map_id
+        self.pin_type = pin_type
+        self.latitude = latitude
+        self.longitude = longitude
+        self.values = {}  # value by field ID
+
+class _MapStore:
+    # The rows and indexes of one map
+    def __init__(self, map_row):
+        self.map = map_row
+        self.pin_types = {}
+        self.pin_type_ids = {}  # by name
+        self.pins = {}
+        self.pin_ids = {}  # by uid
+        self.pins_by_type = {}
+        self.latitudes = array('d')
+        self.latitude_ids = array('q')
+        self.dates = {}  # sorted (value, pin ID) pairs by field ID
+        self.day_counts = {}  # pin count by day, by field ID
+        self.bounds = {}  # cached (south, west, north, east) by pin type ID
+        self.last_modified = {}
+        self.version = 0  # incremented by every change, like the journal's data version
+
+    def index_pin(self, pin):
+        position = bisect.bisect_right(self.latitudes, pin.latitude)
+        self.latitudes.insert(position, pin.latitude)
+        self.latitude_ids.insert(position, pin.id)
+
+    def unindex_pin(self, pin):
+        position = bisect.bisect_left(self.latitudes, pin.latitude)
+        while self.latitude_ids[position] != pin.id:
+            position += 1
+        del self.latitudes[position]
+        del self.latitude_ids[position]
+
+    def ids_in_latitudes(self, south, north):
+        start = bisect.bisect_left(self.latitudes, south)
+        end = bisect.bisect_right(self.latitudes, north)
+        return self.latitude_ids[start:end]
+
+    def index_date(self, field_id, value, pin_id):
+        bisect.insort(self.dates.setdefault(field_id, []), (value, pin_id))
+        if not _is_iso_date(value):
+            return
+        counts = self.day_counts.setdefault(field_id, {})
+        counts[value[:10]] = counts.get(value[:10], 0) + 1
+
+    def unindex_date(self, field_id, value, pin_id):
+        values = self.dates[field_id]
+        del values[bisect.bisect_left(values, (value, pin_id))]
+        if not _is_iso_date(value):
+            return
+        counts = self.day_counts[field_id]
+        counts[value[:10]] -= 1
+        if counts[value[:10]] <= 0:
+            del counts[value[:10]]
+
+    def set_value(self, pin, field, value):
+        old = pin.values.get(field.id)
+        if field.field_type == 'date' and old is not None:
+            self.unindex_date(field.id, old, pin.id)
+        pin.values[field.id] = value
+        if field.field_type == 'date':
+            self.index_date(field.id, value, pin.id)
+
+    def touch(self, pin_type_id, moved=False):
+        self.version += 1
+        self.last_modified[pin_type_id] = time.time()
+        if moved:
+            self.bounds.pop(pin_type_id, None)
+
+    def record(self, pin, with_uid=False, with_fields=True):
+        info = pin.pin_type.info
+        values = tuple(pin.values.get(field_id) for field_id in info.field_ids) if with_fields else ()
+        return PinRecord(pin.id, pin.uid if with_uid else None, info, pin.latitude, pin.longitude, values)
+
+class MemoryRepository(PinRepository):
+    """
+    A repository kept in memory.
+
+    It starts with the default map and its default pin type. Maps created with
+    separate_file=True are kept like the others.
+    """
+    backend = 'memory'
+
+    def __init__(self):
+        """
+        Initialize an empty MemoryRepository instance.
+        """
+        self._lock = threading.RLock()
+        self._maps = {}
+        self._next_ids = {'map': 1, 'pin_type': 1, 'field': 1, 'pin': 1}
+        self._create_map("Default", DEFAULT_MAP_ID, "default")
+
+    def _next_id(self, kind):
+        next_id = self._next_ids[kind]
+        self._next_ids[kind] = next_id + 1
+        return next_id
+
+    def _store(self, map_id):
+        store = self._maps.get(map_id)
+        if store is None:
+            raise ValueError(f"Map with ID '{map_id}' does not exist.")
+        return store
+
+    def _create_map(self, name, map_id, uid):
+        map_row = _MapRow(map_id, uid, name)
+        self._next_ids['map'] = max(self._next_ids['map'], map_id + 1)
+        store = self._maps[map_id] = _MapStore(map_row)
+        pin_type_uid = "default" if map_id == DEFAULT_MAP_ID else f"{uid}-default"
+        self._create_pin_type(store, DEFAULT_PIN_TYPE_NAME, [("Name", "string", 1), ("Date", "date", 1)], "36aedc", "add_location", pin_type_uid)
+        return map_row
+
+    def _create_pin_type(self, store, name, fields, color, style, uid=None):
+        pin_type = _PinTypeRow(self._next_id('pin_type'), uid or _new_uid(), store.map.id, name, color or "36aedc", style)
+        for field_name, field_type, is_required in fields:
+            pin_type.fields.append(_FieldRow(self._next_id('field'), field_name, field_type, is_required))
+        pin_type.refresh_info()
+        store.pin_types[pin_type.id] = pin_type
+        store.pin_type_ids[name] = pin_type.id
+        store.pins_by_type[pin_type.id] = set()
+        store.version += 1
+        return pin_type
+
+    def _pin_type_named(self, store, name, message="PinType '{}' does not exist."):
+        pin_type_id = store.pin_type_ids.get(name)
+        if pin_type_id is None:
+            raise ValueError(message.format(name))
+        return store.pin_types[pin_type_id]
+
+    def _pin(self, store, pin_id):
+        pin = store.pins.get(pin_id)
+        if pin is None:
+            raise ValueError(f"Pin with ID '{pin_id}' does not exist.")
+        return pin
+
+    def _remove_pin(self, store, pin):
+        for field in pin.pin_type.fields:
+            if field.field_type == 'date' and field.id in pin.values:
+                store.unindex_date(field.id, pin.values[field.id], pin.id)
+        store.unindex_pin(pin)
+        del store.pins[pin.id]
+        del store.pin_ids[pin.uid]
+        store.pins_by_type[pin.pin_type.id].discard(pin.id)
+        store.touch(pin.pin_type.id, moved=True)
+
+    def create_map(self, name, separate_file=False):
+        with self._lock:
+            if any(store.map.name == name for store in self._maps.values()):
+                raise ValueError(f"Map '{name}' already exists.")
+            return self._create_map(name, self._next_ids['map'], _new_uid())
+
+    def get_all_maps(self):
+        with self._lock:
+            return [
+                {'id': store.map.id, 'uid': store.map.uid, 'name': store.map.name, 'separate_file': False}
+                for store in sorted(self._maps.values(), key=lambda store: store.map.id)
+            ]
+
+    def delete_map(self, map_id):
+        if map_id == DEFAULT_MAP_ID:
+            raise ValueError("The default map cannot be deleted.")
+        with self._lock:
+            store = self._store(map_id)
+            del self._maps[map_id]
+        print(f"Map {store.map.name} deleted successfully.")
+
+    def create_pin_type(self, name, fields, color=None, style="add_location", map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            if name in store.pin_type_ids:
+                raise ValueError(f"PinType '{name}' already exists.")
+            return self._create_pin_type(store, name, fields, color, style)
+
+    def get_all_pin_types(self, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            return [
+                {'id': pin_type.id, 'name': pin_type.name, 'color': pin_type.color, 'style': pin_type.style}
+                for pin_type in self._store(map_id).pin_types.values()
+            ]
+
+    def get_pin_type_by_name(self, name, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            pin_type = self._pin_type_named(self._store(map_id), name)
+            return {
+                "name": pin_type.name,
+                "color": pin_type.color,
+                "style": pin_type.style,
+                "fields": [
+                    {"name": field.name, "field_type": field.field_type, "is_required": bool(field.is_required)}
+                    for field in pin_type.fields
+                ],
+            }
+
+    def get_pin_type_stats(self, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            result = []
+            for pin_type in store.pin_types.values():
+                pin_ids = store.pins_by_type[pin_type.id]
+                bounds = store.bounds.get(pin_type.id)
+                if bounds is None and pin_ids:
+                    pins = [store.pins[pin_id] for pin_id in pin_ids]
+                    bounds = store.bounds[pin_type.id] = (
+                        min(pin.latitude for pin in pins), min(pin.longitude for pin in pins),
+                        max(pin.latitude for pin in pins), max(pin.longitude for pin in pins),
+                    )
+                result.append({
+                    'id': pin_type.id,
+                    'name': pin_type.name,
+                    'color': pin_type.color,
+                    'style': pin_type.style,
+                    'pin_count': len(pin_ids),
+                    'bounds': bounds if pin_ids else None,
+                    'last_modified': store.last_modified.get(pin_type.id),
+                })
+            return result
+
+    def _find_duplicate(self, store, pin_type, latitude, longitude, field_values, distance_m, key_fields):
+        lat_span = distance_m / METERS_PER_DEGREE
+        lng_span = lat_span / max(math.cos(math.radians(latitude)), 1e-6)
+        candidates = []
+        for pin_id in store.ids_in_latitudes(latitude - lat_span, latitude + lat_span):
+            pin = store.pins[pin_id]
+            if pin.pin_type is not pin_type or abs(pin.longitude - longitude) > lng_span:
+                continue
+            if _distance_m(latitude, longitude, pin.latitude, pin.longitude) > distance_m:
+                continue
+            if key_fields:
+                values = {field.name: pin.values.get(field.id) for field in pin_type.fields}
+                if any(values.get(name) != field_values.get(name) for name in key_fields):
+                    continue
+            candidates.append(pin)
+        return min(candidates, key=lambda pin: _distance_m(latitude, longitude, pin.latitude, pin.longitude), default=None)
+
+    def add_pin(self, pin_type_name, latitude, longitude, field_values, on_duplicate="allow",
+                duplicate_distance_m=DEFAULT_DISTANCE_M, key_fields=None, map_id=DEFAULT_MAP_ID):
+        if on_duplicate not in ("allow", "merge", "reject"):
+            raise ValueError(f"Unknown on_duplicate '{on_duplicate}'.")
+        with self._lock:
+            store = self._store(map_id)
+            pin_type = self._pin_type_named(store, pin_type_name)
+            fields = {}
+            for field_name in field_values:
+                fields[field_name] = pin_type.field(field_name)
+                if fields[field_name] is None:
+                    raise ValueError(f"Field '{field_name}' does not exist for PinType '{pin_type_name}'.")
+
+            if on_duplicate != "allow":
+                duplicate = self._find_duplicate(store, pin_type, latitude, longitude, field_values,
+                                                 duplicate_distance_m, key_fields)
+                if duplicate is not None:
+                    if on_duplicate == "reject":
+                        raise DuplicatePinError(duplicate)
+                    changed = False
+                    for field_name, value in field_values.items():
+                        field = fields[field_name]
+                        if value in (None, "") or duplicate.values.get(field.id) not in (None, ""):
+                            continue
+                        store.set_value(duplicate, field, value)
+                        changed = True
+                    if changed:
+                        store.touch(pin_type.id)
+                    return duplicate
+
+            pin = _PinRow(self._next_id('pin'), _new_uid(), map_id, pin_type, latitude, longitude)
+            store.pins[pin.id] = pin
+            store.pin_ids[pin.uid] = pin.id
+            store.pins_by_type[pin_type.id].add(pin.id)
+            store.index_pin(pin)
+            for field_name, value in field_values.items():
+                store.set_value(pin, fields[field_name], value)
+            store.touch(pin_type.id, moved=True)
+            return pin
+
+    def get_pin_by_id(self, pin_id, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            pin = self._store(map_id).pins.get(pin_id)
+            if pin is None:
+                raise ValueError(f"Pin with id '{pin_id}' does not exist.")
+            return {
+                "id": pin.id,
+                "latitude": pin.latitude,
+                "longitude": pin.longitude,
+                "pin_type": pin.pin_type.name,
+                "color": pin.pin_type.color,
+                "style": pin.pin_type.style,
+                "fields": {
+                    field.name: {"value": pin.values[field.id], "type": field.field_type}
+                    for field in pin.pin_type.fields if field.id in pin.values
+                },
+            }
+
+    def get_pins(self, pin_type_name, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            pin_type = self._pin_type_named(store, pin_type_name)
+            return [store.record(store.pins[pin_id]) for pin_id in sorted(store.pins_by_type[pin_type.id])]
+
+    def get_all_pins(self, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            return [store.record(pin) for pin in store.pins.values()]
+
+    def get_pins_in_bounds(self, south, west, north, east, map_id=DEFAULT_MAP_ID):
+        return list(self.iter_pins(bounds=(south, west, north, east), map_id=map_id))
+
+    def iter_pins(self, bounds=None, pin_type_name=None, uids=None, with_fields=True, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            if uids is not None:
+                pins = [store.pins[store.pin_ids[uid]] for uid in set(uids) if uid in store.pin_ids]
+            elif bounds is not None:
+                pins = [store.pins[pin_id] for pin_id in store.ids_in_latitudes(bounds[0], bounds[2])]
+            else:
+                pins = list(store.pins.values())
+            if bounds is not None:
+                south, west, north, east = bounds
+                pins = [pin for pin in pins if south <= pin.latitude <= north and west <= pin.longitude <= east]
+            if pin_type_name is not None:
+                pins = [pin for pin in pins if pin.pin_type.name == pin_type_name]
+            pins.sort(key=lambda pin: pin.id)
+            records = [store.record(pin, with_uid=True, with_fields=with_fields) for pin in pins]
+        yield from records
+
+    def _date_field_ids(self, store, field_name):
+        return [
+            field.id
+            for pin_type in store.pin_types.values() for field in pin_type.fields
+            if field.field_type == 'date' and (field_name is None or field.name == field_name)
+        ]
+
+    def get_date_field_names(self, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            return sorted({
+                field.name
+                for pin_type in store.pin_types.values() for field in pin_type.fields
+                if field.field_type == 'date'
+            })
+
+    def get_date_counts(self, field_name=None, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            totals = {}
+            for field_id in self._date_field_ids(store, field_name):
+                for day, count in store.day_counts.get(field_id, {}).items():
+                    totals[day] = totals.get(day, 0) + count
+            return sorted(totals.items())
+
+    def get_pin_ids_by_date(self, start, end, field_name=None, pin_ids=None, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            if start >= end:
+                return []
+            wanted = set(pin_ids) if pin_ids is not None else None
+            result = []
+            for field_id in self._date_field_ids(store, field_name):
+                values = store.dates.get(field_id, [])
+                first = bisect.bisect_left(values, (start,))
+                last = bisect.bisect_left(values, (end,))
+                result.extend(pin_id for _, pin_id in values[first:last] if wanted is None or pin_id in wanted)
+            return result
+
+    def update_pin(self, pin_id, updated_field_values, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            pin = self._pin(store, pin_id)
+            fields = {}
+            for field_name in updated_field_values:
+                fields[field_name] = pin.pin_type.field(field_name)
+                if fields[field_name] is None:
+                    raise ValueError(f"Field '{field_name}' does not exist for PinType ID '{pin.pin_type.id}'.")
+            for field_name, new_value in updated_field_values.items():
+                store.set_value(pin, fields[field_name], new_value)
+            store.touch(pin.pin_type.id)
+            return pin
+
+    def update_pins(self, updates, map_id=DEFAULT_MAP_ID):
+        errors = {}
+        with self._lock:
+            for pin_id, updated_field_values in updates.items():
+                try:
+                    self.update_pin(pin_id, updated_field_values, map_id=map_id)
+                except Exception as e:
+                    errors[pin_id] = e
+        return errors
+
+    def delete_pin(self, pin_id, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            store = self._store(map_id)
+            self._remove_pin(store, self._pin(store, pin_id))
+        print(f"Pin {pin_id} deleted successfully.")
+
+    def update_pin_type(self, pin_type_id, new_name=None, updated_fields=None, new_color=None, new_style=None,
+                        map_id=DEFAULT_MAP_ID, progress=None):
+        with self._lock:
+            store = self._store(map_id)
+            pin_type = store.pin_types.get(pin_type_id)
+            if pin_type is None:
+                raise ValueError(f"PinType with ID '{pin_type_id}' does not exist.")
+            pins = [store.pins[pin_id] for pin_id in store.pins_by_type[pin_type.id]]
+
+            if updated_fields is not None:
+                kept_field_ids = {field_data.get('id') for field_data in updated_fields}
+                removed = [field for field in pin_type.fields if field.id not in kept_field_ids]
+                for field in removed:
+                    for pin in pins:
+                        value = pin.values.pop(field.id, None)
+                        if value is not None and field.field_type == 'date':
+                            store.unindex_date(field.id, value, pin.id)
+                    store.dates.pop(field.id, None)
+                    store.day_counts.pop(field.id, None)
+                if removed and progress is not None:
+                    progress(len(pins), len(pins))
+
+            if new_name:
+                del store.pin_type_ids[pin_type.name]
+                pin_type.name = new_name
+                store.pin_type_ids[new_name] = pin_type.id
+            if new_color:
+                pin_type.color = new_color
+            if new_style:
+                pin_type.style = new_style
+
+            if updated_fields is not None:
+                existing_fields = {field.id: field for field in pin_type.fields}
+                fields = []
+                for field_data in updated_fields:
+                    field = existing_fields.get(field_data.get('id')) if field_data.get('id') else None
+                    if field is None:
+                        fields.append(_FieldRow(self._next_id('field'), field_data['name'], field_data['field_type'],
+                                                field_data['is_required']))
+                        continue
+                    was_date = field.field_type == 'date'
+                    field.name = field_data['name']
+                    field.field_type = field_data['field_type']
+                    field.is_required = int(bool(field_data['is_required']))
+                    if was_date != (field.field_type == 'date'):
+                        # A field that becomes, or stops being, a date field is indexed again
+                        store.dates.pop(field.id, None)
+                        store.day_counts.pop(field.id, None)
+                        if field.field_type == 'date':
+                            for pin in pins:
+                                if field.id in pin.values:
+                                    store.index_date(field.id, pin.values[field.id], pin.id)
+                    fields.append(field)
+                pin_type.fields = fields
+            pin_type.refresh_info()
+            store.version += 1
+            return pin_type
+
+    def delete_pin_type_and_pins(self, pin_type_name, map_id=DEFAULT_MAP_ID, progress=None):
+        if pin_type_name == DEFAULT_PIN_TYPE_NAME:
+            raise ValueError(f"PinType '{DEFAULT_PIN_TYPE_NAME}' cannot be deleted.")
+        with self._lock:
+            store = self._store(map_id)
+            pin_type = self._pin_type_named(store, pin_type_name, "PinType with ID '{}' does not exist.")
+            pin_ids = sorted(store.pins_by_type[pin_type.id])
+        for start in range(0, len(pin_ids), CHUNK_SIZE):
+            # Other threads can work in between, as with the SQLite backend's short transactions
+            with self._lock:
+                for pin_id in pin_ids[start:start + CHUNK_SIZE]:
+                    pin = store.pins.get(pin_id)
+                    if pin is not None:
+                        self._remove_pin(store, pin)
+            if progress is not None:
+                progress(min(start + CHUNK_SIZE, len(pin_ids)), len(pin_ids))
+        with self._lock:
+            # Also deletes any pin added since the pins were listed
+            for pin_id in list(store.pins_by_type[pin_type.id]):
+                self._remove_pin(store, store.pins[pin_id])
+            for field in pin_type.fields:
+                store.dates.pop(field.id, None)
+                store.day_counts.pop(field.id, None)
+            del store.pin_types[pin_type.id]
+            del store.pin_type_ids[pin_type.name]
+            del store.pins_by_type[pin_type.id]
+            store.bounds.pop(pin_type.id, None)
+            store.last_modified.pop(pin_type.id, None)
+            store.version += 1
+        print(f"PinType {pin_type_name} and all associated pins deleted successfully.")
+
+    @contextlib.contextmanager
+    def atomic(self, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            self._store(map_id)
+            yield
+
+    def get_data_version(self, map_id=DEFAULT_MAP_ID):
+        with self._lock:
+            return self._store(map_id).version
@@ -0,0 +1,373 @@
+"""
+Versioned schema migrations for the Custom Pins application.
+
+create_tables only creates what is missing, so it can never change a table or add an index
+to a database that already exists. Schema changes are instead written as numbered
+migrations, applied in order and recorded in the schemaversion table, so every database
+is brought to the current schema in place the next time it is opened.
+
+Migrations work on the tables as they are on disk with plain SQL, never through the
+models, which describe the schema after the last migration. A new database is created from
+the models and then runs every migration too, so migrations must leave a schema that
+already has their change as it is.
+
+Functions:
+    migration(version, name): Register a function as a migration.
+    get_schema_version(database): Get the version of the last migration applied.
+    pending_migrations(database): Get the migrations not applied yet.
+    migrate(database, dry_run=False): Apply the pending migrations.
+    print_report(report): Print the timings of a migration run.
+
+Run with:
+    python db/migrations.py [--dry-run] [database path]
+"""
+import argparse
+import os
+import time
+import uuid
+
+MIGRATIONS = []
+
+def migration(version, name):
+    """
+    Register a function as a migration.
+
+    Args:
+        version (int): The version the schema is at once the migration is applied.
+        name (str): A short description of the migration.
+
+    Returns:
+        function: The decorator, which takes a function receiving the database.
+    """
+    def register(function):
+        MIGRATIONS.append((version, name, function))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return function
+    return register
+
+def _columns(database, table):
+    return [column.name for column in database.get_columns(table)]
+
+def _ensure_version_table(database):
+    database.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "schemaversion" ('
+        '"version" INTEGER NOT NULL PRIMARY KEY, '
+        '"name" VARCHAR(255) NOT NULL, '
+        '"applied_at" REAL NOT NULL, '
+        '"duration_ms" REAL NOT NULL)'
+    )
+
+def get_schema_version(database):
+    """
+    Get the version of the last migration applied.
+
+    Args:
+        database (peewee.Database): The database.
+
+    Returns:
+        int: The version, or 0 if no migration was applied.
+    """
+    if not database.table_exists('schemaversion'):
+        return 0
+    return database.execute_sql('SELECT MAX("version") FROM "schemaversion"').fetchone()[0] or 0
+
+def pending_migrations(database):
+    """
+    Get the migrations not applied yet.
+
+    Args:
+        database (peewee.Database): The database.
+
+    Returns:
+        list: The (version, name, function) of each pending migration, in order.
+    """
+    current = get_schema_version(database)
+    return [entry for entry in MIGRATIONS if entry[0] > current]
+
+def migrate(database, dry_run=False):
+    """
+    Apply the pending migrations.
+
+    Each migration runs in its own transaction together with its schemaversion row, so a
+    failing migration leaves the database at the previous version. A dry run applies all
+    of them in a single transaction and rolls it back, which shows what would run and how
+    long it takes without changing anything.
+
+    Args:
+        database (peewee.Database): The database.
+        dry_run (bool, optional): Whether to roll the migrations back. Defaults to False.
+
+    Returns:
+        list: The version, name and 'duration_ms' of each migration run.
+    """
+    report = []
+    with database.atomic() as transaction:
+        _ensure_version_table(database)
+        for version, name, function in pending_migrations(database):
+            started = time.perf_counter()
+            with database.atomic():
+                function(database)
+                duration_ms = (time.perf_counter() - started) * 1000
+                database.execute_sql(
+                    'INSERT INTO "schemaversion" ("version", "name", "applied_at", "duration_ms") VALUES (?, ?, ?, ?)',
+                    (version, name, time.time(), duration_ms)
+                )
+            report.append({"version": version, "name": name, "duration_ms": duration_ms})
+            if not dry_run:
+                print(f"Applied migration {version} ({name}) in {duration_ms:.1f} ms.")
+        if dry_run:
+            transaction.rollback()
+    return report
+
+def print_report(report):
+    """
+    Print the timings of a migration run.
+
+    Args:
+        report (list): The report returned by migrate.
+    """
+    if not report:
+        print("No pending migrations.")
+        return
+    for entry in report:
+        print(f"{entry['version']:>4}  {entry['name']:<48} {entry['duration_ms']:>9.1f} ms")
+    print(f"Total: {sum(entry['duration_ms'] for entry in report):.1f} ms")
+
+
+@migration(1, "add uid to pin types and pins")
+def add_uids(database):
+    # The default pin type exists on every device, so it gets the same fixed uid everywhere
+    for table in ("pintype", "pin"):
+        if not database.table_exists(table) or 'uid' in _columns(database, table):
+            continue
+        database.execute_sql(f'ALTER TABLE "{table}" ADD COLUMN "uid" VARCHAR(255)')
+        names = _columns(database, table)
+        for row in database.execute_sql(f'SELECT * FROM "{table}"').fetchall():
+            row = dict(zip(names, row))
+            uid = "default" if table == "pintype" and row['name'] == "Default" else uuid.uuid4().hex
+            database.execute_sql(f'UPDATE "{table}" SET "uid" = ? WHERE "id" = ?', (uid, row['id']))
+        database.execute_sql(f'CREATE UNIQUE INDEX IF NOT EXISTS "{table}_uid" ON "{table}" ("uid")')
+
+@migration(2, "move pin types and pins to the default map")
+def add_map_ids(database):
+    if database.table_exists("pin") and 'map_id' not in _columns(database, "pin"):
+        database.execute_sql('ALTER TABLE "pin" ADD COLUMN "map_id" INTEGER NOT NULL DEFAULT 1')
+
+    if not database.table_exists("pintype") or 'map_id' in _columns(database, "pintype"):
+        return
+    # Names used to be unique across the database through an inline constraint, which
+    # SQLite cannot drop, so the table is copied into one where they are unique per map
+    database.execute_sql(
+        'CREATE TABLE "pintype_new" ('
+        '"id" INTEGER NOT NULL PRIMARY KEY, '
+        '"uid" VARCHAR(255) NOT NULL, '
+        '"map_id" INTEGER NOT NULL DEFAULT 1 REFERENCES "map" ("id") ON DELETE CASCADE, '
+        '"name" VARCHAR(255) NOT NULL, '
+        '"color" VARCHAR(255) NOT NULL, '
+        '"style" VARCHAR(255) NOT NULL)'
+    )
+    database.execute_sql(
+        'INSERT INTO "pintype_new" ("id", "uid", "map_id", "name", "color", "style") '
+        'SELECT "id", "uid", 1, "name", "color", "style" FROM "pintype"'
+    )
+    database.execute_sql('DROP TABLE "pintype"')
+    database.execute_sql('ALTER TABLE "pintype_new" RENAME TO "pintype"')
+    database.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "pintype_uid" ON "pintype" ("uid")')
+
+@migration(3, "add indexes for pin and field value lookups")
+def add_lookup_indexes(database):
+    # Names match the ones peewee gives the model indexes, so new and migrated databases agree
+    indexes = [
+        ("pintype", "pintype_map_id_name", '("map_id", "name")', True),
+        ("pin", "pin_map_id_pin_type_id", '("map_id", "pin_type_id")', False),
+        ("pin", "pin_map_id_latitude_longitude", '("map_id", "latitude", "longitude")', False),
+        ("field", "field_pin_type_id_name", '("pin_type_id", "name")', False),
+        ("fieldvalue", "fieldvalue_pin_id_field_id", '("pin_id", "field_id")', False),
+        ("fieldvalue", "fieldvalue_field_id", '("field_id")', False),
+    ]
+    for table, name, columns, unique in indexes:
+        if database.table_exists(table):
+            database.execute_sql(f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS "{name}" ON "{table}" {columns}')
+
+@migration(4, "analyze tables for the query planner")
+def analyze(database):
+    database.execute_sql('ANALYZE')
+
+
+# The current time in seconds since the epoch, as SQLite computes it
+_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+def _count_pin(sign, row):
+    # Adds (sign "+") or removes (sign "-") one pin to the statistics of its pin type
+    if sign == "+":
+        return (
+            'INSERT INTO "pintypestats" ("pin_type_id", "pin_count", "min_latitude", "max_latitude", '
+            '"min_longitude", "max_longitude", "last_modified") '
+            f'VALUES ({row}."pin_type_id", 1, {row}."latitude", {row}."latitude", {row}."longitude", {row}."longitude", {_NOW}) '
+            'ON CONFLICT ("pin_type_id") DO UPDATE SET '
+            '"pin_count" = "pin_count" + 1, '
+            '"min_latitude" = MIN(COALESCE("min_latitude", excluded."min_latitude"), excluded."min_latitude"), '
+            '"max_latitude" = MAX(COALESCE("max_latitude", excluded."max_latitude"), excluded."max_latitude"), '
+            '"min_longitude" = MIN(COALESCE("min_longitude", excluded."min_longitude"), excluded."min_longitude"), '
+            '"max_longitude" = MAX(COALESCE("max_longitude", excluded."max_longitude"), excluded."max_longitude"), '
+            '"last_modified" = excluded."last_modified"; '
+        )
+    # The bounds are only scanned again when the removed pin was on them
+    return (
+        f'UPDATE "pintypestats" SET "pin_count" = "pin_count" - 1, "last_modified" = {_NOW} '
+        f'WHERE "pin_type_id" = {row}."pin_type_id"; '
+        'UPDATE "pintypestats" SET '
+        f'"min_latitude" = (SELECT MIN("latitude") FROM "pin" WHERE "pin_type_id" = {row}."pin_type_id"), '
+        f'"max_latitude" = (SELECT MAX("latitude") FROM "pin" WHERE "pin_type_id" = {row}."pin_type_id"), '
+        f'"min_longitude" = (SELECT MIN("longitude") FROM "pin" WHERE "pin_type_id" = {row}."pin_type_id"), '
+        f'"max_longitude" = (SELECT MAX("longitude") FROM "pin" WHERE "pin_type_id" = {row}."pin_type_id") '
+        f'WHERE "pin_type_id" = {row}."pin_type_id" '
+        f'AND ({row}."latitude" IN ("min_latitude", "max_latitude") OR {row}."longitude" IN ("min_longitude", "max_longitude")); '
+    )
+
+@migration(5, "maintain pin type statistics with triggers")
+def add_pin_type_stats(database):
+    database.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "pintypestats" ('
+        '"pin_type_id" INTEGER NOT NULL PRIMARY KEY REFERENCES "pintype" ("id") ON DELETE CASCADE, '
+        '"pin_count" INTEGER NOT NULL, '
+        '"min_latitude" REAL, "max_latitude" REAL, "min_longitude" REAL, "max_longitude" REAL, '
+        '"last_modified" REAL)'
+    )
+    triggers = {
+        "pin_stats_insert": f'AFTER INSERT ON "pin" BEGIN {_count_pin("+", "NEW")}END',
+        "pin_stats_delete": f'AFTER DELETE ON "pin" BEGIN {_count_pin("-", "OLD")}END',
+        "pin_stats_update": (
+            'AFTER UPDATE OF "pin_type_id", "latitude", "longitude" ON "pin" '
+            f'BEGIN {_count_pin("-", "OLD")}{_count_pin("+", "NEW")}END'
+        ),
+        "fieldvalue_stats_insert": (
+            'AFTER INSERT ON "fieldvalue" BEGIN '
+            f'UPDATE "pintypestats" SET "last_modified" = {_NOW} '
+            'WHERE "pin_type_id" = (SELECT "pin_type_id" FROM "pin" WHERE "id" = NEW."pin_id"); END'
+        ),
+        "fieldvalue_stats_update": (
+            'AFTER UPDATE ON "fieldvalue" BEGIN '
+            f'UPDATE "pintypestats" SET "last_modified" = {_NOW} '
+            'WHERE "pin_type_id" = (SELECT "pin_type_id" FROM "pin" WHERE "id" = NEW."pin_id"); END'
+        ),
+        "pintype_stats_delete": 'AFTER DELETE ON "pintype" BEGIN DELETE FROM "pintypestats" WHERE "pin_type_id" = OLD."id"; END',
+    }
+    for name, body in triggers.items():
+        database.execute_sql(f'CREATE TRIGGER IF NOT EXISTS "{name}" {body}')
+
+    database.execute_sql(
+        'INSERT OR REPLACE INTO "pintypestats" ("pin_type_id", "pin_count", "min_latitude", "max_latitude", '
+        '"min_longitude", "max_longitude", "last_modified") '
+        f'SELECT "pin_type_id", COUNT(*), MIN("latitude"), MAX("latitude"), MIN("longitude"), MAX("longitude"), {_NOW} '
+        'FROM "pin" GROUP BY "pin_type_id"'
+    )
+
+
+def _count_date(sign, row):
+    # Adds (sign "+") or removes (sign "-") one date value to the count of its day
+    day = f'substr({row}."value", 1, 10)'
+    if sign == "+":
+        return (
+            'INSERT INTO "datecount" ("field_id", "day", "pin_count") '
+            f'VALUES ({row}."field_id", {day}, 1) '
+            'ON CONFLICT ("field_id", "day") DO UPDATE SET "pin_count" = "pin_count" + 1; '
+        )
+    return (
+        'UPDATE "datecount" SET "pin_count" = "pin_count" - 1 '
+        f'WHERE "field_id" = {row}."field_id" AND "day" = {day}; '
+        f'DELETE FROM "datecount" WHERE "field_id" = {row}."field_id" AND "day" = {day} AND "pin_count" <= 0; '
+    )
+
+def _is_date_field(row):
+    return f'(SELECT "field_type" FROM "field" WHERE "id" = {row}."field_id") = \'date\''
+
+def _is_iso_date(row):
+    # Empty or malformed values of a date field belong to no day
+    return f'{row}."value" GLOB \'[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*\''
+
+_DATE_COUNT_TRIGGERS = ("fieldvalue_date_insert", "fieldvalue_date_delete", "fieldvalue_date_update_old",
+                        "fieldvalue_date_update_new", "field_date_type_update", "field_date_delete")
+
+def _count_dates(database):
+    # Creates the triggers that keep the per-day counts and counts the existing values
+    iso_value = _is_iso_date('"fieldvalue"')
+    triggers = {
+        "fieldvalue_date_insert": (
+            f'AFTER INSERT ON "fieldvalue" WHEN {_is_date_field("NEW")} AND {_is_iso_date("NEW")} '
+            f'BEGIN {_count_date("+", "NEW")}END'
+        ),
+        "fieldvalue_date_delete": (
+            f'AFTER DELETE ON "fieldvalue" WHEN {_is_date_field("OLD")} AND {_is_iso_date("OLD")} '
+            f'BEGIN {_count_date("-", "OLD")}END'
+        ),
+        "fieldvalue_date_update_old": (
+            f'AFTER UPDATE OF "field_id", "value" ON "fieldvalue" WHEN {_is_date_field("OLD")} AND {_is_iso_date("OLD")} '
+            f'BEGIN {_count_date("-", "OLD")}END'
+        ),
+        "fieldvalue_date_update_new": (
+            f'AFTER UPDATE OF "field_id", "value" ON "fieldvalue" WHEN {_is_date_field("NEW")} AND {_is_iso_date("NEW")} '
+            f'BEGIN {_count_date("+", "NEW")}END'
+        ),
+        # A field that becomes, or stops being, a date field is counted again from scratch
+        "field_date_type_update": (
+            'AFTER UPDATE OF "field_type" ON "field" WHEN OLD."field_type" != NEW."field_type" BEGIN '
+            'DELETE FROM "datecount" WHERE "field_id" = NEW."id"; '
+            'INSERT INTO "datecount" ("field_id", "day", "pin_count") '
+            'SELECT "field_id", substr("value", 1, 10), COUNT(*) FROM "fieldvalue" '
+            f'WHERE "field_id" = NEW."id" AND NEW."field_type" = \'date\' AND {iso_value} GROUP BY 2; END'
+        ),
+        "field_date_delete": 'AFTER DELETE ON "field" BEGIN DELETE FROM "datecount" WHERE "field_id" = OLD."id"; END',
+    }
+    for name, body in triggers.items():
+        database.execute_sql(f'CREATE TRIGGER IF NOT EXISTS "{name}" {body}')
+
+    database.execute_sql('DELETE FROM "datecount"')
+    database.execute_sql(
+        'INSERT INTO "datecount" ("field_id", "day", "pin_count") '
+        'SELECT "fieldvalue"."field_id", substr("fieldvalue"."value", 1, 10), COUNT(*) '
+        'FROM "fieldvalue" JOIN "field" ON "field"."id" = "fieldvalue"."field_id" '
+        f'WHERE "field"."field_type" = \'date\' AND {iso_value} GROUP BY 1, 2'
+    )
+
+@migration(6, "index date values and count them per day")
+def add_date_counts(database):
+    # Dates are stored as ISO strings, which sort like the dates, so the index serves ranges
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "fieldvalue_field_id_value" ON "fieldvalue" ("field_id", "value")')
+    database.execute_sql(
+        'CREATE TABLE IF NOT EXISTS "datecount" ('
+        '"field_id" INTEGER NOT NULL REFERENCES "field" ("id") ON DELETE CASCADE, '
+        '"day" VARCHAR(255) NOT NULL, '
+        '"pin_count" INTEGER NOT NULL, '
+        'PRIMARY KEY ("field_id", "day"))'
+    )
+    _count_dates(database)
+
+@migration(7, "count only ISO dates per day")
+def count_iso_dates(database):
+    # Databases migrated to 6 before the triggers checked the values counted empty dates as a day
+    for name in _DATE_COUNT_TRIGGERS:
+        database.execute_sql(f'DROP TRIGGER IF EXISTS "{name}"')
+    _count_dates(database)
+
+@migration(8, "index pin positions per pin type")
+def add_pin_type_bound_indexes(database):
+    # Deleting a pin on its pin type's bounds reads the new bounds; without these indexes
+    # each read scans every pin of the type, so deleting a type sorted by position is quadratic
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "pin_pin_type_id_latitude" ON "pin" ("pin_type_id", "latitude")')
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "pin_pin_type_id_longitude" ON "pin" ("pin_type_id", "longitude")')
+
+
+if __name__ == "__main__":
+    from peewee import SqliteDatabase
+    default_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'map_pins.db')
+    parser = argparse.ArgumentParser(description="Apply the pending schema migrations.")
+    parser.add_argument('path', nargs='?', default=default_path)
+    parser.add_argument('--dry-run', action='store_true', help="Time the migrations and roll them back.")
+    args = parser.parse_args()
+
+    target = SqliteDatabase(args.path)
+    print(f"{args.path}: schema version {get_schema_version(target)}")
+    print_report(migrate(target, dry_run=args.dry_run))
+    if args.dry_run:
+        print("Dry run, nothing was changed.")
@@ -0,0 +1,170 @@
+"""
+Read cache of pin details for the Custom Pins application.
+
+Opening a pin reads its details with get_pin_by_id. The details of the most recently read
+pins are kept in a bounded LRU cache, so reopening a recent pin costs no database round
+trip. The CRUD functions drop the entries of the pins they change once the change is
+written; a load that races with a change is not stored. Entries also expire after a
+time to live, which bounds how long a change made outside these functions, such as
+inside a transaction that has not committed yet, can go unseen.
+
+Classes:
+    PinCache: A bounded LRU cache of pin details with a time to live.
+
+Attributes:
+    pin_details (PinCache): The cache used by db.crud.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_SIZE = 256
+TTL = 300  # seconds
+
+def _copy(details):
+    # Callers get their own copy, so changing it cannot change the cache
+    copied = dict(details)
+    copied["fields"] = {name: dict(field) for name, field in details["fields"].items()}
+    return copied
+
+class PinCache:
+    """
+    A bounded LRU cache of pin details with a time to live.
+
+    Entries are keyed by map ID and pin ID.
+
+    Attributes:
+        size (int): The maximum number of cached pins.
+        ttl (float): The number of seconds an entry stays valid, or None to keep it until evicted.
+        hits (int): The number of reads served from the cache.
+        misses (int): The number of reads that went to the database.
+        evictions (int): The number of entries dropped to make room.
+        expirations (int): The number of entries dropped because they were too old.
+        invalidations (int): The number of entries dropped because their pin changed.
+    """
+    def __init__(self, size=CACHE_SIZE, ttl=TTL):
+        """
+        Initialize a PinCache instance.
+
+        Args:
+            size (int, optional): The maximum number of cached pins. Defaults to CACHE_SIZE.
+            ttl (float, optional): The number of seconds an entry stays valid. Defaults to TTL.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, map_id, pin_id, load):
+        """
+        Get the details of a pin, loading them on a miss.
+
+        Args:
+            map_id (int): The ID of the map.
+            pin_id (int): The ID of the pin.
+            load (function): Function called without arguments on a miss; returns the
+                details of the pin and the ID of its pin type.
+
+        Returns:
+            dict: A copy of the details of the pin.
+        """
+        key = (map_id, pin_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                details, _, expires_at = entry
+                if self.ttl is None or time.monotonic() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return _copy(details)
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+
+        details, pin_type_id = load()
+
+        with self._lock:
+            # An invalidation during the load may have made the details stale
+            if generation == self._generation:
+                expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+                self._entries[key] = (details, pin_type_id, expires_at)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return _copy(details)
+
+    def _drop(self, keys):
+        # Must be called with the lock held
+        self._generation += 1
+        for key in keys:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate(self, map_id, pin_ids):
+        """
+        Drop the entries of pins that changed.
+
+        Args:
+            map_id (int): The ID of the map.
+            pin_ids (iterable): The IDs of the pins.
+        """
+        with self._lock:
+            self._drop([(map_id, pin_id) for pin_id in pin_ids])
+
+    def invalidate_pin_type(self, map_id, pin_type_id):
+        """
+        Drop the entries of every pin of a pin type that changed.
+
+        Args:
+            map_id (int): The ID of the map.
+            pin_type_id (int): The ID of the pin type.
+        """
+        with self._lock:
+            self._drop([key for key, (_, entry_pin_type_id, _) in self._entries.items()
+                        if key[0] == map_id and entry_pin_type_id == pin_type_id])
+
+    def invalidate_map(self, map_id):
+        """
+        Drop the entries of every pin of a map.
+
+        Args:
+            map_id (int): The ID of the map.
+        """
+        with self._lock:
+            self._drop([key for key in self._entries if key[0] == map_id])
+
+    def clear(self):
+        """
+        Drop every entry.
+        """
+        with self._lock:
+            self._drop(list(self._entries))
+
+    def stats(self):
+        """
+        Get the counters of the cache.
+
+        Returns:
+            dict: The 'size', 'hits', 'misses', 'hit_rate', 'evictions', 'expirations' and 'invalidations'.
+        """
+        with self._lock:
+            reads = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / reads if reads else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+pin_details = PinCache()
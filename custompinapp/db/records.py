@@ -0,0 +1,241 @@
+"""
+Compact pin records for the Custom Pins application.
+
+Listing functions return one record per pin instead of a dictionary. A record keeps its
+values in slots and refers to the attributes of its pin type, such as the name and color,
+through a PinTypeInfo shared by every pin of the type, instead of holding its own copies.
+Field values are loaded on first access, for a whole batch of records in one query, and
+kept as a tuple in the order of the pin type's fields.
+
+Records are read-only mappings with the keys of the dictionaries they replace, so
+pin['color'], pin.get('fields', {}) and dict(pin) keep working.
+
+The models are imported on first use, so the in-memory backend (see db.memory) builds
+the same records without opening the database.
+
+Classes:
+    PinTypeInfo: The attributes shared by the pins of a pin type.
+    PinRecord: A pin, readable as a dictionary.
+    FieldBatch: The field values of a batch of records, loaded together on first use.
+
+Functions:
+    load_pin_types(map_id, pin_type_ids=None): Get the shared attributes of the pin types of a map.
+    pin_records(rows, map_id, with_fields=True, batch_size=1000): Build records from rows of pin columns.
+"""
+import threading
+from collections.abc import Mapping
+
+class PinTypeInfo:
+    """
+    The attributes shared by the pins of a pin type.
+
+    Attributes:
+        id (int): The ID of the pin type.
+        name (str): The name of the pin type.
+        color (str): The color of the pin type.
+        style (str): The style of the pin type.
+        field_ids (tuple): The IDs of the pin type's fields.
+        field_names (tuple): The names of the pin type's fields, in the same order.
+    """
+    __slots__ = ('id', 'name', 'color', 'style', 'field_ids', 'field_names')
+
+    def __init__(self, id, name, color, style, field_ids=(), field_names=()):
+        self.id = id
+        self.name = name
+        self.color = color
+        self.style = style
+        self.field_ids = field_ids
+        self.field_names = field_names
+
+    def __repr__(self):
+        return f"PinTypeInfo({self.id}, {self.name!r})"
+
+class PinRecord(Mapping):
+    """
+    A pin, readable as a dictionary.
+
+    The keys are 'id', 'pin_type' (the name of the pin type), 'latitude', 'longitude',
+    'color', 'style', 'fields' and, when it was read, 'uid'. 'fields' builds a new
+    dictionary of field values on each access.
+
+    Every key is also an attribute, so hot loops can use pin.latitude directly.
+
+    Attributes:
+        id (int): The ID of the pin.
+        uid (str): The uid of the pin, or None if it was not read.
+        pin_type_info (PinTypeInfo): The attributes of the pin's type.
+        latitude (float): The latitude of the pin.
+        longitude (float): The longitude of the pin.
+    """
+    __slots__ = ('id', 'uid', 'pin_type_info', 'latitude', 'longitude', '_values', '_batch')
+
+    def __init__(self, id, uid, pin_type_info, latitude, longitude, values=(), batch=None):
+        self.id = id
+        self.uid = uid
+        self.pin_type_info = pin_type_info
+        self.latitude = latitude
+        self.longitude = longitude
+        self._values = values
+        self._batch = batch
+
+    @property
+    def pin_type(self):
+        """
+        str: The name of the pin's type.
+        """
+        return self.pin_type_info.name
+
+    @property
+    def color(self):
+        """
+        str: The color of the pin's type.
+        """
+        return self.pin_type_info.color
+
+    @property
+    def style(self):
+        """
+        str: The style of the pin's type.
+        """
+        return self.pin_type_info.style
+
+    @property
+    def fields(self):
+        """
+        dict: The field values of the pin by field name, loaded on first access.
+        """
+        if self._batch is not None:
+            self._batch.load()
+        return {name: value for name, value in zip(self.pin_type_info.field_names, self._values) if value is not None}
+
+    def _keys(self):
+        return _KEYS if self.uid is not None else _KEYS_WITHOUT_UID
+
+    def __getitem__(self, key):
+        if key in _KEY_SET and (key != 'uid' or self.uid is not None):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+    def __contains__(self, key):
+        return key in _KEY_SET and (key != 'uid' or self.uid is not None)
+
+    def __repr__(self):
+        return f"PinRecord(id={self.id}, pin_type={self.pin_type!r}, latitude={self.latitude}, longitude={self.longitude})"
+
+_KEYS = ('id', 'uid', 'pin_type', 'latitude', 'longitude', 'color', 'style', 'fields')
+_KEYS_WITHOUT_UID = tuple(key for key in _KEYS if key != 'uid')
+_KEY_SET = frozenset(_KEYS)
+_load_lock = threading.Lock()
+
+class FieldBatch:
+    """
+    The field values of a batch of records, loaded together on first use.
+
+    Attributes:
+        map_id (int): The ID of the map of the records.
+        records (list): The records waiting for their values, or None once loaded.
+    """
+    __slots__ = ('map_id', 'records')
+
+    def __init__(self, map_id, records):
+        self.map_id = map_id
+        self.records = records
+
+    def load(self):
+        """
+        Load the field values of every record of the batch.
+        """
+        from db.db import database, FieldValue
+        with _load_lock:
+            records = self.records
+            if records is None:
+                return
+            values = {record.id: {} for record in records}
+            # Plain SQL: building a peewee IN expression costs more than running the query
+            sql = (f"SELECT pin_id, field_id, value FROM {FieldValue._meta.table_name}"
+                   f" WHERE pin_id IN ({', '.join('?' * len(values))})")
+            with database.use_map(self.map_id):
+                for pin_id, field_id, value in database.execute_sql(sql, list(values)):
+                    values[pin_id][field_id] = value
+            for record in records:
+                by_field = values[record.id]
+                record._values = tuple(by_field.get(field_id) for field_id in record.pin_type_info.field_ids)
+                record._batch = None
+            self.records = None
+
+def load_pin_types(map_id, pin_type_ids=None):
+    """
+    Get the shared attributes of the pin types of a map.
+
+    Args:
+        map_id (int): The ID of the map.
+        pin_type_ids (iterable, optional): The IDs of the pin types to get. Defaults to
+            None, for every pin type of the map.
+
+    Returns:
+        dict: The PinTypeInfo of each pin type found, by ID.
+    """
+    from db.db import PinType, Field
+    condition = PinType.map == map_id
+    if pin_type_ids is not None:
+        condition &= PinType.id.in_(list(pin_type_ids))
+    fields = {}
+    query = (Field
+             .select(Field.pin_type, Field.id, Field.name)
+             .join(PinType)
+             .where(condition)
+             .order_by(Field.id)
+             .tuples())
+    for pin_type_id, field_id, name in query:
+        fields.setdefault(pin_type_id, []).append((field_id, name))
+    pin_types = {}
+    query = PinType.select(PinType.id, PinType.name, PinType.color, PinType.style).where(condition).tuples()
+    for pin_type_id, name, color, style in query:
+        type_fields = fields.get(pin_type_id, [])
+        pin_types[pin_type_id] = PinTypeInfo(
+            pin_type_id, name, color, style,
+            tuple(field_id for field_id, _ in type_fields),
+            tuple(field_name for _, field_name in type_fields),
+        )
+    return pin_types
+
+def pin_records(rows, map_id, with_fields=True, batch_size=1000):
+    """
+    Build records from rows of pin columns.
+
+    Must be called with the map's database selected.
+
+    Args:
+        rows (iterable): Tuples of (id, pin type ID, latitude, longitude), optionally followed by the uid.
+        map_id (int): The ID of the map of the pins.
+        with_fields (bool, optional): Whether the records can load their field values; if
+            not, their fields are empty. Defaults to True.
+        batch_size (int, optional): The number of records whose field values are loaded
+            together. Defaults to 1000.
+
+    Yields:
+        PinRecord: A record for each row.
+    """
+    pin_types = load_pin_types(map_id)
+    batch = None
+    for row in rows:
+        uid = row[4] if len(row) > 4 else None
+        pin_type_info = pin_types.get(row[1])
+        if pin_type_info is None:
+            # A pin type created after the stream started, here or by another process
+            pin_types.update(load_pin_types(map_id, [row[1]]))
+            pin_type_info = pin_types[row[1]]
+        record = PinRecord(row[0], uid, pin_type_info, row[2], row[3])
+        if with_fields:
+            # A batch read before it is full is not extended
+            if batch is None or batch.records is None or len(batch.records) == batch_size:
+                batch = FieldBatch(map_id, [])
+            batch.records.append(record)
+            record._batch = batch
+        yield record
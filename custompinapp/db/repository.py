@@ -0,0 +1,306 @@
+"""
+Storage backends for the Custom Pins application.
+
+PinRepository is the interface of the CRUD layer: the operations on maps, pin types and
+pins of db.crud, with the same arguments, return values and errors. Three backends
+implement it:
+
+- 'sqlite': SqliteRepository, db.crud on the database file chosen by db.db.
+- 'sqlite-memory': SqliteRepository on a shared-cache in-memory SQLite database, which
+  keeps the change journal, jobs and sync, but writes nothing to disk.
+- 'memory': db.memory.MemoryRepository, pure Python dictionaries and sorted arrays, with
+  no SQL at all. It has no change journal, so it cannot sync, and its data lives in one
+  process; it is the reference behavior of the interface and a very fast cache tier.
+
+The backend is chosen by the CUSTOMPINS_STORAGE environment variable, like the database
+file by CUSTOMPINS_DB, and defaults to 'sqlite'. The application, the API, background jobs
+and the change bus all work through the repository returned by get_repository(). Nothing
+opens a database until a SQLite repository is created.
+
+The change journal, and what is built on it, needs a SQLite backend: with 'memory', the
+change bus has nothing to poll, deduplication and vector tiles are refused, and sync only
+sees the SQLite database. Background jobs are still kept in the SQLite database.
+
+Classes:
+    DuplicatePinError: Raised when a new pin duplicates an existing one and duplicates are rejected.
+    PinRepository: The operations on maps, pin types and pins.
+    SqliteRepository: The repository of the SQLite database.
+
+Functions:
+    open_repository(backend=None): Create the repository of a backend.
+    get_repository(): Get the repository shared by the application.
+    copy_map(source, target, map_id=DEFAULT_MAP_ID, target_map_id=DEFAULT_MAP_ID): Copy the pin types and pins of a map.
+"""
+import abc
+import contextlib
+import os
+import threading
+from db.defaults import DEFAULT_MAP_ID, DEFAULT_DISTANCE_M
+
+BACKENDS = ('sqlite', 'sqlite-memory', 'memory')
+
+_shared = None  # The repository returned by get_repository()
+_shared_lock = threading.Lock()
+
+class DuplicatePinError(ValueError):
+    """
+    Raised when a new pin duplicates an existing one and duplicates are rejected.
+
+    Attributes:
+        pin (Pin): The existing pin.
+    """
+    def __init__(self, pin):
+        super().__init__(f"Pin '{pin.id}' of type '{pin.pin_type.name}' already exists at this location.")
+        self.pin = pin
+
+class PinRepository(abc.ABC):
+    """
+    The operations on maps, pin types and pins.
+
+    Each operation behaves like the db.crud function of the same name, which documents its
+    arguments and results. Objects returned for created or updated rows, such as the pin
+    returned by add_pin, have at least the attributes id, uid and name or latitude and
+    longitude; listings return db.records.PinRecord objects.
+
+    Attributes:
+        backend (str): The name of the backend.
+        database (MapRoutedDatabase): The SQLite database, which also keeps the change
+            journal, or None for a backend without one.
+    """
+    backend = None
+    database = None
+
+    @abc.abstractmethod
+    def create_map(self, name, separate_file=False):
+        pass
+
+    @abc.abstractmethod
+    def get_all_maps(self):
+        pass
+
+    @abc.abstractmethod
+    def delete_map(self, map_id):
+        pass
+
+    @abc.abstractmethod
+    def create_pin_type(self, name, fields, color=None, style="add_location", map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_all_pin_types(self, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_pin_type_by_name(self, name, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_pin_type_stats(self, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def add_pin(self, pin_type_name, latitude, longitude, field_values, on_duplicate="allow",
+                duplicate_distance_m=DEFAULT_DISTANCE_M, key_fields=None, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_pin_by_id(self, pin_id, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_pins(self, pin_type_name, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_all_pins(self, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_pins_in_bounds(self, south, west, north, east, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def iter_pins(self, bounds=None, pin_type_name=None, uids=None, with_fields=True, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_date_field_names(self, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_date_counts(self, field_name=None, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def get_pin_ids_by_date(self, start, end, field_name=None, pin_ids=None, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def update_pin(self, pin_id, updated_field_values, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def update_pins(self, updates, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def delete_pin(self, pin_id, map_id=DEFAULT_MAP_ID):
+        pass
+
+    @abc.abstractmethod
+    def update_pin_type(self, pin_type_id, new_name=None, updated_fields=None, new_color=None, new_style=None,
+                        map_id=DEFAULT_MAP_ID, progress=None):
+        pass
+
+    @abc.abstractmethod
+    def delete_pin_type_and_pins(self, pin_type_name, map_id=DEFAULT_MAP_ID, progress=None):
+        pass
+
+    @abc.abstractmethod
+    def atomic(self, map_id=DEFAULT_MAP_ID):
+        """
+        Make the operations on a map inside a with block one transaction.
+
+        Args:
+            map_id (int, optional): The ID of the map. Defaults to the default map.
+
+        Returns:
+            A context manager.
+        """
+
+    @abc.abstractmethod
+    def get_data_version(self, map_id=DEFAULT_MAP_ID):
+        """
+        Get a number that changes whenever the pins or pin types of a map change.
+
+        Args:
+            map_id (int, optional): The ID of the map. Defaults to the default map.
+
+        Returns:
+            int: The data version.
+
+        Raises:
+            ValueError: If the map does not exist.
+        """
+
+# The operations db.crud implements as functions of the same name
+OPERATIONS = tuple(
+    name for name, member in vars(PinRepository).items()
+    if getattr(member, '__isabstractmethod__', False) and name not in ('atomic', 'get_data_version')
+)
+
+def _crud_operation(name):
+    # A method calling the db.crud function, until __init__ puts the function itself in its place
+    def operation(self, *args, **kwargs):
+        return getattr(self._crud, name)(*args, **kwargs)
+    operation.__name__ = name
+    return operation
+
+class SqliteRepository(PinRepository):
+    """
+    The repository of the SQLite database, whose operations are the db.crud functions.
+
+    Attributes:
+        database (MapRoutedDatabase): The database.
+    """
+    locals().update({name: _crud_operation(name) for name in OPERATIONS})
+
+    def __init__(self):
+        """
+        Initialize a SqliteRepository instance, opening the database.
+        """
+        import db.crud as pins_crud
+        self._crud = pins_crud
+        self.database = pins_crud.database
+        self.backend = 'sqlite-memory' if self.database.in_memory else 'sqlite'
+        # The functions themselves, so calls cost no more than calling db.crud
+        for name in OPERATIONS:
+            setattr(self, name, getattr(pins_crud, name))
+
+    @contextlib.contextmanager
+    def atomic(self, map_id=DEFAULT_MAP_ID):
+        with self.database.use_map(map_id), self.database.atomic():
+            yield
+
+    def get_data_version(self, map_id=DEFAULT_MAP_ID):
+        from db.journal import get_data_version
+        with self.database.use_map(map_id):
+            return get_data_version()
+
+def open_repository(backend=None):
+    """
+    Create the repository of a backend.
+
+    'sqlite-memory' must be chosen before anything opens the database, since the database
+    file is chosen when db.db is imported, unless CUSTOMPINS_STORAGE already chose it.
+
+    Args:
+        backend (str, optional): 'sqlite', 'sqlite-memory' or 'memory'. Defaults to the
+            CUSTOMPINS_STORAGE environment variable, or 'sqlite'.
+
+    Returns:
+        PinRepository: The repository.
+    """
+    if backend is None:
+        backend = os.environ.get('CUSTOMPINS_STORAGE') or 'sqlite'
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown storage backend '{backend}'; expected one of {', '.join(BACKENDS)}.")
+    if backend == 'memory':
+        from db.memory import MemoryRepository
+        return MemoryRepository()
+    if backend == 'sqlite-memory':
+        import sys
+        if 'db.db' not in sys.modules:
+            os.environ['CUSTOMPINS_DB'] = ':memory:'
+        elif not sys.modules['db.db'].database.in_memory:
+            raise RuntimeError("The database file is already open; 'sqlite-memory' must be chosen before it is.")
+    return SqliteRepository()
+
+def get_repository():
+    """
+    Get the repository shared by the application, created by open_repository() on first use.
+
+    Returns:
+        PinRepository: The repository.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = open_repository()
+        return _shared
+
+def copy_map(source, target, map_id=DEFAULT_MAP_ID, target_map_id=DEFAULT_MAP_ID):
+    """
+    Copy the pin types and pins of a map from one repository to another, for example to
+    serve a map from memory or to save a demo map.
+
+    Pin types that already exist in the target, such as the default one, keep their fields
+    there. Pins get new IDs.
+
+    Args:
+        source (PinRepository): The repository to copy from.
+        target (PinRepository): The repository to copy to.
+        map_id (int, optional): The ID of the map in the source. Defaults to the default map.
+        target_map_id (int, optional): The ID of the map in the target. Defaults to the default map.
+
+    Returns:
+        int: The number of pins copied.
+    """
+    existing = {pin_type['name'] for pin_type in target.get_all_pin_types(map_id=target_map_id)}
+    for pin_type in source.get_all_pin_types(map_id=map_id):
+        if pin_type['name'] in existing:
+            continue
+        fields = source.get_pin_type_by_name(pin_type['name'], map_id=map_id)['fields']
+        target.create_pin_type(pin_type['name'], [(field['name'], field['field_type'], field['is_required']) for field in fields],
+                               pin_type['color'], pin_type['style'], map_id=target_map_id)
+    field_names = {}
+    count = 0
+    for pin in source.iter_pins(map_id=map_id):
+        names = field_names.get(pin['pin_type'])
+        if names is None:
+            fields = target.get_pin_type_by_name(pin['pin_type'], map_id=target_map_id)['fields']
+            names = field_names[pin['pin_type']] = {field['name'] for field in fields}
+        values = {name: value for name, value in pin['fields'].items() if name in names}
+        target.add_pin(pin['pin_type'], pin['latitude'], pin['longitude'], values, map_id=target_map_id)
+        count += 1
+    return count
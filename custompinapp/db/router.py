@@ -0,0 +1,233 @@
+"""
+Per-map database routing for the Custom Pins application.
+
+Maps can live in the shared database or in their own SQLite file. MapRoutedDatabase is a
+single peewee database that sends every query to the file of the map selected with
+use_map(), so the models and CRUD functions stay the same whatever the storage. The
+selection is held in a context variable, so concurrent sessions and threads working on
+different maps never share a connection, a transaction or a file lock.
+
+In memory mode the files are shared-cache in-memory SQLite databases instead, which every
+connection of the process sees, and which are kept open for the life of the process.
+Writers there wait for each other's table locks; readers should not take any.
+
+Classes:
+    MapRoutedDatabase: A SQLite database that routes queries to the current map's file.
+"""
+import contextlib
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from peewee import SqliteDatabase, OperationalError
+
+_current_path = contextvars.ContextVar('current_map_path', default=None)
+
+class _ConnectionState(threading.local):
+    # The connection of each thread to one file, with the attributes peewee keeps per thread
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.closed = True
+        self.conn = None
+        self.ctx = []
+        self.transactions = []
+
+    def set_connection(self, conn):
+        self.conn = conn
+        self.closed = False
+        self.ctx = []
+        self.transactions = []
+
+class MapRoutedDatabase(SqliteDatabase):
+    """
+    A SQLite database that routes queries to the current map's file.
+
+    Attributes:
+        directory (str): The directory of the per-map files.
+        shared_path (str): The path of the shared database.
+        resolve_file (function): Function that returns the file name of a map, or None if
+            the map lives in the shared database. Set by the models module.
+        on_new_file (function): Function called inside use_map() the first time a per-map
+            file is used by this process, to create its tables.
+        in_memory (bool): Whether the files are kept in memory instead of on disk.
+    """
+    def __init__(self, shared_path, directory, in_memory=False, **kwargs):
+        """
+        Initialize a MapRoutedDatabase instance.
+
+        Args:
+            shared_path (str): The path of the shared database.
+            directory (str): The directory of the per-map files.
+            in_memory (bool, optional): Whether to keep the files in memory, under the same
+                names. Defaults to False.
+        """
+        self.in_memory = in_memory
+        self._keepers = {}
+        if in_memory:
+            kwargs['uri'] = True
+            shared_path = self._open_in_memory(shared_path)
+        self.shared_path = shared_path
+        self._states = {}
+        self._states_lock = threading.Lock()
+        self.directory = directory
+        self.resolve_file = lambda map_id: None
+        self.on_new_file = None
+        self._files = {}
+        self._ready_paths = set()
+        self._ready_lock = threading.Lock()
+        super().__init__(shared_path, **kwargs)
+
+    @property
+    def database(self):
+        return _current_path.get() or self.shared_path
+
+    @database.setter
+    def database(self, value):
+        self.shared_path = value
+
+    @property
+    def _state(self):
+        path = self.database
+        state = self._states.get(path)
+        if state is None:
+            with self._states_lock:
+                state = self._states.setdefault(path, _ConnectionState())
+        return state
+
+    @_state.setter
+    def _state(self, value):
+        # Set by peewee's __init__ only; each file gets a _ConnectionState on first use
+        pass
+
+    def _open_in_memory(self, path):
+        # A shared-cache memory database lives while a connection to it is open
+        uri = f"file:{path}?mode=memory&cache=shared"
+        if uri not in self._keepers:
+            self._keepers[uri] = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        return uri
+
+    def path_for(self, map_id):
+        """
+        Get the database file of a map.
+
+        Args:
+            map_id (int): The ID of the map.
+
+        Returns:
+            str: The path of the file holding the map.
+        """
+        if map_id not in self._files:
+            with self.use_shared():
+                file_name = self.resolve_file(map_id)
+            path = os.path.join(self.directory, file_name) if file_name else self.shared_path
+            if file_name and self.in_memory:
+                path = self._open_in_memory(path)
+            self._files[map_id] = path
+        return self._files[map_id]
+
+    def remove_file(self, map_id):
+        """
+        Close this thread's connection to the file of a map stored in its own file, and
+        delete the file.
+
+        Args:
+            map_id (int): The ID of the map.
+        """
+        path = self.path_for(map_id)
+        with self.use_map(map_id):
+            self.close()
+        keeper = self._keepers.pop(path, None)
+        if keeper is not None:
+            keeper.close()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def forget(self, map_id):
+        """
+        Drop the cached file of a map, after the map is created, moved or deleted.
+
+        Args:
+            map_id (int): The ID of the map.
+        """
+        self._files.pop(map_id, None)
+
+    @contextlib.contextmanager
+    def use_map(self, map_id):
+        """
+        Send the queries made inside the block to the file of a map.
+
+        Args:
+            map_id (int): The ID of the map.
+        """
+        path = self.path_for(map_id)
+        token = _current_path.set(path)
+        try:
+            if path not in self._ready_paths:
+                self._prepare(path, map_id)
+            yield
+        finally:
+            _current_path.reset(token)
+
+    def _prepare(self, path, map_id):
+        # Other threads wait until the tables exist; a failed preparation is tried again
+        with self._ready_lock:
+            if path in self._ready_paths:
+                return
+            if path != self.shared_path and self.on_new_file is not None:
+                self.on_new_file(map_id)
+            self._ready_paths.add(path)
+
+    @contextlib.contextmanager
+    def use_shared(self):
+        """
+        Send the queries made inside the block to the shared database.
+        """
+        token = _current_path.set(None)
+        try:
+            yield
+        finally:
+            _current_path.reset(token)
+
+    def execute_sql(self, sql, params=None, **kwargs):
+        if not self.in_memory:
+            return super().execute_sql(sql, params, **kwargs)
+        # Shared-cache databases lock tables, and SQLite fails a statement waiting for a
+        # table lock at once instead of after the busy timeout, so wait here instead
+        deadline = time.monotonic() + self._timeout
+        delay = 0.001
+        while True:
+            try:
+                return super().execute_sql(sql, params, **kwargs)
+            except OperationalError as e:
+                if 'locked' not in str(e) or time.monotonic() > deadline:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def atomic(self, lock_type='IMMEDIATE'):
+        """
+        Start a transaction, or a savepoint inside one.
+
+        Transactions take the write lock when they begin. Two deferred transactions that
+        both read before writing deadlock, and SQLite fails one of them at once instead of
+        letting it wait for the other, which happens as soon as background jobs write
+        while sessions do.
+
+        Args:
+            lock_type (str, optional): The SQLite transaction type. Defaults to 'IMMEDIATE'.
+        """
+        return super().atomic(lock_type=lock_type)
+
+    def close_all(self):
+        """
+        Close this thread's connection to every file.
+        """
+        for path in list(self._states):
+            token = _current_path.set(path)
+            try:
+                self.close()
+            finally:
+                _current_path.reset(token)
@@ -0,0 +1,321 @@
+"""
+Incremental delta sync for the Custom Pins application.
+
+Devices with their own database exchange batches of change journal entries with a hub.
+Batches are compressed for transport. Conflicts are resolved per entity with last writer
+wins, ordered by the change timestamp and then by the origin device ID; changes that lose
+are reported back instead of being applied.
+
+Maps stored in their own file are synced too: each file has its own journal, pushed on its
+own, and pulled changes are applied in the file of their map.
+
+Functions:
+    get_changes_since(seq, limit=500, origin=None): Get journal entries after a sequence number.
+    pack_changes(changes): Compress a batch of changes for transport.
+    unpack_changes(data): Decompress a batch of changes.
+    apply_changes(batch): Apply a batch of changes made on another device.
+    sync_with_hub(hub_database, batch_size=500): Push local changes to a hub and pull its changes.
+"""
+import json
+import zlib
+from db.db import get_session, Map, PinType, Pin, Field, FieldValue, ChangeLog, MODELS, DEFAULT_MAP_ID, create_default_map
+from db.journal import get_device_id, get_state, set_state, record_change
+from db.pin_cache import pin_details
+
+database = get_session()
+
+def get_changes_since(seq, limit=500, origin=None):
+    """
+    Get journal entries after a sequence number.
+
+    Args:
+        seq (int): The last sequence number already seen.
+        limit (int, optional): The maximum number of entries. Defaults to 500.
+        origin (str, optional): Only return changes made on this device. Defaults to None.
+
+    Returns:
+        list: A list of dictionaries representing the changes, ordered by sequence number.
+    """
+    query = ChangeLog.select().where(ChangeLog.seq > seq)
+    if origin is not None:
+        query = query.where(ChangeLog.origin == origin)
+    return [
+        {
+            "seq": change.seq,
+            "entity": change.entity,
+            "entity_uid": change.entity_uid,
+            "operation": change.operation,
+            "payload": json.loads(change.payload),
+            "origin": change.origin,
+            "timestamp": change.timestamp,
+        }
+        for change in query.order_by(ChangeLog.seq).limit(limit)
+    ]
+
+def pack_changes(changes):
+    """
+    Compress a batch of changes for transport.
+
+    Args:
+        changes (list): The changes, as returned by get_changes_since.
+
+    Returns:
+        bytes: The compressed batch.
+    """
+    return zlib.compress(json.dumps(changes, separators=(',', ':')).encode('utf-8'))
+
+def unpack_changes(data):
+    """
+    Decompress a batch of changes.
+
+    Args:
+        data (bytes): The compressed batch, as returned by pack_changes.
+
+    Returns:
+        list: The changes.
+    """
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+def _get_or_create_map(payload):
+    # Journals written before maps existed only had the default map
+    if 'map' not in payload:
+        return Map.get_by_id(DEFAULT_MAP_ID)
+    map_row = Map.get_or_none(Map.uid == payload['map']['uid'])
+    if map_row is None:
+        if Map.get_or_none(Map.name == payload['map']['name']):
+            raise ValueError(f"Map '{payload['map']['name']}' already exists with a different uid.")
+        map_row = Map.create(uid=payload['map']['uid'], name=payload['map']['name'])
+    return map_row
+
+def _apply_pin_type(change):
+    pin_type = PinType.get_or_none(PinType.uid == change['entity_uid'])
+    if change['operation'] == 'delete':
+        if pin_type:
+            Pin.delete().where(Pin.pin_type == pin_type).execute()
+            pin_type.delete_instance(recursive=True)
+        return
+
+    payload = change['payload']
+    if pin_type is None:
+        map_row = _get_or_create_map(payload)
+        if PinType.get_or_none((PinType.map == map_row) & (PinType.name == payload['name'])):
+            raise ValueError(f"PinType '{payload['name']}' already exists with a different uid.")
+        pin_type = PinType.create(uid=change['entity_uid'], map=map_row, name=payload['name'], color=payload['color'], style=payload['style'])
+    else:
+        pin_type.name = payload['name']
+        pin_type.color = payload['color']
+        pin_type.style = payload['style']
+        pin_type.save()
+
+    # Fields are matched by name so that existing values are kept
+    existing_fields = {field.name: field for field in pin_type.fields}
+    for name, field_type, is_required in payload['fields']:
+        field = existing_fields.pop(name, None)
+        if field is None:
+            Field.create(pin_type=pin_type, name=name, field_type=field_type, is_required=is_required)
+        else:
+            field.field_type = field_type
+            field.is_required = is_required
+            field.save()
+    for field in existing_fields.values():
+        field.delete_instance(recursive=True)
+
+def _apply_pin(change):
+    pin = Pin.get_or_none(Pin.uid == change['entity_uid'])
+    if change['operation'] == 'delete':
+        if pin:
+            pin.delete_instance(recursive=True)
+        return
+
+    payload = change['payload']
+    pin_type = PinType.get_or_none(PinType.uid == payload['pin_type'])
+    if pin_type is None:
+        raise ValueError(f"PinType with uid '{payload['pin_type']}' does not exist.")
+    if pin is None:
+        pin = Pin.create(uid=change['entity_uid'], map=pin_type.map_id, pin_type=pin_type, latitude=payload['latitude'], longitude=payload['longitude'])
+    else:
+        pin.map = pin_type.map_id
+        pin.pin_type = pin_type
+        pin.latitude = payload['latitude']
+        pin.longitude = payload['longitude']
+        pin.save()
+
+    for field_name, value in payload['fields'].items():
+        field = Field.get_or_none((Field.pin_type == pin_type) & (Field.name == field_name))
+        if not field:
+            raise ValueError(f"Field '{field_name}' does not exist for PinType '{pin_type.name}'.")
+        updated = (FieldValue.update(value=value)
+                   .where((FieldValue.pin == pin) & (FieldValue.field == field))
+                   .execute())
+        if not updated:
+            FieldValue.create(pin=pin, field=field, value=value)
+
+def apply_changes(batch):
+    """
+    Apply a batch of changes made on another device.
+
+    Each change is applied and journaled with its original origin and timestamp, so it can be
+    forwarded to other devices. Changes made on this device are skipped, and so are changes
+    older than the latest local change to the same entity, which are reported as conflicts.
+
+    Args:
+        batch (list): The changes, as returned by get_changes_since.
+
+    Returns:
+        dict: A report with the number of changes 'applied' and 'skipped', the 'conflicts'
+        and 'errors' found, and the 'last_seq' of the batch.
+    """
+    database = ChangeLog._meta.database
+    device_id = get_device_id()
+    report = {"applied": 0, "skipped": 0, "conflicts": [], "errors": [], "last_seq": None}
+
+    for change in batch:
+        report["last_seq"] = change["seq"]
+        if change["origin"] == device_id:
+            report["skipped"] += 1
+            continue
+
+        latest = (ChangeLog.select()
+                  .where((ChangeLog.entity == change["entity"]) & (ChangeLog.entity_uid == change["entity_uid"]))
+                  .order_by(ChangeLog.seq.desc())
+                  .first())
+        if latest is not None:
+            local_version = (latest.timestamp, latest.origin)
+            remote_version = (change["timestamp"], change["origin"])
+            if local_version == remote_version:
+                # Already applied, for example when it comes back through another peer
+                report["skipped"] += 1
+                continue
+            if local_version > remote_version:
+                report["conflicts"].append({"change": change, "winner": latest.seq})
+                continue
+
+        try:
+            with database.atomic():
+                if change["entity"] == "pin_type":
+                    _apply_pin_type(change)
+                elif change["entity"] == "pin":
+                    _apply_pin(change)
+                else:
+                    raise ValueError(f"Unknown entity '{change['entity']}'.")
+                record_change(change["entity"], change["entity_uid"], change["operation"], change["payload"],
+                              origin=change["origin"], timestamp=change["timestamp"])
+            report["applied"] += 1
+        except Exception as e:
+            report["errors"].append({"change": change, "error": str(e)})
+
+    if report["applied"]:
+        # Remote changes can touch any pin of any map
+        pin_details.clear()
+    return report
+
+def _separate_maps():
+    # The maps stored in their own file, whose changes are journaled in that file, by uid
+    with database.use_shared():
+        return {map_row.uid: map_row.id for map_row in Map.select().where(Map.file_name.is_null(False))}
+
+def _scope(map_id):
+    return database.use_shared() if map_id is None else database.use_map(map_id)
+
+def _owner(change, maps, owners):
+    # The ID of the separate-file map a pulled change belongs to, or None for the shared database
+    if change['entity'] == 'pin_type' and change['operation'] != 'delete':
+        owner = maps.get(change['payload'].get('map', {}).get('uid'))
+    else:
+        if change['entity'] == 'pin' and change['operation'] != 'delete':
+            model, uid = PinType, change['payload']['pin_type']
+        else:
+            model, uid = (PinType if change['entity'] == 'pin_type' else Pin), change['entity_uid']
+        owner = owners.get(uid)
+        if uid not in owners:
+            for map_id in maps.values():
+                with database.use_map(map_id):
+                    if model.select().where(model.uid == uid).exists():
+                        owner = map_id
+                        break
+    owners[change['entity_uid']] = owner
+    return owner
+
+def _apply_pulled(batch, maps):
+    # Applies each change in the file of its map, in order
+    if not maps:
+        return apply_changes(batch)
+    runs = []
+    owners = {}
+    for change in batch:
+        owner = _owner(change, maps, owners)
+        if runs and runs[-1][0] == owner:
+            runs[-1][1].append(change)
+        else:
+            runs.append((owner, [change]))
+
+    report = {"applied": 0, "skipped": 0, "conflicts": [], "errors": [], "last_seq": batch[-1]["seq"] if batch else None}
+    for owner, changes in runs:
+        with _scope(owner):
+            _add_report(report, apply_changes(changes))
+    return report
+
+def _add_report(totals, report):
+    for key in ("applied", "skipped"):
+        totals[key] += report[key]
+    for key in ("conflicts", "errors"):
+        totals[key].extend(report[key])
+
+def sync_with_hub(hub_database, batch_size=500):
+    """
+    Push local changes to a hub and pull its changes.
+
+    The hub is reached by binding the models to its database, which is how a second local
+    database stands in for a remote hub. Batches go through pack_changes and unpack_changes
+    as they would over the network. Watermarks are kept per hub, so each run only sends
+    what changed since the last one.
+
+    A map stored in its own file keeps its own journal, device ID and push watermark there,
+    so each of those journals is pushed from inside its map's scope. Pulled changes are
+    applied in the file of the map they belong to; those of maps this device does not store
+    in their own file go to the shared database.
+
+    Args:
+        hub_database (peewee.Database): The database of the hub.
+        batch_size (int, optional): The maximum number of changes per batch. Defaults to 500.
+
+    Returns:
+        dict: The 'pushed' and 'pulled' reports, with the counts of every batch added up.
+    """
+    with hub_database.bind_ctx(MODELS):
+        hub_database.create_tables(MODELS)
+        create_default_map()
+        hub_id = get_device_id()
+
+    maps = _separate_maps()
+    totals = {direction: {"applied": 0, "skipped": 0, "conflicts": [], "errors": []} for direction in ("pushed", "pulled")}
+    watermark_keys = {"pushed": f"pushed:{hub_id}", "pulled": f"pulled:{hub_id}"}
+
+    for map_id in [None] + list(maps.values()):
+        with _scope(map_id):
+            device_id = get_device_id()
+            seq = int(get_state(watermark_keys["pushed"], 0))
+            while True:
+                data = pack_changes(get_changes_since(seq, batch_size, origin=device_id))
+                with hub_database.bind_ctx(MODELS):
+                    report = apply_changes(unpack_changes(data))
+                if report["last_seq"] is None:
+                    break
+                seq = report["last_seq"]
+                set_state(watermark_keys["pushed"], seq)
+                _add_report(totals["pushed"], report)
+
+    with database.use_shared():
+        seq = int(get_state(watermark_keys["pulled"], 0))
+    while True:
+        with hub_database.bind_ctx(MODELS):
+            data = pack_changes(get_changes_since(seq, batch_size))
+        report = _apply_pulled(unpack_changes(data), maps)
+        if report["last_seq"] is None:
+            break
+        seq = report["last_seq"]
+        with database.use_shared():
+            set_state(watermark_keys["pulled"], seq)
+        _add_report(totals["pulled"], report)
+
+    return totals
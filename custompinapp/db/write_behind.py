@@ -0,0 +1,141 @@
+"""
+Write-behind queue for pin attribute edits.
+
+Edits are accepted immediately and written later, coalesced per map, pin and field (the
+last write wins), in one transaction per map. A flush happens a short interval after the
+first pending edit, or earlier when flush() is called. Readers that must show a pin as
+edited apply pending() to what they read instead of flushing every pending edit.
+
+Classes:
+    WriteBehindQueue: A queue of pending field edits.
+
+Attributes:
+    pin_edits (WriteBehindQueue): The queue shared by the application.
+"""
+import atexit
+import threading
+from db.repository import get_repository, DEFAULT_MAP_ID
+
+repository = get_repository()
+
+FLUSH_INTERVAL = 0.5  # seconds
+
+class WriteBehindQueue:
+    """
+    A queue of pending field edits.
+
+    Attributes:
+        flush_interval (float): The delay in seconds between the first pending edit and the flush.
+        flush_count (int): The number of flushes that wrote at least one edit.
+    """
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        """
+        Initialize a WriteBehindQueue instance.
+
+        Args:
+            flush_interval (float, optional): The delay in seconds between the first pending
+                edit and the flush. Defaults to FLUSH_INTERVAL.
+        """
+        self.flush_interval = flush_interval
+        self.flush_count = 0
+        self._pending = {}
+        self._writing = {}  # the edits of the running flush, until they are written
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+
+    def submit(self, pin_id, field_name, value, on_error=None, map_id=DEFAULT_MAP_ID):
+        """
+        Queue a field edit.
+
+        Args:
+            pin_id (int): The ID of the pin.
+            field_name (str): The name of the field.
+            value (str): The new value of the field.
+            on_error (function, optional): Callback function called with the exception if the
+                edit cannot be written. Defaults to None.
+            map_id (int, optional): The ID of the map of the pin. Defaults to the default map.
+        """
+        with self._lock:
+            self._pending[(map_id, pin_id, field_name)] = (value, on_error)
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def discard(self, pin_id, map_id=DEFAULT_MAP_ID):
+        """
+        Drop the pending edits of a pin, for example because it is being deleted.
+
+        Args:
+            pin_id (int): The ID of the pin.
+            map_id (int, optional): The ID of the map of the pin. Defaults to the default map.
+        """
+        with self._lock:
+            for key in [key for key in self._pending if key[:2] == (map_id, pin_id)]:
+                del self._pending[key]
+
+    def pending(self, pin_id, map_id=DEFAULT_MAP_ID):
+        """
+        Get the values of the edits of a pin that may not be written yet.
+
+        Args:
+            pin_id (int): The ID of the pin.
+            map_id (int, optional): The ID of the map of the pin. Defaults to the default map.
+
+        Returns:
+            dict: The new value of each edited field, by field name.
+        """
+        with self._lock:
+            values = {key[2]: value for key, (value, _) in self._writing.items() if key[:2] == (map_id, pin_id)}
+            values.update({key[2]: value for key, (value, _) in self._pending.items() if key[:2] == (map_id, pin_id)})
+            return values
+
+    def pending_count(self):
+        """
+        Get the number of pending edits.
+
+        Returns:
+            int: The number of pending edits.
+        """
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        Write all pending edits, in a single transaction per map.
+
+        Errors are reported through the on_error callback of each failed edit.
+        """
+        # Only one flush writes at a time, so edits reach the database in order
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._writing = pending
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not pending:
+                return
+
+            updates = {}
+            for (map_id, pin_id, field_name), (value, _) in pending.items():
+                updates.setdefault(map_id, {}).setdefault(pin_id, {})[field_name] = value
+
+            errors = {}
+            for map_id, map_updates in updates.items():
+                try:
+                    failed = repository.update_pins(map_updates, map_id=map_id)
+                except Exception as e:
+                    failed = {pin_id: e for pin_id in map_updates}
+                errors.update(((map_id, pin_id), error) for pin_id, error in failed.items())
+            with self._lock:
+                self._writing = {}
+            self.flush_count += 1
+
+        for (map_id, pin_id, field_name), (value, on_error) in pending.items():
+            if (map_id, pin_id) in errors and on_error is not None:
+                on_error(errors[(map_id, pin_id)])
+
+pin_edits = WriteBehindQueue()
+atexit.register(pin_edits.flush)
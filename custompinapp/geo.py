@@ -0,0 +1,175 @@
+"""
+Geographic helpers for the Custom Pins application.
+
+This module provides the Web Mercator math used by the map: projecting coordinates to
+pixels at a given zoom level and measuring on-screen distances between coordinates.
+
+Functions:
+    lat_lng_to_world_pixel(latitude, longitude, zoom): Project a coordinate to world pixels.
+    pixel_distance(lat1, lng1, lat2, lng2, zoom): On-screen distance between two coordinates.
+    ground_distance(lat1, lng1, lat2, lng2): Distance in meters between two coordinates.
+    pixels_to_degrees(pixels, latitude, zoom): Convert a pixel distance to degrees.
+    world_pixel_to_lat_lng(x, y, zoom): Unproject world pixels to a coordinate.
+    viewport_bounds(latitude, longitude, zoom, width, height): Bounding box of a map viewport.
+    tile_bounds(z, x, y, buffer=0): Bounding box of a map tile.
+    fit_bounds(south, west, north, east, width, height, padding=40, max_zoom=16): Center and zoom showing a bounding box.
+"""
+import math
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.05112878
+EARTH_RADIUS_M = 6371008.8
+
+def lat_lng_to_world_pixel(latitude, longitude, zoom):
+    """
+    Project a coordinate to Web Mercator world pixels.
+
+    Args:
+        latitude (float): The latitude of the coordinate.
+        longitude (float): The longitude of the coordinate.
+        zoom (float): The zoom level of the map.
+
+    Returns:
+        tuple: The (x, y) position in pixels, measured from the top left of the world.
+    """
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    scale = TILE_SIZE * (2 ** zoom)
+    x = (longitude + 180.0) / 360.0 * scale
+    sin_lat = math.sin(math.radians(latitude))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+def pixel_distance(lat1, lng1, lat2, lng2, zoom):
+    """
+    Get the on-screen distance between two coordinates.
+
+    Args:
+        lat1 (float): The latitude of the first coordinate.
+        lng1 (float): The longitude of the first coordinate.
+        lat2 (float): The latitude of the second coordinate.
+        lng2 (float): The longitude of the second coordinate.
+        zoom (float): The zoom level of the map.
+
+    Returns:
+        float: The distance in pixels.
+    """
+    x1, y1 = lat_lng_to_world_pixel(lat1, lng1, zoom)
+    x2, y2 = lat_lng_to_world_pixel(lat2, lng2, zoom)
+    return math.hypot(x1 - x2, y1 - y2)
+
+def ground_distance(lat1, lng1, lat2, lng2):
+    """
+    Get the great-circle distance between two coordinates.
+
+    Args:
+        lat1 (float): The latitude of the first coordinate.
+        lng1 (float): The longitude of the first coordinate.
+        lat2 (float): The latitude of the second coordinate.
+        lng2 (float): The longitude of the second coordinate.
+
+    Returns:
+        float: The distance in meters.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+def pixels_to_degrees(pixels, latitude, zoom):
+    """
+    Convert an on-screen distance to degrees around a latitude.
+
+    Args:
+        pixels (float): The distance in pixels.
+        latitude (float): The latitude where the distance is measured.
+        zoom (float): The zoom level of the map.
+
+    Returns:
+        tuple: The (latitude, longitude) spans in degrees.
+    """
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    lng_degrees = pixels * 360.0 / (TILE_SIZE * (2 ** zoom))
+    lat_degrees = lng_degrees * math.cos(math.radians(latitude))
+    return lat_degrees, lng_degrees
+
+def world_pixel_to_lat_lng(x, y, zoom):
+    """
+    Unproject Web Mercator world pixels to a coordinate.
+
+    Args:
+        x (float): The horizontal position in pixels.
+        y (float): The vertical position in pixels.
+        zoom (float): The zoom level of the map.
+
+    Returns:
+        tuple: The (latitude, longitude) of the position.
+    """
+    scale = TILE_SIZE * (2 ** zoom)
+    longitude = x / scale * 360.0 - 180.0
+    latitude = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / scale))))
+    return latitude, longitude
+
+def viewport_bounds(latitude, longitude, zoom, width, height):
+    """
+    Get the bounding box shown by a map viewport.
+
+    Args:
+        latitude (float): The latitude of the viewport center.
+        longitude (float): The longitude of the viewport center.
+        zoom (float): The zoom level of the map.
+        width (float): The width of the viewport in pixels.
+        height (float): The height of the viewport in pixels.
+
+    Returns:
+        tuple: The (south, west, north, east) bounds in degrees.
+    """
+    x, y = lat_lng_to_world_pixel(latitude, longitude, zoom)
+    north, west = world_pixel_to_lat_lng(x - width / 2, y - height / 2, zoom)
+    south, east = world_pixel_to_lat_lng(x + width / 2, y + height / 2, zoom)
+    return south, max(west, -180.0), north, min(east, 180.0)
+
+def tile_bounds(z, x, y, buffer=0):
+    """
+    Get the bounding box of a map tile.
+
+    Args:
+        z (int): The zoom level of the tile.
+        x (int): The column of the tile.
+        y (int): The row of the tile.
+        buffer (float, optional): Extra margin around the tile, in pixels. Defaults to 0.
+
+    Returns:
+        tuple: The (south, west, north, east) bounds in degrees.
+    """
+    north, west = world_pixel_to_lat_lng(x * TILE_SIZE - buffer, y * TILE_SIZE - buffer, z)
+    south, east = world_pixel_to_lat_lng((x + 1) * TILE_SIZE + buffer, (y + 1) * TILE_SIZE + buffer, z)
+    return south, west, north, east
+
+def fit_bounds(south, west, north, east, width, height, padding=40, max_zoom=16):
+    """
+    Get the center and zoom level at which a viewport shows a bounding box.
+
+    Args:
+        south (float): The minimum latitude.
+        west (float): The minimum longitude.
+        north (float): The maximum latitude.
+        east (float): The maximum longitude.
+        width (float): The width of the viewport in pixels.
+        height (float): The height of the viewport in pixels.
+        padding (float, optional): The margin kept around the box, in pixels. Defaults to 40.
+        max_zoom (float, optional): The zoom used for a box too small to fit. Defaults to 16.
+
+    Returns:
+        tuple: The (latitude, longitude, zoom) of the viewport.
+    """
+    # Sizes at zoom 0; each zoom level doubles them
+    x1, y1 = lat_lng_to_world_pixel(north, west, 0)
+    x2, y2 = lat_lng_to_world_pixel(south, east, 0)
+    center_latitude, center_longitude = world_pixel_to_lat_lng((x1 + x2) / 2, (y1 + y2) / 2, 0)
+
+    zoom = max_zoom
+    for size, available in ((x2 - x1, width - 2 * padding), (y2 - y1, height - 2 * padding)):
+        if size > 0 and available > 0:
+            zoom = min(zoom, math.log2(available / size))
+    return center_latitude, center_longitude, max(0, math.floor(zoom))
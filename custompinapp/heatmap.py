@@ -0,0 +1,188 @@
+"""
+Density heatmap of pins for the Custom Pins application.
+
+At country zoom single pins cannot be told apart, so they are binned into a grid of
+screen-sized cells and drawn as one shaded cell each. Binning is done with NumPy over all
+pins at once; the resulting grids are cached per zoom level and pin type filter, and pin
+changes adjust the cached cells in place instead of dropping the grids. Drawing cost
+depends on the number of occupied cells, not on the number of pins.
+
+NumPy is imported on first use, so it is only loaded once a heatmap is drawn.
+
+Classes:
+    DensityHeatmap: Cached density grids of a set of pins.
+"""
+import math
+from geo import lat_lng_to_world_pixel, world_pixel_to_lat_lng, TILE_SIZE
+
+class DensityHeatmap:
+    """
+    Cached density grids of a set of pins.
+
+    Pins are dictionaries with at least 'id', 'latitude', 'longitude' and 'pin_type' keys,
+    and 'fields' when a weight field is used.
+
+    Attributes:
+        cell_px (int): The size of a grid cell on screen, in pixels.
+        weight_field (str): The numeric field each pin is weighted by, or None to count pins.
+            Pins without a numeric value in the field weigh nothing.
+        pins (dict): The binned pins by ID.
+    """
+    def __init__(self, cell_px=32, weight_field=None):
+        """
+        Initialize a DensityHeatmap instance.
+
+        Args:
+            cell_px (int, optional): The size of a grid cell on screen, in pixels. Defaults to 32.
+            weight_field (str, optional): The numeric field each pin is weighted by. Defaults to None.
+        """
+        self.cell_px = cell_px
+        self.weight_field = weight_field
+        self.pins = {}
+        self._grids = {}
+        self._arrays = None
+
+    def _weight(self, pin):
+        if self.weight_field is None:
+            return 1.0
+        value = pin.get('fields', {}).get(self.weight_field)
+        if isinstance(value, dict):
+            value = value.get('value')
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def _cell(self, pin, zoom):
+        x, y = lat_lng_to_world_pixel(pin['latitude'], pin['longitude'], zoom)
+        return (int(x // self.cell_px), int(y // self.cell_px))
+
+    def _shift(self, pin, sign):
+        # Moves one pin in or out of every cached grid it belongs to
+        weight = self._weight(pin) * sign
+        for (zoom, pin_type), grid in self._grids.items():
+            if pin_type is not None and pin['pin_type'] != pin_type:
+                continue
+            cell = self._cell(pin, zoom)
+            value = grid.get(cell, 0.0) + weight
+            if abs(value) < 1e-9:
+                grid.pop(cell, None)
+            else:
+                grid[cell] = value
+
+    def load(self, pins):
+        """
+        Replace the binned pins, dropping every cached grid.
+
+        Args:
+            pins (iterable): The pins.
+        """
+        self.pins = {pin['id']: pin for pin in pins}
+        self._grids.clear()
+        self._arrays = None
+
+    def add(self, pin):
+        """
+        Add a pin, or move it if a pin with the same ID was added before.
+
+        Args:
+            pin (dict): The pin.
+        """
+        previous = self.pins.get(pin['id'])
+        if previous is not None:
+            self._shift(previous, -1)
+        self.pins[pin['id']] = pin
+        self._shift(pin, 1)
+        self._arrays = None
+
+    def remove(self, pin_id):
+        """
+        Remove a pin.
+
+        Args:
+            pin_id (int): The ID of the pin.
+        """
+        pin = self.pins.pop(pin_id, None)
+        if pin is not None:
+            self._shift(pin, -1)
+            self._arrays = None
+
+    def _build_arrays(self):
+        import numpy as np
+
+        pins = list(self.pins.values())
+        latitudes = np.clip(np.fromiter((pin['latitude'] for pin in pins), float, len(pins)), -85.05112878, 85.05112878)
+        longitudes = np.fromiter((pin['longitude'] for pin in pins), float, len(pins))
+        # World pixels at zoom 0; each zoom level doubles them
+        sin_lat = np.sin(np.radians(latitudes))
+        x = (longitudes + 180.0) / 360.0 * TILE_SIZE
+        y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * TILE_SIZE
+        weights = np.fromiter((self._weight(pin) for pin in pins), float, len(pins))
+        pin_types = np.array([pin['pin_type'] for pin in pins], dtype=object)
+        self._arrays = (x, y, weights, pin_types)
+
+    def grid(self, zoom, pin_type=None):
+        """
+        Get the density grid at a zoom level, binning the pins if it is not cached.
+
+        Args:
+            zoom (float): The zoom level of the map. Grids are kept per whole zoom level.
+            pin_type (str, optional): The name of the pin type to count, or None for all. Defaults to None.
+
+        Returns:
+            dict: The summed weight of each occupied (column, row) cell.
+        """
+        import numpy as np
+
+        key = (math.floor(zoom), pin_type)
+        grid = self._grids.get(key)
+        if grid is not None:
+            return grid
+
+        if self._arrays is None:
+            self._build_arrays()
+        x, y, weights, pin_types = self._arrays
+        if pin_type is not None:
+            mask = pin_types == pin_type
+            x, y, weights = x[mask], y[mask], weights[mask]
+
+        scale = 2 ** key[0] / self.cell_px
+        cells_per_axis = int(math.ceil(TILE_SIZE * scale))
+        # The east and south edges of the world belong to the last cell
+        columns = np.minimum(np.floor(x * scale).astype(np.int64), cells_per_axis - 1)
+        rows = np.minimum(np.floor(y * scale).astype(np.int64), cells_per_axis - 1)
+        cells = columns * cells_per_axis + rows
+        occupied, inverse = np.unique(cells, return_inverse=True)
+        sums = np.bincount(inverse, weights=weights, minlength=len(occupied))
+
+        grid = {
+            (int(cell // cells_per_axis), int(cell % cells_per_axis)): float(value)
+            for cell, value in zip(occupied, sums) if abs(value) >= 1e-9
+        }
+        self._grids[key] = grid
+        return grid
+
+    def cells(self, zoom, pin_type=None):
+        """
+        Get the occupied cells of the density grid at a zoom level.
+
+        Args:
+            zoom (float): The zoom level of the map.
+            pin_type (str, optional): The name of the pin type to count, or None for all. Defaults to None.
+
+        Returns:
+            list: The (latitude, longitude, intensity) of each cell center, with intensity
+            relative to the densest cell, between 0 and 1.
+        """
+        level = math.floor(zoom)
+        grid = self.grid(zoom, pin_type)
+        peak = max((value for value in grid.values() if value > 0), default=0)
+        if peak <= 0:
+            return []
+        result = []
+        for (column, row), value in grid.items():
+            if value <= 0:
+                continue
+            latitude, longitude = world_pixel_to_lat_lng((column + 0.5) * self.cell_px, (row + 0.5) * self.cell_px, level)
+            result.append((latitude, longitude, value / peak))
+        return result
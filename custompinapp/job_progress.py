@@ -0,0 +1,102 @@
+"""
+Background job indicator for the Custom Pins application.
+
+This module defines the JobProgress control, which shows the progress and time left of
+the background jobs run by db.jobs, with a button to cancel them. It is hidden while no
+job is queued or running.
+
+Classes:
+    JobProgress: A progress bar for the background jobs.
+"""
+import flet as ft
+import config
+
+JOB_LABELS = {
+    'delete_pin_type': "Deleting pin type",
+    'update_pin_type': "Updating pin type",
+    'import_pins': "Importing pins",
+    'deduplicate_pins': "Merging duplicates",
+    'rebuild_indexes': "Rebuilding indexes",
+}
+
+def _format_eta(seconds):
+    if seconds is None:
+        return ""
+    if seconds < 60:
+        return f" · {seconds:.0f} s left"
+    return f" · {seconds / 60:.0f} min left"
+
+class JobProgress(ft.Container):
+    """
+    A progress bar for the background jobs.
+
+    Attributes:
+        jobs (dict): The queued and running jobs by ID.
+    """
+    def __init__(self):
+        """
+        Initialize a JobProgress instance. It shows nothing until attach() is called.
+        """
+        self.bar = ft.ProgressBar(width=90, value=0, color=config.DARK_COLOR, bgcolor=config.LIGHT_COLOR)
+        self.label = ft.Text(size=12, color=config.ICON_COLOR)
+        self.cancel_button = ft.IconButton(icon=ft.icons.CLOSE, icon_size=16, icon_color=config.ICON_COLOR,
+                                           tooltip="Cancel", on_click=self._handle_cancel)
+        super().__init__(content=ft.Row([self.bar, self.label, self.cancel_button], spacing=4), visible=False)
+        self.jobs = {}
+        self._runner = None
+
+    def attach(self, runner):
+        """
+        Show the jobs of a runner.
+
+        Args:
+            runner (db.jobs.JobRunner): The runner.
+        """
+        self._runner = runner
+        for job in runner.list_jobs(active=True):
+            self.jobs[job['id']] = job
+        runner.subscribe(self._handle_job)
+        self._refresh()
+
+    def detach(self):
+        """
+        Stop showing the jobs of the attached runner.
+        """
+        if self._runner is not None:
+            self._runner.unsubscribe(self._handle_job)
+            self._runner = None
+
+    def will_unmount(self):
+        self.detach()
+
+    def _handle_job(self, job):
+        if job['status'] in ('queued', 'running'):
+            self.jobs[job['id']] = job
+        else:
+            self.jobs.pop(job['id'], None)
+        self._refresh()
+
+    def _shown_job(self):
+        # The oldest job is the one running first
+        return min(self.jobs.values(), key=lambda job: job['id'], default=None)
+
+    def _refresh(self):
+        job = self._shown_job()
+        self.visible = job is not None
+        if job is not None:
+            label = JOB_LABELS.get(job['kind'], job['kind'])
+            if job['status'] == 'queued':
+                self.bar.value = None
+                self.label.value = f"{label}: waiting"
+            else:
+                self.bar.value = job['progress']
+                self.label.value = f"{label} {job['progress']:.0%}{_format_eta(job['eta_s'])}"
+            if len(self.jobs) > 1:
+                self.label.value += f" (+{len(self.jobs) - 1})"
+        if self.page:
+            self.update()
+
+    def _handle_cancel(self, e):
+        job = self._shown_job()
+        if job is not None and self._runner is not None:
+            self._runner.cancel(job['id'])
@@ -0,0 +1,561 @@
+"""
+Load test for the Custom Pins application.
+
+This module runs simulated user sessions against main.main in a single process, without a
+browser or a network. Each session gets a real Flet page whose connection records the
+messages that would be sent to the browser instead of sending them. Sessions replay a
+random script of map moves, zooms, pin placements, pin taps, attribute edits and pin
+deletes through the page's event handlers, the way Flet runs them: on a shared thread
+pool, with the sessions interleaved.
+
+The report gives latency percentiles per operation, the number and size of the UI update
+messages, and the time spent in database queries with the number of queries that found
+the database locked.
+
+Sessions change their pins from Flet's handler threads and from the change bus at once.
+Any error showing that two threads changed the same state together, such as a dictionary
+changing size during iteration, is reported as a race, and the test then exits with
+status 1.
+
+The test runs on a database file of its own, seeded with random pins, unless one is given,
+so the app's data is never touched. Sessions share the main module, as they do in the
+server, and the report counts the sessions still alive after their pages were closed.
+
+Classes:
+    RecordingConnection: A Flet connection that records outgoing messages instead of sending them.
+    RecordingPage: A Flet page that keeps track of the event handlers it runs.
+    LoadStats: Measurements collected during a load test.
+    SimulatedSession: A user session driving main.main.
+
+Functions:
+    run(sessions=10, operations=30, seed_pins=500, database=None, think_ms=50, threads=None, seed=0): Run a load test.
+    print_report(stats): Print the results of a load test.
+
+Run with:
+    python load_test.py --sessions 20 --operations 50
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import gc
+import flet as ft
+from flet_core.control_event import ControlEvent
+from flet_core.event import Event
+from flet_core.local_connection import LocalConnection
+from flet_core.protocol import (
+    ClientActions, ClientMessage, CommandEncoder, PageCommandResponsePayload,
+    PageCommandsBatchResponsePayload, RegisterWebClientRequestPayload
+)
+
+# Relative weights of the scripted operations
+OPERATION_WEIGHTS = {
+    'move': 35,
+    'zoom': 15,
+    'place': 15,
+    'tap': 15,
+    'edit': 12,
+    'delete': 8,
+}
+
+_MEDIA = json.dumps({
+    side: {"left": 0, "top": 0, "right": 0, "bottom": 0}
+    for side in ("padding", "view_padding", "view_insets")
+})
+
+_RACE_MESSAGES = ('changed size during iteration', 'mutated during iteration')
+
+def percentile(values, q):
+    """
+    Get a percentile of a list of values, by the nearest rank.
+
+    Args:
+        values (list): The values.
+        q (float): The percentile, between 0 and 100.
+
+    Returns:
+        float: The percentile, or 0 for an empty list.
+    """
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+class RecordingConnection(LocalConnection):
+    """
+    A Flet connection that records outgoing messages instead of sending them.
+
+    Commands are processed as the Flet server processes them, so controls get IDs and the
+    recorded messages are the JSON a browser would receive.
+
+    Attributes:
+        sizes (list): The size in bytes of each message sent.
+    """
+    def __init__(self, session_id, width, height):
+        """
+        Initialize a RecordingConnection instance.
+
+        Args:
+            session_id (str): The ID of the session.
+            width (int): The width of the simulated browser window.
+            height (int): The height of the simulated browser window.
+        """
+        super().__init__()
+        self.sizes = []
+        self._client_details = RegisterWebClientRequestPayload(
+            pageName="", pageRoute="/", pageWidth=str(width), pageHeight=str(height),
+            windowWidth=str(width), windowHeight=str(height), windowTop="0", windowLeft="0",
+            isPWA="false", isWeb="true", isDebug="false", platform="linux",
+            platformBrightness="light", media=_MEDIA, sessionId=session_id,
+        )
+
+    def _record(self, message):
+        self.sizes.append(len(json.dumps(message, cls=CommandEncoder, separators=(",", ":")).encode('utf-8')))
+
+    def send_command(self, session_id, command):
+        result, message = self._process_command(command)
+        if message:
+            self._record(message)
+        return PageCommandResponsePayload(result=result, error="")
+
+    def send_commands(self, session_id, commands):
+        results = []
+        messages = []
+        for command in commands:
+            result, message = self._process_command(command)
+            if command.name in ("add", "get"):
+                results.append(result)
+            if message:
+                messages.append(message)
+        if messages:
+            self._record(ClientMessage(ClientActions.PAGE_CONTROLS_BATCH, messages))
+        return PageCommandsBatchResponsePayload(results=results, error="")
+
+class RecordingPage(ft.Page):
+    """
+    A Flet page that keeps track of the event handlers it runs.
+
+    Flet starts handlers of typed events, such as map taps, on the thread pool without
+    waiting for them. This page keeps their futures, so an operation can be timed until
+    its handlers are done.
+
+    Attributes:
+        pending (list): The futures of the handlers started and not yet awaited.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = []
+
+    def run_thread(self, handler, *args, **kwargs):
+        self.pending.append(self.loop.run_in_executor(self.executor, partial(handler, *args, **kwargs)))
+
+class LoadStats:
+    """
+    Measurements collected during a load test.
+
+    Attributes:
+        latencies (dict): The latencies in milliseconds of each operation, by operation name.
+        errors (dict): The number of failed operations, by operation name.
+        messages (dict): The sizes in bytes of the messages sent by each operation, by operation name.
+        queries (list): The duration in milliseconds of each database query.
+        locked (int): The number of queries that failed because the database was locked.
+        sessions (int): The number of sessions.
+        leaked (int): The number of sessions still alive after their pages were closed.
+        races (list): The errors raised by handlers or change bus listeners because two
+            threads changed the same state at once.
+        duration (float): The wall time of the test in seconds.
+    """
+    def __init__(self):
+        """
+        Initialize a LoadStats instance.
+        """
+        self.latencies = {}
+        self.errors = {}
+        self.messages = {}
+        self.queries = []
+        self.locked = 0
+        self.sessions = 0
+        self.leaked = 0
+        self.races = []
+        self.duration = 0.0
+
+    def record(self, name, latency_ms, message_sizes, error):
+        """
+        Record one operation.
+
+        Args:
+            name (str): The name of the operation.
+            latency_ms (float): The time the operation took, in milliseconds.
+            message_sizes (list): The sizes in bytes of the messages the operation sent.
+            error (Exception): The error the operation raised, or None.
+        """
+        self.latencies.setdefault(name, []).append(latency_ms)
+        self.messages.setdefault(name, []).append(message_sizes)
+        if error is not None:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            self.record_race(name, error)
+
+    def record_race(self, source, error):
+        """
+        Record an error if it shows that two threads changed the same state at once.
+
+        Args:
+            source (str): Where the error was raised, such as an operation name.
+            error (Exception): The error.
+        """
+        if isinstance(error, RuntimeError) and any(message in str(error) for message in _RACE_MESSAGES):
+            self.races.append(f"{source}: {error!r}")
+
+    @contextlib.contextmanager
+    def timing_queries(self, database):
+        """
+        Time every query sent to a database inside the block.
+
+        Args:
+            database (Database): The peewee database.
+        """
+        from peewee import OperationalError
+
+        execute_sql = database.execute_sql
+
+        def timed_execute_sql(sql, params=None, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return execute_sql(sql, params, *args, **kwargs)
+            except OperationalError as e:
+                if 'locked' in str(e):
+                    self.locked += 1
+                raise
+            finally:
+                self.queries.append((time.perf_counter() - started) * 1000)
+
+        database.execute_sql = timed_execute_sql
+        try:
+            yield
+        finally:
+            del database.execute_sql
+
+def _descendants(control):
+    for child in control._get_children():
+        yield child
+        yield from _descendants(child)
+
+class SimulatedSession:
+    """
+    A user session driving main.main.
+
+    Attributes:
+        number (int): The number of the session.
+        page (ft.Page): The page of the session.
+        session (session.Session): The state of the page, once started.
+    """
+    def __init__(self, number, stats, loop, executor, rng, width=1280, height=800):
+        """
+        Initialize a SimulatedSession instance.
+
+        Args:
+            number (int): The number of the session.
+            stats (LoadStats): Where the measurements are recorded.
+            loop (asyncio.AbstractEventLoop): The event loop running the sessions.
+            executor (ThreadPoolExecutor): The thread pool running the event handlers.
+            rng (random.Random): The random generator of the script.
+            width (int, optional): The width of the simulated browser window. Defaults to 1280.
+            height (int, optional): The height of the simulated browser window. Defaults to 800.
+        """
+        self.number = number
+        self.stats = stats
+        self.loop = loop
+        self.executor = executor
+        self.rng = rng
+        session_id = f"load-test-{number}"
+        self.connection = RecordingConnection(session_id, width, height)
+        self.page = RecordingPage(self.connection, session_id, loop=loop, executor=executor)
+        self.session = None
+
+    async def _measure(self, name, operation):
+        sent = len(self.connection.sizes)
+        started = time.perf_counter()
+        error = None
+        try:
+            await operation
+        except Exception as e:
+            error = e
+            print(f"Session {self.number}: {name} failed: {e!r}", file=sys.stderr)
+        self.stats.record(name, (time.perf_counter() - started) * 1000, self.connection.sizes[sent:], error)
+
+    async def _fire(self, control, event_name, data=""):
+        # Dispatch an event as Page.on_event_async does, but wait for the handlers to finish
+        handler = control.event_handlers.get(event_name)
+        if handler is None:
+            return
+        event = ControlEvent(control.uid, event_name, data, control, self.page)
+        if asyncio.iscoroutinefunction(handler):
+            await handler(event)
+        else:
+            await self.loop.run_in_executor(self.executor, handler, event)
+        while self.page.pending:
+            await self.page.pending.pop(0)
+
+    async def _set_value(self, control, value):
+        # The browser reports edited values as a page change event
+        props = json.dumps([{"i": control.uid, "value": value}])
+        await self.page.on_event_async(Event("page", "change", props))
+
+    def _center(self):
+        center = self.session.last_center or self.session.page_map.configuration.initial_center
+        return center.latitude, center.longitude
+
+    def _map_event(self, source, latitude, longitude, zoom):
+        return json.dumps({
+            "src": source, "c_lat": latitude, "c_long": longitude,
+            "zoom": zoom, "min_zoom": None, "max_zoom": None, "rot": 0,
+        })
+
+    def _marker_overlay(self):
+        marker_overlay = sys.modules.get('marker_overlay')
+        if marker_overlay is None:
+            return None
+        for control in self.page.overlay:
+            content = getattr(control, 'content', None)
+            # Closed overlays are hidden and kept for the next pin
+            if control.visible is not False and isinstance(content, marker_overlay.MarkerOverlay):
+                return content
+        return None
+
+    async def start(self):
+        """
+        Connect the page and run main.main on it.
+        """
+        await self.page.fetch_page_details_async()
+        import main
+
+        async def start_main():
+            self.session = await main.main(self.page)
+
+        await self._measure('start', start_main())
+
+    async def close(self):
+        """
+        Close the page, as the server does when the browser disconnects.
+        """
+        await self.page.on_event_async(Event("page", "close", ""))
+        while self.page.pending:
+            await self.page.pending.pop(0)
+        self.page._close()
+
+    async def move(self):
+        latitude, longitude = self._center()
+        span = 360 / 2 ** self.session.current_zoom
+        data = self._map_event(
+            "dragEnd",
+            max(-80, min(80, latitude + self.rng.uniform(-span, span) / 2)),
+            longitude + self.rng.uniform(-span, span),
+            self.session.current_zoom,
+        )
+        await self._measure('move', self._fire(self.session.page_map.configuration, "event", data))
+
+    async def zoom(self):
+        latitude, longitude = self._center()
+        zoom = max(3, min(18, self.session.current_zoom + self.rng.choice((-1, 1))))
+        data = self._map_event("scrollWheel", latitude, longitude, zoom)
+        await self._measure('zoom', self._fire(self.session.page_map.configuration, "event", data))
+
+    async def place(self):
+        view = self.page.views[-1]
+        await self._measure('place', self._fire(view.floating_action_button, "click"))
+
+    async def tap(self):
+        with self.session.lock:
+            pins = list(self.session.loaded_pins)
+        if pins:
+            pin = self.rng.choice(pins)
+            latitude, longitude = pin['latitude'], pin['longitude']
+        else:
+            latitude, longitude = self._center()
+        data = json.dumps({"lat": latitude, "long": longitude, "gx": 0, "gy": 0})
+        await self._measure('tap', self._fire(self.session.page_map.configuration, "tap", data))
+        return self._marker_overlay()
+
+    async def edit(self):
+        overlay = self._marker_overlay() or await self.tap()
+        if overlay is None:
+            return
+        from marker_overlay import Attribute
+
+        attributes = [control for control in _descendants(overlay) if isinstance(control, Attribute) and control.editable]
+        if not attributes:
+            return
+        attribute = self.rng.choice(attributes)
+
+        def button(handler):
+            return next(control for control in _descendants(attribute) if getattr(control, 'on_click', None) == handler)
+
+        async def edit_attribute():
+            await self._fire(button(attribute.edit_clicked), "click")
+            if attribute.attribute_type != 'date':
+                # The edit view is built by the click; dates are edited in a date picker instead
+                await self._set_value(attribute.edit_field, f"session {self.number} {self.rng.randrange(10 ** 6)}")
+                await self._fire(button(attribute.save_clicked), "click")
+
+        await self._measure('edit', edit_attribute())
+
+    async def delete(self):
+        overlay = self._marker_overlay() or await self.tap()
+        if overlay is None:
+            return
+        await self._measure('delete', self._fire(overlay.delete_button, "click"))
+
+    async def replay(self, operations, think_ms):
+        """
+        Run a random script of operations.
+
+        Args:
+            operations (int): The number of operations.
+            think_ms (float): The mean pause between operations, in milliseconds.
+        """
+        names = list(OPERATION_WEIGHTS)
+        weights = list(OPERATION_WEIGHTS.values())
+        for name in self.rng.choices(names, weights, k=operations):
+            await asyncio.sleep(self.rng.expovariate(1000 / think_ms) if think_ms > 0 else 0)
+            await getattr(self, name)()
+
+def _seed(pins_crud, count, rng):
+    pin_type = pins_crud.get_pin_type_by_name("Default")
+    with pins_crud.database.atomic():
+        for n in range(count):
+            fields = {field['name']: f"seed {n}" if field['field_type'] == 'string' else "" for field in pin_type['fields']}
+            pins_crud.add_pin("Default", rng.gauss(15, 4), rng.gauss(9, 6), fields)
+
+async def _run_sessions(stats, sessions, operations, think_ms, threads, seed):
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(threads) as executor:
+        simulated = [
+            SimulatedSession(n, stats, loop, executor, random.Random(seed * 1000003 + n))
+            for n in range(sessions)
+        ]
+
+        async def session(simulated_session):
+            await simulated_session.start()
+            await simulated_session.replay(operations, think_ms)
+            await simulated_session.close()
+
+        await asyncio.gather(*(session(s) for s in simulated))
+        del simulated
+    from session import sessions as live_sessions
+    gc.collect()
+    stats.leaked = len(live_sessions)
+
+def run(sessions=10, operations=30, seed_pins=500, database=None, think_ms=50, threads=None, seed=0, verbose=False):
+    """
+    Run a load test.
+
+    Must be called before the database module is imported, since the database file is
+    chosen when it is.
+
+    Args:
+        sessions (int, optional): The number of simultaneous sessions. Defaults to 10.
+        operations (int, optional): The number of operations of each session. Defaults to 30.
+        seed_pins (int, optional): The number of random pins added to a new database. Defaults to 500.
+        database (str, optional): The database file to use, or ":memory:" for an in-memory
+            database. Defaults to a new temporary file.
+        think_ms (float, optional): The mean pause between the operations of a session, in milliseconds. Defaults to 50.
+        threads (int, optional): The size of the event handler thread pool. Defaults to Flet's default.
+        seed (int, optional): The seed of the random scripts. Defaults to 0.
+        verbose (bool, optional): Whether to show the output of the app. Defaults to False.
+
+    Returns:
+        LoadStats: The measurements.
+    """
+    if 'db.db' in sys.modules:
+        raise RuntimeError("The load test must choose the database before it is imported.")
+
+    stats = LoadStats()
+    stats.sessions = sessions
+    rng = random.Random(seed)
+    with contextlib.ExitStack() as stack:
+        if database is None:
+            database = os.path.join(stack.enter_context(tempfile.TemporaryDirectory()), 'load_test.db')
+        elif database != ':memory:':
+            seed_pins = 0
+        os.environ['CUSTOMPINS_DB'] = database
+        if not verbose:
+            stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+
+        import db.crud as pins_crud
+        from db.write_behind import pin_edits
+        from db.change_bus import change_bus
+
+        _seed(pins_crud, seed_pins, rng)
+        change_bus.on_error = lambda listener, error: stats.record_race('change bus', error)
+        try:
+            with stats.timing_queries(pins_crud.database):
+                started = time.perf_counter()
+                asyncio.run(_run_sessions(stats, sessions, operations, think_ms, threads, seed))
+                pin_edits.flush()
+                stats.duration = time.perf_counter() - started
+        finally:
+            change_bus.on_error = None
+        pins_crud.database.close_all()
+    return stats
+
+def print_report(stats):
+    """
+    Print the results of a load test.
+
+    Args:
+        stats (LoadStats): The measurements.
+    """
+    total = sum(len(latencies) for latencies in stats.latencies.values())
+    print(f"{stats.sessions} sessions, {total} operations in {stats.duration:.1f} s ({total / max(stats.duration, 1e-9):.1f} operations/s)")
+    print()
+    print(f"  {'operation':<10} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'msgs/op':>8} {'KB/op':>8}")
+    for name, latencies in stats.latencies.items():
+        messages = stats.messages[name]
+        per_op_count = sum(len(sizes) for sizes in messages) / len(messages)
+        per_op_kb = sum(sum(sizes) for sizes in messages) / len(messages) / 1024
+        print(
+            f"  {name:<10} {len(latencies):>6} {stats.errors.get(name, 0):>6}"
+            f" {percentile(latencies, 50):>9.1f} {percentile(latencies, 90):>9.1f}"
+            f" {percentile(latencies, 99):>9.1f} {max(latencies):>9.1f}"
+            f" {per_op_count:>8.1f} {per_op_kb:>8.1f}"
+        )
+    sizes = [size for messages in stats.messages.values() for op_sizes in messages for size in op_sizes]
+    print()
+    print(f"UI updates: {len(sizes)} messages, {sum(sizes) / 1024:.1f} KB,"
+          f" p50 {percentile(sizes, 50)} B, p95 {percentile(sizes, 95)} B, max {max(sizes, default=0)} B")
+    print(f"Database: {len(stats.queries)} queries, {sum(stats.queries) / 1000:.2f} s in total,"
+          f" p50 {percentile(stats.queries, 50):.2f} ms, p99 {percentile(stats.queries, 99):.2f} ms,"
+          f" max {max(stats.queries, default=0):.1f} ms, {stats.locked} locked")
+    print(f"Sessions alive after closing: {stats.leaked}")
+    print(f"Races between threads: {len(stats.races)}")
+    for race in stats.races[:10]:
+        print(f"  {race}")
+    from db.pin_cache import pin_details
+    cache = pin_details.stats()
+    print(f"Pin cache: {cache['hits']} hits, {cache['misses']} misses ({cache['hit_rate']:.0%}),"
+          f" {cache['invalidations']} invalidations, {cache['evictions']} evictions")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test main.main with simulated sessions.")
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--operations', type=int, default=30, help="operations per session")
+    parser.add_argument('--seed-pins', type=int, default=500, help="random pins added to the new database")
+    parser.add_argument('--database', help="database file to use instead of a new one, whose data is changed, or :memory:")
+    parser.add_argument('--think-ms', type=float, default=50, help="mean pause between operations")
+    parser.add_argument('--threads', type=int, help="event handler threads")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="show the output of the app")
+    args = parser.parse_args()
+    stats = run(args.sessions, args.operations, args.seed_pins, args.database, args.think_ms, args.threads, args.seed, args.verbose)
+    print_report(stats)
+    if stats.races:
+        sys.exit(1)
@@ -0,0 +1,247 @@
+"""
+Location service for the Custom Pins application.
+
+This module finds and follows the position of the device without blocking the event loop.
+Every call to the device is awaited, and the last fix is kept with the time it arrived and
+its accuracy. Finding the device answers at once from a recent fix, or from the position
+the device already knows, and refines it with a precise fix in the background. Tracking
+follows the device's position updates and moves the camera at most once per interval.
+
+Callbacks receive a LocationFix and run in a worker thread, like the app's other event
+handlers, so they can query the database and update the page.
+
+Classes:
+    LocationFix: A position reported by the device.
+    LocationService: Finds and follows the position of the device.
+"""
+import asyncio
+import time
+import flet as ft
+from geo import ground_distance
+import config
+
+class LocationFix:
+    """
+    A position reported by the device.
+
+    Attributes:
+        latitude (float): The latitude of the position.
+        longitude (float): The longitude of the position.
+        accuracy (float): The accuracy of the position in meters, or None if unknown.
+        received_at (float): The time.monotonic() time the position arrived.
+    """
+    __slots__ = ('latitude', 'longitude', 'accuracy', 'received_at')
+
+    def __init__(self, latitude, longitude, accuracy=None, received_at=None):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.accuracy = accuracy
+        self.received_at = time.monotonic() if received_at is None else received_at
+
+    @property
+    def age(self):
+        """
+        float: The number of seconds since the position arrived.
+        """
+        return time.monotonic() - self.received_at
+
+    def __repr__(self):
+        return f"LocationFix({self.latitude}, {self.longitude}, accuracy={self.accuracy})"
+
+class LocationService:
+    """
+    Finds and follows the position of the device.
+
+    The geolocator control must be added to the page before the service is used.
+
+    Attributes:
+        page (ft.Page): The page the service runs on.
+        geolocator (ft.Geolocator): The control that talks to the device.
+        last_fix (LocationFix): The last position of the device, or None.
+        tracking (bool): Whether the camera follows the position updates.
+        max_age (float): The age in seconds up to which a fix answers without refinement.
+        good_accuracy_m (float): The accuracy in meters above which a fix is refined.
+        min_interval (float): The minimum number of seconds between camera moves while tracking.
+        min_move_m (float): The distance in meters below which a new fix does not move the camera.
+    """
+    def __init__(self, page, max_age=config.LOCATION_MAX_AGE_S, good_accuracy_m=config.LOCATION_GOOD_ACCURACY_M,
+                 min_interval=config.TRACKING_MIN_INTERVAL_S, min_move_m=config.TRACKING_MIN_MOVE_M):
+        """
+        Initialize a LocationService instance.
+
+        Args:
+            page (ft.Page): The page the service runs on.
+            max_age (float, optional): Defaults to config.LOCATION_MAX_AGE_S.
+            good_accuracy_m (float, optional): Defaults to config.LOCATION_GOOD_ACCURACY_M.
+            min_interval (float, optional): Defaults to config.TRACKING_MIN_INTERVAL_S.
+            min_move_m (float, optional): Defaults to config.TRACKING_MIN_MOVE_M.
+        """
+        self.page = page
+        self.geolocator = ft.Geolocator(on_error=self._handle_error)
+        self.last_fix = None
+        self.tracking = False
+        self.max_age = max_age
+        self.good_accuracy_m = good_accuracy_m
+        self.min_interval = min_interval
+        self.min_move_m = min_move_m
+        self._permission_granted = False
+        self._refining = None
+        self._refine_callbacks = []
+        self._on_move = None
+        self._moved_to = None
+        self._moved_at = 0.0
+        self._trailing_move = None
+
+    async def locate(self, on_fix):
+        """
+        Find the position of the device.
+
+        on_fix is called at once with a recent fix, or with the position the device already
+        knows. If that fix is old, imprecise or missing, a precise fix is requested in the
+        background, and on_fix is called again when it arrives unless it is within
+        min_move_m of the first one.
+
+        Args:
+            on_fix (function): Function called with each LocationFix.
+
+        Returns:
+            LocationFix: The fix answered at once, or None if there is none yet or the
+            permission was denied.
+        """
+        if not await self._ensure_permission():
+            print("Location permission denied.")
+            return None
+
+        fix = self.last_fix
+        if fix is None or fix.age > self.max_age:
+            # The position the device already knows is instant, but may be old
+            fix = await self._last_known_fix()
+            stale = True
+        else:
+            # Fixes from tracking have no accuracy, but are taken at high accuracy
+            stale = fix.accuracy is not None and fix.accuracy > self.good_accuracy_m
+
+        if fix is not None:
+            self._dispatch(on_fix, fix)
+        if fix is None or stale:
+            self._refine(on_fix, fix)
+        return fix
+
+    async def start_tracking(self, on_move):
+        """
+        Follow the position updates of the device.
+
+        Args:
+            on_move (function): Function called with the LocationFix to move the camera to.
+
+        Returns:
+            bool: Whether tracking started; False if the permission was denied.
+        """
+        if not await self._ensure_permission():
+            print("Location permission denied.")
+            return False
+        self._on_move = on_move
+        self._moved_to = None
+        self._moved_at = 0.0
+        self.tracking = True
+        self.geolocator.location_settings = ft.GeolocatorSettings(
+            accuracy=ft.GeolocatorPositionAccuracy.HIGH,
+            distance_filter=config.TRACKING_DISTANCE_FILTER_M,
+        )
+        self.geolocator.on_position_change = self._handle_position_change
+        self.geolocator.update()
+        return True
+
+    def stop_tracking(self):
+        """
+        Stop following the position updates of the device.
+        """
+        self.tracking = False
+        self._on_move = None
+        self.geolocator.on_position_change = None
+        self.geolocator.location_settings = None
+        self.geolocator.update()
+
+    async def _ensure_permission(self):
+        if self._permission_granted:
+            return True
+        status = await self.geolocator.get_permission_status_async()
+        if status in (ft.GeolocatorPermissionStatus.DENIED, ft.GeolocatorPermissionStatus.DENIED_FOREVER):
+            status = await self.geolocator.request_permission_async()
+        self._permission_granted = status in (ft.GeolocatorPermissionStatus.WHILE_IN_USE, ft.GeolocatorPermissionStatus.ALWAYS)
+        return self._permission_granted
+
+    async def _last_known_fix(self):
+        if self.page.web:
+            return None
+        try:
+            position = await self.geolocator.get_last_known_position_async(wait_timeout=config.LOCATION_TIMEOUT_S)
+        except Exception as e:
+            print(f"Error: {e}")
+            return None
+        if position.latitude is None or position.longitude is None:
+            return None
+        return LocationFix(position.latitude, position.longitude, position.accuracy)
+
+    def _refine(self, on_fix, shown):
+        self._refine_callbacks.append((on_fix, shown))
+        # Callers waiting at the same time share one request
+        if self._refining is None:
+            self._refining = self.page.run_task(self._refine_async)
+
+    async def _refine_async(self):
+        fix = None
+        try:
+            position = await self.geolocator.get_current_position_async(
+                location_settings=ft.GeolocatorSettings(accuracy=ft.GeolocatorPositionAccuracy.BEST_FOR_NAVIGATION),
+                wait_timeout=config.LOCATION_TIMEOUT_S,
+            )
+            fix = self._store(position.latitude, position.longitude, position.accuracy)
+        except Exception as e:
+            print(f"Error: {e}")
+        finally:
+            callbacks, self._refine_callbacks = self._refine_callbacks, []
+            self._refining = None
+        if fix is None:
+            return
+        for on_fix, shown in callbacks:
+            if shown is None or ground_distance(shown.latitude, shown.longitude, fix.latitude, fix.longitude) >= self.min_move_m:
+                self._dispatch(on_fix, fix)
+
+    async def _handle_position_change(self, e):
+        fix = self._store(e.latitude, e.longitude)
+        if fix is None or self._on_move is None:
+            return
+        moved_to = self._moved_to
+        if moved_to is not None and ground_distance(moved_to.latitude, moved_to.longitude, fix.latitude, fix.longitude) < self.min_move_m:
+            return
+        wait = self.min_interval - (time.monotonic() - self._moved_at)
+        if wait > 0:
+            # The latest fix is shown once the interval has passed
+            if self._trailing_move is None:
+                self._trailing_move = self.page.run_task(self._move_later, wait)
+            return
+        self._move(fix)
+
+    async def _move_later(self, delay):
+        await asyncio.sleep(delay)
+        self._trailing_move = None
+        if self._on_move is not None and self.last_fix is not self._moved_to:
+            self._move(self.last_fix)
+
+    def _move(self, fix):
+        self._moved_to = fix
+        self._moved_at = time.monotonic()
+        self._dispatch(self._on_move, fix)
+
+    def _store(self, latitude, longitude, accuracy=None):
+        if latitude is None or longitude is None:
+            return None
+        self.last_fix = LocationFix(latitude, longitude, accuracy)
+        return self.last_fix
+
+    def _dispatch(self, callback, fix):
+        self.page.run_thread(callback, fix)
+
+    def _handle_error(self, e):
+        print(f"Location error: {e.data}")
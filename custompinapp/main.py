@@ -2,20 +2,37 @@
 Main module for the Custom Pins application.
 
 This module initializes the Flet application and sets up the main page with various components and functionalities.
+The state of each page is kept in a session.Session, so one process can serve many pages.
+Handlers send only the controls they changed, in one message, through the session's
+ui_updates.UpdateScheduler; the whole page is only sent when it is first shown.
+The database and the rarely used overlays are loaded after the first frame is sent. Set
+CUSTOMPINS_PROFILE_STARTUP=1 to print how long each startup phase takes.
 
 Functions:
     main(page: ft.Page): Asynchronous function to initialize the main page of the application.
 """
 
+import startup_profiler as profiler
 from time import sleep
-import flet as ft
-import flet_core.map as map
+with profiler.timed("import flet"):
+    import flet as ft
+    import flet_core.map as map
+import math
 import random
-from create_pin_type_overlay import CreatePinTypeOverlay
-from marker_overlay import MarkerOverlay
-import db.crud as pins_crud
-from map_overlay import DotOverlay, update_dot_position
-import config
+with profiler.timed("import app modules"):
+    from map_overlay import DotOverlay, OverlayPanel, update_dot_position
+    from pin_layers import pin_render_mode, build_pin_circle, build_heat_circles, copy_circle, reuse_controls, HEATMAP, CIRCLES
+    from session import Session
+    from map_camera import move_camera
+    from geo import viewport_bounds, fit_bounds
+    from pin_type_menu import PinTypeMenu
+    from location import LocationService
+    from job_progress import JobProgress
+    import config
+
+pins_repository = None  # The db.repository storage, opened once the first frame is on screen
+pins_jobs = None  # db.jobs, imported with the repository
+pins_changes = None  # db.change_bus, imported with the repository
 
 async def main(page: ft.Page):
     """
@@ -23,18 +40,49 @@ async def main(page: ft.Page):
 
     Args:
         page (ft.Page): The main page object provided by Flet.
+
+    Returns:
+        Session: The state of the page, closed when the page is closed.
     """
-    global last_center
-    last_center = None
+    # Everything the page shows lives in its session, so sessions never share state
+    global pins_repository, pins_jobs, pins_changes
+    session = Session(page)
+    loaded_pins = session.loaded_pins
+    heatmap = session.heatmap
+    ui = session.ui
     dot_overlay = DotOverlay()
-    global selected_pin_type
-    pin_types = pins_crud.get_all_pin_types()
-    selected_pin_type = pin_types[0]
+    # Panels stay in the overlay and are hidden when closed, so the dot is never rebuilt
+    panel_shadow = ft.BoxShadow(
+        spread_radius=0.5,
+        blur_radius=5,
+        color=ft.colors.BLACK,
+        offset=ft.Offset(0, 0),
+        blur_style=ft.ShadowBlurStyle.NORMAL,
+    )
+    marker_panel = OverlayPanel(
+        padding=5,
+        bgcolor=config.SECONDARY_COLOR,
+        alignment=ft.alignment.center,
+        border_radius=ft.border_radius.all(10),
+        shadow=panel_shadow,
+    )
+    pin_type_panel = OverlayPanel(
+        padding=5,
+        bgcolor=config.SECONDARY_COLOR,
+        alignment=ft.alignment.center,
+        border_radius=ft.border_radius.all(10),
+        margin=ft.margin.symmetric(horizontal=10, vertical=30),
+        #border=ft.border.all(width=2, color=config.SECONDARY_DARK_COLOR),
+        shadow=panel_shadow,
+    )
     
     class CustomMarker(map.Marker):
         """
         Custom marker class for the map.
 
+        Markers carry no click handler of their own; taps are resolved by the map's
+        tap handler through the spatial index.
+
         Attributes:
             coordinates (map.MapLatitudeLongitude): The coordinates of the marker.
             id (int): The unique identifier of the marker.
@@ -46,65 +94,251 @@ async def main(page: ft.Page):
             self.color = color
             self.coordinates = coordinates
             self.id = id
-            self.content = ft.IconButton('add_location',on_click=self.handle_marker_click, icon_color=self.color)
-            
-        def handle_marker_click(self, e):
+            self.content = ft.Icon('add_location', color=self.color)
+
+        def __str__(self):
+            return f"CustomMarker({self.coordinates})"
+
+        def copy_from(self, other):
             """
-            Handle the click event on a marker.
-            Parameters:
-            - e: The event object representing the click event.
-            Returns:
-            None
+            Make this marker show the pin of another one, so it can be reused.
+
+            Args:
+                other (CustomMarker): The marker to copy.
             """
-            
-            if page.width > page.height:
-                margem = ft.margin.symmetric(horizontal=page.width/4, vertical=page.height/6)                
-            else:
-                margem = ft.margin.symmetric(horizontal=page.width/10, vertical=page.height/6)               
-
-            page.overlay.clear()
-            page.overlay.append(
-                ft.Container(
-                    content=MarkerOverlay(page,self.coordinates,self.id, load_pins=load_pins),
-                    padding=5,
-                    #width=relative_width,
-                    #height=relative_height,
-                    bgcolor=config.SECONDARY_COLOR,
-                    alignment=ft.alignment.center,
-                    border_radius=ft.border_radius.all(10),
-                    margin=margem,
-                    shadow=ft.BoxShadow(
-                        spread_radius=0.5,
-                        blur_radius=5,
-                        color=ft.colors.BLACK,
-                        offset=ft.Offset(0, 0),
-                        blur_style=ft.ShadowBlurStyle.NORMAL,
-                    ),
-                )
-            )
+            self.coordinates = other.coordinates
+            self.id = other.id
+            self.color = other.color
+            self.content.color = other.color
+        
+    def open_marker_overlay(coordinates, pin_id):
+        """
+        Open the marker overlay for a pin.
+
+        Args:
+            coordinates (map.MapLatitudeLongitude): The coordinates of the pin.
+            pin_id (int): The unique identifier of the pin.
+        """
+        from marker_overlay import MarkerOverlay  # Only needed once a pin is opened
 
-            page.update()
+        if page.width > page.height:
+            margem = ft.margin.symmetric(horizontal=page.width/4, vertical=page.height/6)                
+        else:
+            margem = ft.margin.symmetric(horizontal=page.width/10, vertical=page.height/6)               
 
+        if session.marker_overlay is None:
+            session.marker_overlay = MarkerOverlay(page, coordinates, pin_id, on_deleted=handle_pin_deleted, on_close=close_marker_overlay)
+        else:
+            # The rows of the last pin are reused, so only changed values are sent
+            session.marker_overlay.show_pin(coordinates, pin_id)
+        pin_type_panel.hide()
+        marker_panel.show(session.marker_overlay, margin=margem)
+        ui.update(marker_panel, pin_type_panel)
 
-        def __str__(self):
-            return f"CustomMarker({self.coordinates})"
-        
-    def load_pins():
-        print("Loading pins...")
-        marker_layer_ref.current.markers.clear()
-        pins = pins_crud.get_all_pins()
+    @ui.batched
+    def close_marker_overlay():
+        marker_panel.hide()
+        ui.update(marker_panel)
+
+    @ui.batched
+    def handle_pin_deleted(pin_id):
+        """
+        Remove a pin deleted from its overlay from the map, and close the overlay.
+
+        Args:
+            pin_id (int): The ID of the pin.
+        """
+        erase_pins([pin_id])
+        handle_pin_types_changed()
+        close_marker_overlay()
+
+    def is_visible(pin):
+        """
+        Check whether a loaded pin passes the timeline filter.
+
+        Args:
+            pin (dict): The pin.
+
+        Returns:
+            bool: Whether the pin is shown.
+        """
+        return session.time_window is None or pin["id"] in session.time_window
+
+    def visible_pins():
+        """
+        Get the loaded pins that pass the timeline filter.
+
+        Returns:
+            iterable: The pins.
+        """
+        if session.time_window is None:
+            return loaded_pins
+        return [pin for pin in loaded_pins if pin["id"] in session.time_window]
+
+    def visible_count():
+        if session.time_window is None:
+            return len(loaded_pins)
+        return sum(1 for pin in loaded_pins if pin["id"] in session.time_window)
+
+    def render_pins():
+        """
+        Draw the visible pins as markers, on dense or zoomed out maps as circles, and at
+        country zoom as a density heatmap.
+
+        The markers and circles already drawn are reused, so only what changed is sent.
+        """
+        pins = visible_pins()
+        session.render_mode = pin_render_mode(len(pins), session.current_zoom)
+        markers = []
+        circles = []
+        if session.render_mode == HEATMAP:
+            # Cached per zoom level, so this costs one circle per occupied cell
+            circles = build_heat_circles(heatmap.cells(session.current_zoom))
+        elif session.render_mode == CIRCLES:
+            circles = [build_pin_circle(pin) for pin in pins]
+        else:
+            markers = [CustomMarker(map.MapLatitudeLongitude(pin["latitude"], pin["longitude"]), pin["id"], pin['color']) for pin in pins]
+        marker_layer = session.marker_layer_ref.current
+        circle_layer = session.circle_layer_ref.current
+        reuse_controls(marker_layer.markers, markers, lambda marker: marker.id, CustomMarker.copy_from)
+        reuse_controls(circle_layer.circles, circles, lambda circle: (circle.coordinates.latitude, circle.coordinates.longitude),
+                       copy_circle)
+        ui.update(marker_layer, circle_layer)
+
+    def draw_new_pins(pins):
+        """
+        Add pins that were just loaded or created to the map.
+
+        Args:
+            pins (list): The pins to draw.
+        """
+        pins = [pin for pin in pins if is_visible(pin)]
         for pin in pins:
+            heatmap.add(pin)
+        if session.render_mode == HEATMAP or pin_render_mode(visible_count(), session.current_zoom) != session.render_mode:
+            render_pins()
+            return
+        for pin in pins:
+            draw_pin(pin)
+        if pins:
+            ui.update(session.circle_layer_ref.current if session.render_mode == CIRCLES else session.marker_layer_ref.current)
+
+    def erase_pins(pin_ids):
+        """
+        Remove pins from the loaded pins and from the map. Only their markers are removed,
+        unless the rendering mode changes or the map shows the heatmap.
+
+        Args:
+            pin_ids (iterable): The IDs of the pins.
+
+        Returns:
+            bool: Whether any of the pins was loaded.
+        """
+        removed = set()
+        for pin_id in pin_ids:
+            if loaded_pins.remove(pin_id) is not None:
+                heatmap.remove(pin_id)
+                removed.add(pin_id)
+        if not removed:
+            return False
+        if session.render_mode == HEATMAP or pin_render_mode(visible_count(), session.current_zoom) != session.render_mode:
+            render_pins()
+        elif session.render_mode == CIRCLES:
+            circle_layer = session.circle_layer_ref.current
+            circle_layer.circles[:] = [circle for circle in circle_layer.circles if circle.data not in removed]
+            ui.update(circle_layer)
+        else:
+            marker_layer = session.marker_layer_ref.current
+            marker_layer.markers[:] = [marker for marker in marker_layer.markers if marker.id not in removed]
+            ui.update(marker_layer)
+        return True
+
+    def draw_pin(pin):
+        """
+        Add a single pin to the layer used by the current rendering mode.
+
+        Args:
+            pin (dict): The pin to draw.
+        """
+        if session.render_mode == CIRCLES:
+            session.circle_layer_ref.current.circles.append(build_pin_circle(pin))
+        else:
             coordinates = map.MapLatitudeLongitude(pin["latitude"], pin["longitude"])
-            id = pin["id"]
-            marker = CustomMarker(coordinates, id, pin['color'])
-            marker_layer_ref.current.markers.append(marker)
+            session.marker_layer_ref.current.markers.append(CustomMarker(coordinates, pin["id"], pin['color']))
 
+    @ui.batched
+    def load_pins():
+        print("Loading pins...")
+        loaded_pins.clear()
+        for pin in pins_repository.get_all_pins():
+            loaded_pins.insert(pin)
+        if session.time_window is not None:
+            session.time_window.reload()
+        heatmap.load(visible_pins())
+        render_pins()
+        # Pin counts in the menu may have changed
+        handle_pin_types_changed()
         print("Loaded pins!")
-        page.update()
+
+    @ui.batched
+    def handle_changes(changes):
+        """
+        Bring the map up to date with the pins changed by any session, in this process or
+        in another one serving the same database.
+
+        Args:
+            changes (dict): The changes read by db.change_bus.
+        """
+        if changes["pin_types"]:
+            # Pin type changes can recolor or remove any pin
+            load_pins()
+            return
+        erased = erase_pins(changes["deleted"])
+        redraw = False
+        new_pins = []
+        for pin in changes["pins"]:
+            previous = loaded_pins.get(pin["id"])
+            loaded_pins.insert(pin)
+            if previous is None:
+                new_pins.append(pin)
+            elif (previous["latitude"], previous["longitude"]) != (pin["latitude"], pin["longitude"]):
+                heatmap.add(pin)
+                redraw = True
+        if session.time_window is not None and changes["pins"]:
+            # New dates can show or hide any of the changed pins
+            session.time_window.refresh([pin["id"] for pin in changes["pins"]])
+            heatmap.load(visible_pins())
+            redraw = True
+
+        if redraw:
+            if session.time_window is None:
+                for pin in new_pins:
+                    heatmap.add(pin)
+            render_pins()
+        elif new_pins:
+            draw_new_pins(new_pins)
+        elif not erased:
+            # Only field values changed, which the map does not show
+            return
+        handle_pin_types_changed()
+
+    def load_pins_in_view(latitude, longitude, zoom):
+        """
+        Load the pins visible around a center that are not on the map yet.
+
+        Args:
+            latitude (float): The latitude of the viewport center.
+            longitude (float): The longitude of the viewport center.
+            zoom (float): The zoom level of the viewport.
+        """
+        south, west, north, east = viewport_bounds(latitude, longitude, zoom, page.width, page.height)
+        new_pins = [pin for pin in pins_repository.get_pins_in_bounds(south, west, north, east) if loaded_pins.get(pin["id"]) is None]
+        for pin in new_pins:
+            loaded_pins.insert(pin)
+        draw_new_pins(new_pins)
         
-    global gl
-    gl = ft.Geolocator()
-    page.add(gl)
+    location = LocationService(page)
+    page.add(location.geolocator)
 
     # Create dot overlay with initial position
     def update_dot_event(e):
@@ -116,11 +350,16 @@ async def main(page: ft.Page):
         """
         print("update dot position")
         update_dot_position(page, dot_overlay)
+        ui.update(dot_overlay)
 
+    @ui.batched
     def place_pin(type,lat,lng,fields, color = "ff0000"):
         """
         Add a new pin to the database and place a marker on the map.
 
+        A pin placed on top of a pin of the same type is merged into it, and the existing
+        pin is opened instead.
+
         Args:
             type (str): The type of the pin.
             lat (float): The latitude of the pin.
@@ -129,10 +368,25 @@ async def main(page: ft.Page):
             color (str, optional): The color of the pin marker. Defaults to "ff0000".
         """
         # Add a new pin to the database
-        pin = pins_crud.add_pin(type,lat,lng,fields)
+        pin = pins_repository.add_pin(type,lat,lng,fields, on_duplicate="merge", duplicate_distance_m=config.DUPLICATE_PIN_DISTANCE_M)
+        if loaded_pins.get(pin.id) is not None:
+            open_marker_overlay(map.MapLatitudeLongitude(pin.latitude, pin.longitude), pin.id)
+            return
+        pin_data = {
+            "id": pin.id,
+            "pin_type": pin.pin_type.name,
+            "latitude": pin.latitude,
+            "longitude": pin.longitude,
+            "color": pin.pin_type.color,
+            "style": pin.pin_type.style,
+            "fields": fields,
+        }
+        loaded_pins.insert(pin_data)
+        if session.time_window is not None:
+            session.time_window.refresh([pin.id])
         # Add a new marker to the map
-        marker_layer_ref.current.markers.append(CustomMarker(map.MapLatitudeLongitude(pin.latitude, pin.longitude), pin.id,pin.pin_type.color))
-        page.update()
+        draw_new_pins([pin_data])
+        handle_pin_types_changed()
             
     def generate_empty_fields():
         """
@@ -141,13 +395,13 @@ async def main(page: ft.Page):
         Returns:
             dict: A dictionary with field names as keys and empty strings as values.
         """
-        global selected_pin_type
-        fields = pins_crud.get_pin_type_by_name(selected_pin_type['name'])['fields']
+        fields = pins_repository.get_pin_type_by_name(session.selected_pin_type['name'])['fields']
         empty_fields = {}
         for field in fields:
             empty_fields[field['name']] = ""
         return empty_fields
         
+    @ui.batched
     def place_marker_at_center(e):
         """
         Place a marker at the center of the map with the selected pin type.
@@ -155,28 +409,53 @@ async def main(page: ft.Page):
         Args:
             e: The event object.
         """
-        global selected_pin_type
         fields = generate_empty_fields()
         
-        if marker_layer_ref.current:
-            if last_center is not None:        
-                place_pin(selected_pin_type['name'], last_center.latitude, last_center.longitude, fields )
-                page.update()
+        if session.marker_layer_ref.current:
+            if session.last_center is not None:        
+                place_pin(session.selected_pin_type['name'], session.last_center.latitude, session.last_center.longitude, fields )
             else:
-                center = page_map.configuration.initial_center
-                place_pin(selected_pin_type['name'], center.latitude, center.longitude,{})
-                page.update()
+                center = session.page_map.configuration.initial_center
+                place_pin(session.selected_pin_type['name'], center.latitude, center.longitude,{})
                 
+    @ui.batched
     def handle_event(e: map.MapEvent):
             print(
                 f"{e.name} - Source: {e.source} - Center: {e.center} - Zoom: {e.zoom} - Rotation: {e.rotation}"
             )
             if e.source == map.MapEventSource.DRAG_END or e.source == map.MapEventSource.SCROLL_WHEEL:
-                global last_center
-                last_center = e.center
+                session.last_center = e.center
             if e.source == map.MapEventSource.NON_ROTATED_SIZE_CHANGE:
                 update_dot_position(page, dot_overlay)
-                last_center = e.center
+                ui.update(dot_overlay)
+                session.last_center = e.center
+            if e.zoom is not None and e.zoom != session.current_zoom:
+                previous_zoom, session.current_zoom = session.current_zoom, e.zoom
+                # Switch modes when the zoom crosses a threshold; heatmap cells change size per zoom level
+                mode_changed = pin_render_mode(visible_count(), session.current_zoom) != session.render_mode
+                if mode_changed or (session.render_mode == HEATMAP and math.floor(previous_zoom) != math.floor(session.current_zoom)):
+                    render_pins()
+
+    @ui.batched
+    def handle_tap(e: map.MapTapEvent):
+        """
+        Open the shown pin closest to a tap, within a pixel tolerance at the current zoom.
+
+        A pin deleted by another session or process before the change bus reported it is
+        removed from the map instead.
+
+        Args:
+            e (map.MapTapEvent): The tap event.
+        """
+        pin = loaded_pins.nearest(e.coordinates.latitude, e.coordinates.longitude, session.current_zoom, config.PIN_TAP_TOLERANCE_PX,
+                                  accept=is_visible)
+        if pin is None:
+            return
+        try:
+            open_marker_overlay(map.MapLatitudeLongitude(pin["latitude"], pin["longitude"]), pin["id"])
+        except ValueError as ex:
+            print(f"Error opening pin {pin['id']}: {ex}")
+            erase_pins([pin["id"]])
                 
     def build_map(zoom, latitude, longitude):
         marker_layer_ref = ft.Ref[map.MarkerLayer]()
@@ -202,9 +481,9 @@ async def main(page: ft.Page):
                     
                     ),
                 on_init=lambda e: print("Initialized Map"),
-                #on_tap=handle_tap,
-                #on_secondary_tap=handle_tap,
-                #on_long_press=handle_tap,
+                on_tap=handle_tap,
+                on_secondary_tap=handle_tap,
+                on_long_press=handle_tap,
                 on_event=handle_event,
             ),
             layers=[
@@ -249,128 +528,186 @@ async def main(page: ft.Page):
 
     
     
-    def build_pin_type_menu_items():
-        pin_types = pins_crud.get_all_pin_types()
-        print("================================================")
-        #print(pin_types)
-        menu_items = []
-        for pin_type in pin_types:
-            menu_items.append(
-                ft.PopupMenuItem(
-                    content=ft.Row([ft.Icon(name=pin_type['style'], color=pin_type['color']),
-                                ft.Text(value= pin_type['name'])]),
-                    on_click=lambda e, pin_type=pin_type: handle_pin_type_selection(pin_type)
-                )
-            )
-        
-        return menu_items
-    
-    def build_pin_type_popup_button():
-        global selected_pin_type
-        pin_types = pins_crud.get_all_pin_types()
-        #selected_pin_type = pin_types[0]
-        if pin_types:
-            popup_button = ft.PopupMenuButton(
-                content=ft.Row([ft.Icon(name=selected_pin_type['style'], color=selected_pin_type['color']),
-                                ft.Text(value= selected_pin_type['name'],color=config.ICON_COLOR,weight=ft.FontWeight.BOLD)]),
-
-                items=build_pin_type_menu_items()
-            )
-            return popup_button
-        return None
-    
-    def update_pin_type_dropdown():
-        global pin_type_dropdown
-        pin_type_dropdown.content.controls.clear()
-        pin_type_dropdown.content.controls.append(build_pin_type_popup_button())
-        page.update()
-        
     def handle_pin_type_selection(pin_type):
         #print(pin_type)
-        global selected_pin_type
         
-        selected_pin_type = pin_type
-        print(f"Selected pin type: {selected_pin_type}")
-        update_pin_type_dropdown()
+        session.selected_pin_type = pin_type
+        print(f"Selected pin type: {session.selected_pin_type}")
+        pin_type_menu.select(pin_type)
+
+    @ui.batched
+    def handle_pin_types_changed():
+        """
+        Refresh the pin type menu after pin types are created or edited.
+        """
+        pin_type_menu.refresh()
+        session.selected_pin_type = pin_type_menu.selected
 
-    global marker_layer_ref, circle_layer_ref, page_map, map_pch
-    page_map, marker_layer_ref, circle_layer_ref = build_map(5, 15, 9)    
+    session.page_map, session.marker_layer_ref, session.circle_layer_ref = build_map(5, 15, 9)    
     
-    def handle_find_myself(e):
-        global marker_layer_ref, circle_layer_ref,gl
+    @ui.batched
+    def go_to(latitude, longitude, zoom):
+        """
+        Move the map to a position and load the pins around it.
+
+        Args:
+            latitude (float): The latitude of the new center.
+            longitude (float): The longitude of the new center.
+            zoom (float): The new zoom level.
+        """
+        moved_map = move_camera(session.page_map, latitude, longitude, zoom)
+        if moved_map is not session.page_map:
+            session.map_pch.controls[0] = moved_map
+            session.page_map = moved_map
+            ui.update(session.map_pch)
+        session.current_zoom = zoom
+        session.last_center = map.MapLatitudeLongitude(latitude, longitude)
+        load_pins_in_view(latitude, longitude, session.current_zoom)
+
+    @ui.batched
+    def zoom_to_selected_type(e):
+        """
+        Fit the map to the pins of the selected pin type, using the stored pin type statistics.
+
+        Args:
+            e: The event object.
+        """
+        if session.selected_pin_type is None or session.selected_pin_type.get('bounds') is None:
+            return
+        south, west, north, east = session.selected_pin_type['bounds']
+        latitude, longitude, zoom = fit_bounds(south, west, north, east, page.width, page.height)
+        go_to(latitude, longitude, zoom)
+
+    @ui.batched
+    def show_fix(fix):
+        """
+        Center the map on a position found by the location service.
+
+        Args:
+            fix (LocationFix): The position of the device.
+        """
+        if session.marker_layer_ref.current:
+            print(f"Found Myself: ({fix.latitude}, {fix.longitude})")
+            go_to(fix.latitude, fix.longitude, 16)
+
+    @ui.batched
+    def follow_fix(fix):
+        """
+        Keep the map centered on the device while tracking, at the current zoom.
+
+        Args:
+            fix (LocationFix): The position of the device.
+        """
+        if session.marker_layer_ref.current:
+            go_to(fix.latitude, fix.longitude, session.current_zoom)
+
+    async def handle_find_myself(e):
         try:
-            if gl.get_permission_status() == ft.GeolocatorPermissionStatus.DENIED or gl.get_permission_status() == ft.GeolocatorPermissionStatus.DENIED_FOREVER:
-                gl.request_permission()
-                page.update()
-            p = gl.get_current_position(ft.GeolocatorPositionAccuracy.BEST_FOR_NAVIGATION)
-            if marker_layer_ref.current:
-                # Update the map's center to the current position
-                print(f"Found Myself: ({p.latitude}, {p.longitude})")
-                # Rebuild the map component
-                map_pch.controls.clear()
-                page_map, marker_layer_ref, circle_layer_ref = build_map(16, p.latitude, p.longitude)
-                map_pch.controls.append(page_map)
-                page.update()
-                load_pins()
-                page.update()
+            await location.locate(show_fix)
         except Exception as e:
             print(f"Error: {e}")
-            page.update()
+
+    async def toggle_tracking(e):
+        """
+        Turn following the position of the device on or off.
+
+        Args:
+            e: The event object.
+        """
+        try:
+            if location.tracking:
+                location.stop_tracking()
+            else:
+                await location.start_tracking(follow_fix)
+        except Exception as e:
+            print(f"Error: {e}")
+        tracking_button.selected = location.tracking
+        ui.update(tracking_button)
+
+    @ui.batched
+    def handle_time_filter(window):
+        """
+        Show only the pins with a date in the timeline's window.
+
+        Args:
+            window (timeline.DateWindow): The window, or None to show every pin.
+        """
+        session.time_window = window
+        heatmap.load(visible_pins())
+        render_pins()
+
+    @ui.batched
+    def toggle_timeline(e):
+        """
+        Show or hide the timeline. Hiding it shows every pin again.
+
+        Args:
+            e: The event object.
+        """
+        if session.timeline_filter is None:
+            # Loaded on first use, like the other rarely used controls
+            from timeline import TimelineFilter
+            session.timeline_filter = TimelineFilter(on_change=handle_time_filter)
+            page.views[0].controls.append(session.timeline_filter)
+            session.timeline_filter.visible = False
+            ui.update(page.views[0])
+        session.timeline_filter.visible = not session.timeline_filter.visible
+        timeline_button.selected = session.timeline_filter.visible
+        ui.update(session.timeline_filter, timeline_button)
+        if session.timeline_filter.visible:
+            session.timeline_filter.load()
+            handle_time_filter(session.timeline_filter.window)
+        else:
+            session.timeline_filter.stop()
+            handle_time_filter(None)
             
     def show_create_pin_type_overlay(e):
-        page.overlay.clear()
-        page.overlay.append(
-            ft.Container(
-                content=CreatePinTypeOverlay(page, on_pin_type_created=update_pin_type_dropdown),
-                padding=5,
-                width=page.width,
-                height=page.height,
-                bgcolor=config.SECONDARY_COLOR,
-                alignment=ft.alignment.center,
-                border_radius=ft.border_radius.all(10),
-                margin=ft.margin.symmetric(horizontal=10, vertical=30),
-                #border=ft.border.all(width=2, color=config.SECONDARY_DARK_COLOR),
-                shadow=ft.BoxShadow(
-                    spread_radius=0.5,
-                    blur_radius=5,
-                    color=ft.colors.BLACK,
-                    offset=ft.Offset(0, 0),
-                    blur_style=ft.ShadowBlurStyle.NORMAL,
-                ),
-            )
+        # Loads the color picker, which is only needed here
+        from create_pin_type_overlay import CreatePinTypeOverlay
+
+        marker_panel.hide()
+        pin_type_panel.show(
+            CreatePinTypeOverlay(page, on_pin_type_created=handle_pin_types_changed, on_close=close_pin_type_overlay),
+            width=page.width,
+            height=page.height,
         )
-        page.update()
+        ui.update(marker_panel, pin_type_panel)
+
+    def close_pin_type_overlay():
+        pin_type_panel.hide()
+        ui.update(pin_type_panel)
 
-    map_pch = ft.Column(
+    session.map_pch = ft.Column(
         expand=1,
-        controls=[page_map],
+        controls=[session.page_map],
     )
     
     def show_delete_confirmation():
         def on_confirm(e):
             try:
-                global selected_pin_type
-                if selected_pin_type['name'] == 'Default':
+                if session.selected_pin_type['name'] == 'Default':
                     page.dialog.open = False
-                    page.update()
+                    ui.update(page.dialog)
                     return
                 
-                pins_crud.delete_pin_type_and_pins(selected_pin_type['name'])
                 page.dialog.open = False
-                page.update()
-                # Optionally, update the UI to reflect the deletion
-                pin_types = pins_crud.get_all_pin_types()
-                if pin_types:
-                    selected_pin_type = pin_types[0]
-                
-                update_pin_type_dropdown()
-                load_pins()
+                ui.update(page.dialog)
+                pin_type_id = session.selected_pin_type['id']
+
+                @ui.batched
+                def on_deleted(job):
+                    pin_type_menu.remove_pin_type(pin_type_id)
+                    session.selected_pin_type = pin_type_menu.selected
+                    load_pins()
+
+                # Runs in the background; the progress shows in the app bar
+                pins_jobs.job_runner.submit("delete_pin_type", {"pin_type_name": session.selected_pin_type['name']}, on_done=on_deleted)
             except ValueError as err:
                 print(err)
         
         def on_cancel(e):
             page.dialog.open = False
-            page.update()
+            ui.update(page.dialog)
 
         confirmation_dialog = ft.AlertDialog(
             title=ft.Text("Confirm Deletion"),
@@ -384,20 +721,35 @@ async def main(page: ft.Page):
 
         page.dialog = confirmation_dialog
         page.dialog.open = True
-        page.update()
+        # A new dialog is part of the page itself
+        ui.update_page()
     
-    global pin_type_dropdown
     
-    pin_type_dropdown = ft.Container(ft.Row())
-    pin_type_dropdown.content.controls.append(build_pin_type_popup_button())
-    update_pin_type_dropdown()
+    pin_type_menu = PinTypeMenu(on_select=handle_pin_type_selection, load=False, scheduler=ui)
+    session.pin_type_dropdown = ft.Container(ft.Row([pin_type_menu]))
+    job_progress = JobProgress()
+    tracking_button = ft.IconButton(
+        icon=ft.icons.NAVIGATION_OUTLINED,
+        selected_icon=ft.icons.NAVIGATION,
+        selected=False,
+        tooltip="Follow my location",
+        on_click=toggle_tracking,
+    )
+    timeline_button = ft.IconButton(
+        icon=ft.icons.DATE_RANGE_OUTLINED,
+        selected_icon=ft.icons.DATE_RANGE,
+        selected=False,
+        icon_color=config.ICON_COLOR,
+        tooltip="Timeline",
+        on_click=toggle_timeline,
+    )
     
     page.views.append(
         ft.View(
             padding=0,
             route="/",
             controls=[
-                map_pch,      
+                session.map_pch,      
             ],
             appbar=ft.AppBar(
                 #leading=ft.IconButton(icon=ft.icons.MENU, on_click=handle_permission_request),
@@ -405,7 +757,9 @@ async def main(page: ft.Page):
                 actions=[
                     ft.Row(
                         [
-                        ft.IconButton(icon=ft.icons.LOCATION_SEARCHING, on_click=handle_find_myself)
+                        job_progress,
+                        ft.IconButton(icon=ft.icons.LOCATION_SEARCHING, on_click=handle_find_myself),
+                        tracking_button,
                         ]
                 ,),
                 ],
@@ -417,7 +771,9 @@ async def main(page: ft.Page):
                             spacing=3,
                             controls=[
                                 ft.IconButton(icon=ft.icons.ADD_CIRCLE_OUTLINE_OUTLINED, icon_color=config.ICON_COLOR, on_click=show_create_pin_type_overlay),
-                                pin_type_dropdown,
+                                session.pin_type_dropdown,
+                                ft.IconButton(icon=ft.icons.ZOOM_OUT_MAP, icon_color=config.ICON_COLOR, tooltip="Zoom to pin type", on_click=zoom_to_selected_type),
+                                timeline_button,
                                 ft.IconButton(icon=ft.icons.DELETE, icon_color=ft.colors.RED, on_click=lambda e: show_delete_confirmation()),
                                 
                             ]
@@ -434,19 +790,43 @@ async def main(page: ft.Page):
         
     )
 
-    # Add dot overlay to the page's overlay
-    page.overlay.append(dot_overlay)
+    # Add dot overlay and the panels to the page's overlay
+    page.overlay.extend([dot_overlay, marker_panel, pin_type_panel])
     update_dot_position(page, dot_overlay)
 
+    def stop_session_threads():
+        # Threads the session started would otherwise keep it alive
+        if location.tracking:
+            location.stop_tracking()
+        if session.timeline_filter is not None:
+            session.timeline_filter.stop()
+
+    session.on_close(stop_session_threads)
     page.on_resize = update_dot_event
-    load_pins()
+    page.on_close = lambda e: session.close()
     page.update()
-    if map_pch.controls:
-        map_control = map_pch.controls[0]
+    profiler.mark("first page.update()")
+
+    with profiler.timed("database init"):
+        from db.repository import get_repository
+        pins_repository = get_repository()
+        import db.jobs as pins_jobs
+        import db.change_bus as pins_changes
+    pins_jobs.job_runner.start()
+    job_progress.attach(pins_jobs.job_runner)
+    session.on_close(job_progress.detach)
+    load_pins()
+    pins_changes.change_bus.subscribe(handle_changes)
+    session.on_close(lambda: pins_changes.change_bus.unsubscribe(handle_changes))
+    profiler.mark("pins loaded")
+    profiler.report()
+    if session.map_pch.controls:
+        map_control = session.map_pch.controls[0]
         if isinstance(map_control, map.Map):
             print(f"Map flags: {map_control.configuration.interaction_configuration.flags}")
             map_control.configuration.interaction_configuration.flags = map.MapInteractiveFlag.NONE
             print(f"Map flags: {map_control.configuration.interaction_configuration.flags}")
+    return session
 
 
 if __name__ == "__main__":
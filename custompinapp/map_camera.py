@@ -0,0 +1,61 @@
+"""
+Camera helpers for the Custom Pins application.
+
+This module moves the camera of a map without recreating its layers or markers.
+
+The Flet version the app is built with (0.24) has no map camera API: a map only reads its
+initial center and zoom when it is created, so changing them on the live map does not move
+it. On that version move_camera therefore always builds a new Map shell around the same
+configuration and layer controls. The layers are not queried or rebuilt, but the new shell
+is sent to the browser with them, markers included. The camera API is used instead as soon
+as Flet provides one, and then a move is a single small update.
+
+Functions:
+    move_camera(page_map, latitude, longitude, zoom=None, animate=True): Move the map camera.
+"""
+import flet as ft
+import flet_core.map as map
+
+CAMERA_ANIMATION_MS = 500
+
+def move_camera(page_map, latitude, longitude, zoom=None, animate=True):
+    """
+    Move the camera of a map to a new center and zoom.
+
+    Flet versions that expose a map camera API move the live map in place. Older versions,
+    Flet 0.24 included, have no way to move an existing map, so a new Map shell is built
+    around the same configuration and layer controls; the tile layer, markers and circles
+    are reused as they are and nothing is queried again, but they are sent again with the
+    new shell.
+
+    Args:
+        page_map (map.Map): The map to move.
+        latitude (float): The latitude of the new center.
+        longitude (float): The longitude of the new center.
+        zoom (float, optional): The new zoom level. Defaults to None, keeping the current zoom.
+        animate (bool, optional): Whether to animate the move. Defaults to True.
+
+    Returns:
+        map.Map: The map showing the new camera. This is page_map itself unless a new shell
+        had to be built, in which case the caller must put it in place of the old one.
+    """
+    destination = map.MapLatitudeLongitude(latitude, longitude)
+    duration = ft.Duration(milliseconds=CAMERA_ANIMATION_MS) if animate else None
+
+    center_on = getattr(page_map, 'center_on', None)
+    if center_on is not None:
+        center_on(destination, zoom, animation_duration=duration)
+        return page_map
+
+    configuration = page_map.configuration
+    configuration.initial_center = destination
+    if zoom is not None:
+        configuration.initial_zoom = zoom
+    layers = list(page_map.layers)
+    # Detach the layers so the old map does not keep them alive
+    page_map.layers = []
+    return map.Map(
+        expand=page_map.expand,
+        configuration=configuration,
+        layers=layers,
+    )
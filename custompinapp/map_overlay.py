@@ -34,12 +34,49 @@ class DotOverlay(ft.Container):
             #absolute = True,
         )
 
+class OverlayPanel(ft.Container):
+    """
+    A panel shown over the map, such as the details of a pin.
+
+    Panels stay in the page's overlay for the life of the page and are hidden when
+    closed, so opening and closing one only sends the panel and not the whole page.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initialize a hidden OverlayPanel instance.
+
+        Args:
+            **kwargs: The properties of the container, such as its padding and shadow.
+        """
+        super().__init__(visible=False, **kwargs)
+
+    def show(self, content, **kwargs):
+        """
+        Show the panel with new content. The caller sends the change to the page.
+
+        Args:
+            content (ft.Control): The content of the panel.
+            **kwargs: Properties of the container to change, such as its margin.
+        """
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+        self.content = content
+        self.visible = True
+
+    def hide(self):
+        """
+        Hide the panel. Its content is kept, so showing it again only sends what changed.
+        The caller sends the change to the page.
+        """
+        self.visible = False
+
 def update_dot_position(page: ft.Page, dot_overlay):
     """
     Update the position of the dot overlay on the map.
 
     This function calculates the center position of the map and updates the
-    margin of the dot overlay to center it on the map.
+    margin of the dot overlay to center it on the map. The caller sends the
+    change to the page.
 
     Args:
         page (ft.Page): The main page object provided by Flet.
@@ -69,5 +106,4 @@ def update_dot_position(page: ft.Page, dot_overlay):
 
     # Debugging the calculated positions
     #print(f"Map center position: left={dot_overlay.left}, top={dot_overlay.top}")
-    page.update()
     
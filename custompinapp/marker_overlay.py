@@ -1,14 +1,80 @@
 import flet as ft
-from db.crud import get_pin_by_id, update_pin, delete_pin
-from map_overlay import DotOverlay, update_dot_position
+from db.repository import get_repository
+from db.write_behind import pin_edits
 import datetime
+import math
+import config
+
+repository = get_repository()
+
+def _attribute_row(name_field, value_field, buttons, visible=True):
+    """
+    Build the row of an attribute, the template of both its display and its edit view.
+
+    Args:
+        name_field (ft.Text): The text showing the name of the attribute.
+        value_field (ft.Control): The control showing or editing the value.
+        buttons (list): The controls at the end of the row.
+        visible (bool, optional): Whether the row is visible. Defaults to True.
+
+    Returns:
+        ft.Container: The row.
+    """
+    return ft.Container(
+            visible=visible,
+            padding= 0,
+            border_radius= 15,
+            #bgcolor=ft.colors.RED,
+            border = ft.border.all(2, ft.colors.GREY),
+            content=ft.Row(
+            [
+                ft.Container(
+                    ft.Icon(ft.icons.ADD_LOCATION, size=30, color=ft.colors.GREY,),
+                    margin=ft.margin.only(left=10,right=20)
+                ),
+                
+                ft.Container(
+                    content=name_field,
+                    #bgcolor=ft.colors.ORANGE_300,
+                    alignment=ft.alignment.center_left,
+                    #width=50,
+                    #expand=True,
+                    margin=ft.margin.only(left=10,right=20)
+                    ,
+                ),
+                ft.Container(
+                    bgcolor=ft.colors.GREY,
+                    #expand=True,
+                    width=2,
+                    height=50,
+                    #margin= ft.margin.only(left=20,right=5),
+                ),
+                #ft.VerticalDivider(),
+                ft.Container(
+                    content=value_field,
+                    #bgcolor=ft.colors.BROWN_400,
+                    alignment=ft.alignment.center,
+                    expand=True,
+                ),
+                *buttons,
+            ],
+            spacing=1,
+            
+            expand=True,
+        ),
+        )
+
+def _name_field(attribute_name):
+    return ft.Text(attribute_name, color=ft.colors.GREY_500, weight="bold", size=14, expand=True)
 
 class Attribute(ft.Column):
     """
     A class representing an attribute of a pin.
 
     This class inherits from `ft.Column` and is used to display and edit attributes
-    associated with a pin on the map.
+    associated with a pin on the map. Only the display view is built up front; the edit
+    view is built the first time the attribute is edited. An Attribute can be bound to
+    another attribute, so the overlay reuses its rows from one pin to the next.
 
     Attributes:
         attribute_name (str): The name of the attribute.
@@ -17,11 +83,13 @@ class Attribute(ft.Column):
         pin_id (int): The unique identifier of the pin.
         editable (bool): Whether the attribute is editable. Defaults to True.
         page (ft.Page): The main page object provided by Flet. Defaults to None.
-        attribute_type (str): The type of the attribute if the value is a dictionary.
-        icon (ft.Icon): The icon representing the attribute.
+        attribute_type (str): The type of the attribute if the value is a dictionary, or None.
         display_field (ft.Text): The text field used to display the attribute value.
-        edit_field (ft.TextField): The text field used to edit the attribute value.
+        edit_field (ft.TextField): The text field used to edit the attribute value, or None
+                                   until the edit view is built.
         display_view (ft.Container): The container for displaying the attribute in view mode.
+        edit_view (ft.Container): The container for editing the attribute, or None until it
+                                  is first needed.
     """
     def __init__(self, attribute_name, attribute_value, pin_id,  editable = True, page: ft.Page = None):
         """
@@ -36,134 +104,82 @@ class Attribute(ft.Column):
             page (ft.Page, optional): The main page object provided by Flet. Defaults to None.
         """
         super().__init__()
+        self.page = page
+        
+        self.display_field = ft.Text(color=ft.colors.GREY_700, weight="bold")
+        self.edit_field = None
+        self.edit_view = None
+        self._display_name = _name_field(attribute_name)
+        self._edit_name = None
+        self._edit_button = ft.Container(
+                content=ft.IconButton(
+                    icon=ft.icons.CREATE_OUTLINED,
+                    tooltip="Edit",
+                    on_click=self.edit_clicked,
+                    ),
+            )
+        self.display_view = _attribute_row(self._display_name, self.display_field, [self._edit_button])
+        self.controls = [self.display_view]
+        self.bind(attribute_name, attribute_value, pin_id, editable)
+
+    def bind(self, attribute_name, attribute_value, pin_id, editable=True):
+        """
+        Show another attribute in this one's controls, in display mode. The caller sends
+        the change to the page.
+
+        Args:
+            attribute_name (str): The name of the attribute.
+            attribute_value (str or dict): The value of the attribute. If a dictionary is provided,
+                                           it should contain 'type' and 'value' keys.
+            pin_id (int): The unique identifier of the pin.
+            editable (bool, optional): Whether the attribute is editable. Defaults to True.
+        """
         self.attribute_name = attribute_name
         self.attribute_value = attribute_value
+        self.attribute_type = None
         self.pin_id = pin_id
         self.editable = editable
-        self.page = page
         
         if type(self.attribute_value) == dict:
             self.attribute_type = self.attribute_value['type']
             self.attribute_value = self.attribute_value['value']
-        
-        
-        self.icon = ft.Icon(ft.icons.PIN_DROP_ROUNDED)
-        
-        self.display_field = ft.Text(value=self.attribute_value, color=ft.colors.GREY_700, weight="bold")
-        self.edit_field = ft.TextField(expand=1)
-
-        self.display_view = ft.Container(
-                padding= 0,
-                border_radius= 15,
-                #bgcolor=ft.colors.RED,
-                border = ft.border.all(2, ft.colors.GREY),
-                content=ft.Row(
-                [
-                    ft.Container(
-                        ft.Icon(ft.icons.ADD_LOCATION, size=30, color=ft.colors.GREY,),
-                        margin=ft.margin.only(left=10,right=20)
-                    ),
-                    
-                    ft.Container(
-                        content=ft.Text(self.attribute_name, color=ft.colors.GREY_500, weight="bold", size=14, expand=True),
-                        #bgcolor=ft.colors.ORANGE_300,
-                        alignment=ft.alignment.center_left,
-                        #width=50,
-                        #expand=True,
-                        margin=ft.margin.only(left=10,right=20)
-                        ,
-                    ),
-                    ft.Container(
-                        bgcolor=ft.colors.GREY,
-                        #expand=True,
-                        width=2,
-                        height=50,
-                        #margin= ft.margin.only(left=20,right=5),
-                    ),
-                    #ft.VerticalDivider(),
-                    ft.Container(
-                        content=self.display_field,
-                        #bgcolor=ft.colors.BROWN_400,
-                        alignment=ft.alignment.center,
-                        expand=True,
-                    ),
-                    
-                ],
-                spacing=1,
-                
-                expand=True,
-            ),
-            )
-        
-        if editable:
-            self.display_view.content.controls.append(
+
+        self._display_name.value = attribute_name
+        self.display_field.value = self.attribute_value
+        self._edit_button.visible = editable
+        self.display_view.visible = True
+        if self.edit_view is not None:
+            self._edit_name.value = attribute_name
+            self.edit_view.visible = False
+
+    def _show_edit_view(self):
+        if self.edit_view is None:
+            self.edit_field = ft.TextField(expand=1)
+            self._edit_name = _name_field(self.attribute_name)
+            self.edit_view = _attribute_row(self._edit_name, self.edit_field, [
                 ft.Container(
-                        content=ft.IconButton(
-                            icon=ft.icons.CREATE_OUTLINED,
-                            tooltip="Edit",
-                            on_click=self.edit_clicked,
-                            ),
-                    )
-            )
+                    content=ft.IconButton(
+                        icon=ft.icons.CLOSE_OUTLINED,
+                        tooltip="Close",
+                        on_click=self.close_clicked,
+                        ),
+                ),
+                ft.IconButton(
+                    icon=ft.icons.DONE_OUTLINE_OUTLINED,
+                    icon_color=ft.colors.GREEN,
+                    tooltip="Update",
+                    on_click=self.save_clicked,
+                ),
+            ])
+            self.controls.append(self.edit_view)
+        self.edit_field.value = self.display_field.value
+        self.display_view.visible = False
+        self.edit_view.visible = True
 
-        self.edit_view = ft.Container(
-                visible=False,
-                padding= 0,
-                border_radius= 15,
-                #bgcolor=ft.colors.RED,
-                border = ft.border.all(2, ft.colors.GREY),
-                content=ft.Row(
-                [
-                    ft.Container(
-                        ft.Icon(ft.icons.ADD_LOCATION, size=30, color=ft.colors.GREY,),
-                        margin=ft.margin.only(left=10,right=20)
-                    ),
-                    
-                    ft.Container(
-                        content=ft.Text(self.attribute_name, color=ft.colors.GREY_500, weight="bold", size=14, expand=True),
-                        #bgcolor=ft.colors.ORANGE_300,
-                        alignment=ft.alignment.center_left,
-                        #width=50,
-                        #expand=True,
-                        margin=ft.margin.only(left=10,right=20)
-                        ,
-                    ),
-                    ft.Container(
-                        bgcolor=ft.colors.GREY,
-                        #expand=True,
-                        width=2,
-                        height=50,
-                        #margin= ft.margin.only(left=20,right=5),
-                    ),
-                    #ft.VerticalDivider(),
-                    ft.Container(
-                        content=self.edit_field,
-                        #bgcolor=ft.colors.BROWN_400,
-                        alignment=ft.alignment.center,
-                        expand=True,
-                    ),
-                    ft.Container(
-                        content=ft.IconButton(
-                            icon=ft.icons.CLOSE_OUTLINED,
-                            tooltip="Close",
-                            on_click=self.close_clicked,
-                            ),
-                    ),
-                    ft.IconButton(
-                        icon=ft.icons.DONE_OUTLINE_OUTLINED,
-                        icon_color=ft.colors.GREEN,
-                        tooltip="Update",
-                        on_click=self.save_clicked,
-                    ),
-                    
-                ],
-                spacing=1,
-                
-                expand=True,
-            ),
-            )
-        
-        self.controls = [self.display_view, self.edit_view]
+    def _show_display_view(self):
+        self.display_view.visible = True
+        if self.edit_view is not None:
+            self.edit_view.visible = False
         
 
     def edit_clicked(self, e):
@@ -194,12 +210,7 @@ class Attribute(ft.Column):
             """
             date = str(e.control.value).split(' ')[0]
             
-            self.attribute_value = date
-            self.display_field.value = date
-            date = {}
-            date[self.attribute_name] = self.attribute_value
-            update_pin(self.pin_id, date)
-
+            self.submit_value(date)
             print(date)
             self.update()
             
@@ -212,14 +223,8 @@ class Attribute(ft.Column):
                     on_change=handle_date_change,  
                     )
                 )
-            elif self.attribute_type == 'integer':
-                self.edit_field.value = self.display_field.value
-                self.display_view.visible = False
-                self.edit_view.visible = True
             else:
-                self.edit_field.value = self.display_field.value
-                self.display_view.visible = False
-                self.edit_view.visible = True
+                self._show_edit_view()
                 
         self.update()
 
@@ -233,30 +238,44 @@ class Attribute(ft.Column):
         Args:
             e: The event object representing the click event.
         """
-        updated_field_values = {}
         if self.editable:
             if self.attribute_type == 'integer':
-                self.attribute_value = self.edit_field.value      
-                print('saving integer field ' + self.attribute_value)
-                self.display_field.value = self.edit_field.value      
-                updated_field_values[self.attribute_name] = self.edit_field.value
-
+                print('saving integer field ' + self.edit_field.value)
             else:
-                self.attribute_value = self.edit_field.value
-                print('saving string field ' + self.attribute_value)
-                self.display_field.value = self.edit_field.value             
-                updated_field_values[self.attribute_name] = self.edit_field.value
-                
-        update_pin(self.pin_id, updated_field_values)
+                print('saving string field ' + self.edit_field.value)
+            self.submit_value(self.edit_field.value)
 
-        #update_pin(self.pin_id, updated_field_values)
-        self.display_view.visible = True
-        self.edit_view.visible = False
+        self._show_display_view()
         self.update()
         
+    def submit_value(self, value):
+        """
+        Show a new value right away and queue it to be written to the pin.
+
+        If the write fails, the previous value is restored and the error is shown.
+
+        Args:
+            value (str): The new value of the attribute.
+        """
+        previous_value = self.attribute_value
+        self.attribute_value = value
+        self.display_field.value = value
+        pin_id, attribute_name = self.pin_id, self.attribute_name
+
+        def revert(error):
+            # The row may show another attribute by now
+            if (self.pin_id, self.attribute_name, self.attribute_value) != (pin_id, attribute_name, value):
+                return
+            self.attribute_value = previous_value
+            self.display_field.value = previous_value
+            if self.page:
+                self.page.open(ft.SnackBar(ft.Text(f"Could not save {self.attribute_name}: {error}")))
+                self.update()
+
+        pin_edits.submit(self.pin_id, self.attribute_name, value, on_error=revert)
+
     def close_clicked(self, e):
-        self.display_view.visible = True
-        self.edit_view.visible = False
+        self._show_display_view()
         self.update()
 
 
@@ -265,18 +284,25 @@ class MarkerOverlay(ft.Column):
     A class representing an overlay for a marker on the map.
 
     This class inherits from `ft.Column` and is used to display and manage
-    the details and actions associated with a marker on the map.
+    the details and actions associated with a marker on the map. One overlay can show
+    one pin after another with show_pin, reusing its rows.
 
     Attributes:
         page (ft.Page): The main page object provided by Flet.
         pin_id (int): The unique identifier of the pin.
         coordinates: The coordinates of the marker.
+        on_close (function): Function called without arguments to close the overlay.
         expand (bool): Whether the overlay should expand to fill available space.
         pin_id_field (ft.Text): The text field displaying the pin ID.
         delete_button (ft.IconButton): The button to delete the marker.
         close_button (ft.IconButton): The button to close the overlay.
+        pin_info_list (ft.ListView): The list of the attributes of the pin, holding the rows
+                                     around the scroll offset between two spacers that
+                                     stand for the others.
+        rows (list): Every Attribute row built, at most a window's worth, reused as the
+                     list scrolls and for the next pin.
     """
-    def __init__(self, page: ft.Page,coordinates ,id: int, load_pins):
+    def __init__(self, page: ft.Page,coordinates ,id: int, on_deleted, on_close):
         """
         Initialize a MarkerOverlay instance.
 
@@ -284,80 +310,56 @@ class MarkerOverlay(ft.Column):
             page (ft.Page): The main page object provided by Flet.
             coordinates: The coordinates of the marker.
             id (int): The unique identifier of the pin.
-            load_pins (function): The function to load pins after deletion.
+            on_deleted (function): Function called with the ID of the pin after it is
+                deleted, to remove it from the map and close the overlay.
+            on_close (function): Function called without arguments to close the overlay.
         """
         super().__init__()
         self.page=page
         self.pin_id = id
         self.coordinates = coordinates
+        self.on_close = on_close
         self.expand= True
         
         def clear_overlay(e):
             """
-            Clear the overlay and reset the dot position.
+            Close the overlay. Its pending edits are written by the queue.
 
             Args:
                 e: The event object representing the click event.
             """
-            self.page.overlay.clear()
-            dot_overlay = DotOverlay()
-            page.overlay.append(dot_overlay)
-            update_dot_position(self.page, dot_overlay)
-            #self.page.update()
+            self.on_close()
         
         def delete_marker(e):
             """
-            Delete the marker and reload pins.
+            Delete the marker and remove it from the map.
 
             Args:
                 e: The event object representing the click event.
             """
             try:
                 print('delte pin called')
-                delete_pin(self.pin_id)  # Call the function to delete the marker
-                self.page.overlay.clear()
-                print('load_pins called')
-                load_pins()
-                print('load_pins completed')
-                dot_overlay = DotOverlay()
-                page.overlay.append(dot_overlay)
-                update_dot_position(self.page, dot_overlay)
-                print("update_dot_position end")
+                pin_edits.discard(self.pin_id)
+                repository.delete_pin(self.pin_id)  # Call the function to delete the marker
+                on_deleted(self.pin_id)
             
             except Exception as ex:
                 print(f"Error deleting marker: {ex}")
 
-        pin_text = f'#{self.pin_id}'
-        self.pin_id_field = ft.Text(value= pin_text, expand=True, color=ft.colors.BLACK, size=20, text_align=ft.TextAlign.JUSTIFY)
+        self.pin_id_field = ft.Text(expand=True, color=ft.colors.BLACK, size=20, text_align=ft.TextAlign.JUSTIFY)
         self.delete_button = ft.IconButton(icon=ft.icons.DELETE_OUTLINED, on_click=delete_marker)
         self.close_button = ft.IconButton(icon=ft.icons.CLOSE, alignment=ft.alignment.center_right,on_click=clear_overlay)
+        self.pin_info_list = ft.ListView(expand=True, spacing=5, on_scroll=self._handle_scroll,
+                                         on_scroll_interval=config.ATTRIBUTE_SCROLL_INTERVAL_MS)
+        self.rows = []
+        self._attributes = []
+        self._window = (0, 0)
+        self._bound = {}  # the row showing each attribute of the window, by attribute index
+        self._scrolled = False
+        self._top_spacer = ft.Container(visible=False)
+        self._bottom_spacer = ft.Container(visible=False)
 
-        # Fetch pin details
-        pin_details = get_pin_by_id(self.pin_id)
-        pin_info_list = ft.ListView(expand=True,spacing=5)
-
-        # Create a list view to display pin details
-        def rebuild_pin_info():
-            """
-            Rebuild the pin information list view.
-
-            This function clears the current controls in the pin information list view
-            and appends the updated pin details.
-            
-            Returns:
-                ft.ListView: The updated pin information list
-            """
-            pin_info_list.controls.clear()
-            
-            pin_info_list.controls.append(Attribute('Pin Type',pin_details['pin_type'],self.pin_id, editable=False))
-            position_text = f"{pin_details['latitude']}, {pin_details['longitude']}"
-            pin_info_list.controls.append(Attribute('Position',position_text,self.pin_id,editable=False))
-            for field_name, value in pin_details['fields'].items():
-                pin_info_list.controls.append(Attribute(field_name,dict(value),self.pin_id,editable=True, page = self.page))
-                print(value)
-            return pin_info_list
-
-        rebuild_pin_info()
+        self.show_pin(coordinates, id)
         
         self.controls = [
                 ft.Row(
@@ -367,6 +369,85 @@ class MarkerOverlay(ft.Column):
                         self.close_button,
                     ]
                 ),
-                pin_info_list,       
+                self.pin_info_list,       
+        ]
+
+    def show_pin(self, coordinates, pin_id):
+        """
+        Show the details of a pin, reusing the rows of the pin shown before. The caller
+        sends the change to the page.
+
+        Only the rows around the scroll offset are shown, in a window of rows that is
+        moved as the list scrolls; spacers take the place of the others.
+
+        Args:
+            coordinates: The coordinates of the marker.
+            pin_id (int): The unique identifier of the pin.
+        """
+        pin_details = repository.get_pin_by_id(pin_id)
+        # Edits still waiting to be written show over the stored values
+        edits = pin_edits.pending(pin_id)
+        self.pin_id = pin_id
+        self.coordinates = coordinates
+        self.pin_id_field.value = f'#{pin_id}'
+
+        position_text = f"{pin_details['latitude']}, {pin_details['longitude']}"
+        self._attributes = [('Pin Type', pin_details['pin_type'], False), ('Position', position_text, False)]
+        self._attributes += [
+            (field_name, dict(value, value=edits[field_name]) if field_name in edits else dict(value), True)
+            for field_name, value in pin_details['fields'].items()
         ]
+        self._bound = {}
+        self._show_window(0)
+        if self._scrolled and self.pin_info_list.page is not None:
+            self.pin_info_list.scroll_to(offset=0)
+            self._scrolled = False
+
+    def _rows_per_screen(self):
+        height = self.page.height if self.page is not None and self.page.height else 0
+        return math.ceil(height / config.ATTRIBUTE_ROW_HEIGHT_PX) + config.ATTRIBUTE_ROWS_AHEAD
+
+    def _set_spacer(self, spacer, rows):
+        # A spacer and the space after it take the place of that many rows
+        spacer.visible = rows > 0
+        spacer.height = rows * config.ATTRIBUTE_ROW_HEIGHT_PX - self.pin_info_list.spacing if rows else None
+
+    def _show_window(self, first_visible):
+        # Shows the rows from a few above the first visible one to a few past the screen, and
+        # returns whether the window moved. Rows that stay in the window keep their
+        # attribute, so only the rows entering it are bound and sent
+        count = len(self._attributes)
+        first = max(0, min(first_visible, count) - config.ATTRIBUTE_ROWS_AHEAD)
+        last = min(count, first_visible + self._rows_per_screen())
+        if (first, last) == self._window and self._bound:
+            return False
+        self._window = (first, last)
+
+        bound = {index: row for index, row in self._bound.items() if first <= index < last}
+        in_use = set(map(id, bound.values()))
+        # Free rows are taken in order, so a reopened list keeps its rows where they were
+        free = iter([row for row in self.rows if id(row) not in in_use])
+        for index in range(first, last):
+            if index in bound:
+                continue
+            attribute_name, value, editable = self._attributes[index]
+            row = next(free, None)
+            if row is not None:
+                row.bind(attribute_name, value, self.pin_id, editable)
+            else:
+                row = Attribute(attribute_name, value, self.pin_id, editable=editable, page=self.page)
+                self.rows.append(row)
+            bound[index] = row
+        self._bound = bound
+
+        self._set_spacer(self._top_spacer, first)
+        self._set_spacer(self._bottom_spacer, count - last)
+        self.pin_info_list.controls = [self._top_spacer] + [bound[index] for index in range(first, last)] + [self._bottom_spacer]
+        return True
 
+    def _handle_scroll(self, e):
+        if e.pixels is None:
+            return
+        self._scrolled = e.pixels > 0
+        if self._show_window(int(e.pixels // config.ATTRIBUTE_ROW_HEIGHT_PX)):
+            self.pin_info_list.update()
@@ -0,0 +1,132 @@
+"""
+Pin rendering helpers for the Custom Pins application.
+
+Dense maps are drawn as plain coloured circles in the map's CircleLayer instead of one
+icon marker per pin, and at country zoom as a density heatmap of shaded cells. None of
+them carries event handlers; picking is done by a single map-level tap handler that
+resolves the nearest pin through the spatial index.
+
+Functions:
+    pin_render_mode(pin_count, zoom): How pins should be drawn.
+    build_pin_circle(pin): Build a circle marker for a pin.
+    build_heat_circles(cells): Build the circle markers of a density heatmap.
+    copy_circle(circle, other): Make a circle marker look like another one.
+    reuse_controls(current, built, key, copy): Show new controls in a layer, reusing the controls already there.
+"""
+import flet as ft
+import flet_core.map as map
+import config
+
+HEATMAP = "heatmap"
+CIRCLES = "circles"
+MARKERS = "markers"
+
+def pin_render_mode(pin_count, zoom):
+    """
+    Decide how pins should be drawn.
+
+    Args:
+        pin_count (int): The number of pins to draw.
+        zoom (float): The current zoom level of the map.
+
+    Returns:
+        str: HEATMAP for a density heatmap, CIRCLES for one circle per pin or MARKERS for
+        one icon marker per pin.
+    """
+    if zoom is not None and zoom <= config.HEATMAP_MAX_ZOOM:
+        return HEATMAP
+    if pin_count > config.CIRCLE_MODE_PIN_THRESHOLD:
+        return CIRCLES
+    if zoom is not None and zoom <= config.CIRCLE_MODE_MAX_ZOOM:
+        return CIRCLES
+    return MARKERS
+
+def build_pin_circle(pin):
+    """
+    Build a circle marker for a pin.
+
+    Args:
+        pin (dict): The pin, with 'id', 'latitude', 'longitude' and 'color' keys.
+
+    Returns:
+        map.CircleMarker: The circle marker, with the ID of the pin as its data.
+    """
+    circle = map.CircleMarker(
+        radius=config.PIN_CIRCLE_RADIUS,
+        coordinates=map.MapLatitudeLongitude(pin['latitude'], pin['longitude']),
+        color=pin['color'],
+        border_color=ft.colors.WHITE,
+        border_stroke_width=1,
+    )
+    # Not sent to the page; lets a single pin's circle be removed
+    circle.data = pin['id']
+    return circle
+
+def build_heat_circles(cells):
+    """
+    Build the circle markers of a density heatmap, one per occupied cell.
+
+    Args:
+        cells (list): The (latitude, longitude, intensity) of each cell, as returned by
+            DensityHeatmap.cells.
+
+    Returns:
+        list: The circle markers, shaded by intensity.
+    """
+    return [
+        map.CircleMarker(
+            radius=config.HEATMAP_CELL_PX / 2,
+            coordinates=map.MapLatitudeLongitude(latitude, longitude),
+            color=ft.colors.with_opacity(0.15 + 0.7 * intensity, config.HEATMAP_COLOR),
+        )
+        for latitude, longitude, intensity in cells
+    ]
+
+def copy_circle(circle, other):
+    """
+    Make a circle marker look like another one.
+
+    Args:
+        circle (map.CircleMarker): The circle marker to change.
+        other (map.CircleMarker): The circle marker to copy.
+    """
+    circle.radius = other.radius
+    circle.coordinates = other.coordinates
+    circle.color = other.color
+    circle.border_color = other.border_color
+    circle.border_stroke_width = other.border_stroke_width
+    circle.data = other.data
+
+def reuse_controls(current, built, key, copy):
+    """
+    Show new controls in a layer, reusing the controls already there.
+
+    A control with the same key as a new one keeps its place and takes its properties;
+    the others are reused for the remaining new controls, and only then are controls added
+    or removed. Flet sends only the properties that changed, so redrawing the heatmap after
+    one pin moved sends a color or two instead of every circle of the map.
+
+    Args:
+        current (list): The controls of the layer, changed in place.
+        built (list): The new controls.
+        key (function): Function returning the key of a control, such as its coordinates.
+        copy (function): Function called with a control and the new control it must look like.
+    """
+    wanted = {}
+    for control in built:
+        wanted.setdefault(key(control), []).append(control)
+    spare = []
+    for control in current:
+        matches = wanted.get(key(control))
+        if matches:
+            copy(control, matches.pop())
+        else:
+            spare.append(control)
+    unmatched = [control for matches in wanted.values() for control in matches]
+    for control, replacement in zip(spare, unmatched):
+        copy(control, replacement)
+    if len(spare) > len(unmatched):
+        removed = {id(control) for control in spare[len(unmatched):]}
+        current[:] = [control for control in current if id(control) not in removed]
+    else:
+        current.extend(unmatched[len(spare):])
@@ -0,0 +1,154 @@
+"""
+Pin type menu for the Custom Pins application.
+
+This module defines the PinTypeMenu class, a popup menu of pin types backed by a cache keyed
+by pin type ID. Changes to the pin types touch only the affected menu items, and changing
+the selection only updates the header. Each item shows the number of pins of its type,
+read from the pin type statistics.
+
+Classes:
+    PinTypeMenu: A popup menu for choosing the selected pin type.
+"""
+import flet as ft
+import config
+
+class PinTypeMenu(ft.PopupMenuButton):
+    """
+    A popup menu for choosing the selected pin type.
+
+    Attributes:
+        pin_types (dict): The cached pin types by ID.
+        menu_items (dict): The menu item of each pin type by ID.
+        selected (dict): The selected pin type.
+        on_select (function): Callback function called with the pin type chosen by the user.
+        scheduler (ui_updates.UpdateScheduler): Sends the changed items to the page, or None
+            to send them at once.
+    """
+    def __init__(self, on_select, load=True, scheduler=None):
+        """
+        Initialize a PinTypeMenu instance.
+
+        Args:
+            on_select (function): Callback function called with the pin type chosen by the user.
+            load (bool, optional): Whether to load the pin types now rather than on the first
+                call to refresh. Defaults to True.
+            scheduler (ui_updates.UpdateScheduler, optional): Sends the changed items to the
+                page, batched with the other changes of the same handler. Defaults to None.
+        """
+        self.header_icon = ft.Icon()
+        self.header_text = ft.Text(color=config.ICON_COLOR, weight=ft.FontWeight.BOLD)
+        super().__init__(content=ft.Row([self.header_icon, self.header_text]), items=[])
+        self.on_select = on_select
+        self.scheduler = scheduler
+        self.pin_types = {}
+        self.menu_items = {}
+        self.selected = None
+        if load:
+            self.refresh()
+
+    def _build_item(self, pin_type_id):
+        icon = ft.Icon()
+        text = ft.Text()
+        count = ft.Text(color=ft.colors.GREY)
+        item = ft.PopupMenuItem(
+            content=ft.Row([icon, text, count]),
+            on_click=lambda e: self.on_select(self.pin_types[pin_type_id]),
+        )
+        item.data = (icon, text, count)
+        return item
+
+    def _apply(self, item, pin_type):
+        icon, text, count = item.data
+        icon.name = pin_type['style']
+        icon.color = pin_type['color']
+        text.value = pin_type['name']
+        count.value = str(pin_type.get('pin_count', 0))
+
+    def _update(self, *controls):
+        if self.scheduler is not None:
+            self.scheduler.update(*controls)
+        elif self.page:
+            self.page.update(*controls)
+
+    def refresh(self):
+        """
+        Reload the pin types and patch only the menu items that changed.
+
+        Pin counts are part of the comparison, so adding or deleting pins only patches the
+        item of their type.
+        """
+        # Imported here so building the menu does not open the database
+        from db.repository import get_repository
+
+        latest = {pin_type['id']: pin_type for pin_type in get_repository().get_pin_type_stats()}
+
+        removed = set(self.pin_types) - set(latest)
+        added = set(latest) - set(self.pin_types)
+        changed = [pin_type for pin_type in latest.values() if self.pin_types.get(pin_type['id']) != pin_type]
+        for pin_type_id in removed:
+            self.remove_pin_type(pin_type_id, update=False)
+        for pin_type in changed:
+            self.upsert_pin_type(pin_type, update=False)
+
+        if self.selected is None or self.selected['id'] not in self.pin_types:
+            self.select(next(iter(self.pin_types.values()), None))
+        if removed or added:
+            self._update(self)
+        elif changed:
+            self._update(self.content, *(self.menu_items[pin_type['id']] for pin_type in changed))
+
+    def upsert_pin_type(self, pin_type, update=True):
+        """
+        Add a pin type to the menu, or update its item if it is already there.
+
+        Args:
+            pin_type (dict): The pin type, as returned by get_pin_type_stats.
+            update (bool, optional): Whether to send the change to the page. Defaults to True.
+        """
+        item = self.menu_items.get(pin_type['id'])
+        created = item is None
+        if created:
+            item = self._build_item(pin_type['id'])
+            self.menu_items[pin_type['id']] = item
+            self.items.append(item)
+        self.pin_types[pin_type['id']] = pin_type
+        self._apply(item, pin_type)
+
+        if self.selected is not None and self.selected['id'] == pin_type['id']:
+            self.select(pin_type, update=update)
+        if update:
+            self._update(self if created else item)
+
+    def remove_pin_type(self, pin_type_id, update=True):
+        """
+        Remove a pin type from the menu.
+
+        Args:
+            pin_type_id (int): The ID of the pin type.
+            update (bool, optional): Whether to send the change to the page. Defaults to True.
+        """
+        self.pin_types.pop(pin_type_id, None)
+        item = self.menu_items.pop(pin_type_id, None)
+        if item is not None:
+            self.items.remove(item)
+        if self.selected is not None and self.selected['id'] == pin_type_id:
+            self.select(next(iter(self.pin_types.values()), None), update=update)
+        if update:
+            self._update(self)
+
+    def select(self, pin_type, update=True):
+        """
+        Show a pin type as the selected one. Only the header is changed.
+
+        Args:
+            pin_type (dict): The pin type to select.
+            update (bool, optional): Whether to send the change to the page. Defaults to True.
+        """
+        self.selected = pin_type
+        if pin_type is None:
+            return
+        self.header_icon.name = pin_type['style']
+        self.header_icon.color = pin_type['color']
+        self.header_text.value = pin_type['name']
+        if update:
+            self._update(self.content)
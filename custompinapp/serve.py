@@ -0,0 +1,36 @@
+"""
+Multi-process web server for the Custom Pins application.
+
+`flet run --web` serves every session from one Python process, which uses one core. This
+module exports the app as an ASGI application and serves it with uvicorn from several
+worker processes sharing one listening socket, so the kernel spreads new sessions over
+the workers. A session lives on its websocket, and so on one worker, from start to end.
+
+The workers share the database, which is opened in WAL mode so their reads never wait
+for each other's writes, and learn about each other's changes through db.change_bus.
+All workers must run on the same host as the database files.
+
+Usage:
+    python serve.py --port 8000 --workers 4
+
+Attributes:
+    app: The ASGI application serving the Flet app.
+"""
+import argparse
+import os
+import flet as ft
+import main
+
+app = ft.app(target=main.main, export_asgi_app=True, assets_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets"))
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Serve the Custom Pins web app from several processes.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="number of app processes (default: one per core)")
+    args = parser.parse_args()
+    # Workers import the app by name, each building its own
+    uvicorn.run("serve:app", host=args.host, port=args.port, workers=args.workers,
+                app_dir=os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,126 @@
+"""
+Per-session state for the Custom Pins application.
+
+Each call of main.main serves one page, and creates a Session that owns everything that
+page shows and remembers: the loaded pins and their heatmap, the viewport, the selected
+pin type and the map's layers. Sessions served by the same process share nothing but the
+database and its caches, so one user's actions never repaint another user's map.
+
+A session is changed from Flet's handler threads and from threads of its own: the change
+bus, the background jobs, the location service and the timeline. Its lock serializes
+them; the batches of its update scheduler hold it, so every handler and callback that
+changes the session runs in a batch.
+
+Closing a session, when its page is closed, runs the cleanups registered by the page's
+controls, such as unsubscribing from the change bus, and drops the loaded pins. The page
+then holds the last reference to the session, and both are freed together.
+
+Classes:
+    Session: The state of one page.
+
+Attributes:
+    sessions (weakref.WeakSet): The sessions alive in this process.
+"""
+import threading
+import weakref
+from spatial_index import PinIndex
+from heatmap import DensityHeatmap
+from ui_updates import UpdateScheduler
+import config
+
+sessions = weakref.WeakSet()
+
+class Session:
+    """
+    The state of one page.
+
+    Attributes:
+        page (ft.Page): The page of the session.
+        lock (threading.RLock): Held while the session's pins, heatmap, layers or overlay
+            are read or changed.
+        ui (UpdateScheduler): Sends the controls the session changed to the page.
+        loaded_pins (PinIndex): The pins loaded on the map.
+        heatmap (DensityHeatmap): The loaded pins binned for the country zoom heatmap.
+        render_mode (str): How the pins are drawn, or None before they are first drawn.
+        time_window (timeline.DateWindow): The pins shown by the timeline, or None when
+            every pin is shown.
+        last_center (map.MapLatitudeLongitude): The center of the map after the last move,
+            or None if the map has not moved.
+        current_zoom (float): The zoom level of the map.
+        selected_pin_type (dict): The pin type new pins are placed with.
+        page_map (map.Map): The map control.
+        map_pch (ft.Column): The placeholder holding the map control.
+        marker_layer_ref (ft.Ref): The layer pins are drawn on as markers.
+        circle_layer_ref (ft.Ref): The layer pins are drawn on as circles or heat cells.
+        pin_type_dropdown (ft.Container): The container of the pin type menu.
+        timeline_filter (timeline.TimelineFilter): The timeline, or None until it is first opened.
+        marker_overlay (marker_overlay.MarkerOverlay): The details of the opened pin, or None
+            until a pin is first opened. It is reused for the next pins.
+        closed (bool): Whether the session was closed.
+    """
+    def __init__(self, page, zoom=5):
+        """
+        Initialize a Session instance.
+
+        Args:
+            page (ft.Page): The page of the session.
+            zoom (float, optional): The initial zoom level of the map. Defaults to 5.
+        """
+        self.page = page
+        self.lock = threading.RLock()
+        self.ui = UpdateScheduler(page, lock=self.lock)
+        self.loaded_pins = PinIndex()
+        self.heatmap = DensityHeatmap(config.HEATMAP_CELL_PX, config.HEATMAP_WEIGHT_FIELD)
+        self.render_mode = None
+        self.time_window = None
+        self.last_center = None
+        self.current_zoom = zoom
+        self.selected_pin_type = None
+        self.page_map = None
+        self.map_pch = None
+        self.marker_layer_ref = None
+        self.circle_layer_ref = None
+        self.pin_type_dropdown = None
+        self.timeline_filter = None
+        self.marker_overlay = None
+        self.closed = False
+        self._cleanups = []
+        sessions.add(self)
+
+    def on_close(self, cleanup):
+        """
+        Register a function to call without arguments when the session is closed.
+
+        Args:
+            cleanup (function): The function.
+        """
+        self._cleanups.append(cleanup)
+
+    def close(self):
+        """
+        Run the registered cleanups, in reverse order, and drop the loaded pins.
+
+        Does nothing if the session is already closed.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            cleanups, self._cleanups = self._cleanups, []
+            for cleanup in reversed(cleanups):
+                try:
+                    cleanup()
+                except Exception as e:
+                    print(f"Error: {e}")
+            self.loaded_pins.clear()
+            self.heatmap.load([])
+            self.time_window = None
+            self.marker_overlay = None
+            if self.marker_layer_ref is not None and self.marker_layer_ref.current is not None:
+                self.marker_layer_ref.current.markers.clear()
+            if self.circle_layer_ref is not None and self.circle_layer_ref.current is not None:
+                self.circle_layer_ref.current.circles.clear()
+            sessions.discard(self)
+
+    def __repr__(self):
+        return f"Session({len(self.loaded_pins)} pins, zoom {self.current_zoom}{', closed' if self.closed else ''})"
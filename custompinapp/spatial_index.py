@@ -0,0 +1,148 @@
+"""
+In-memory spatial index for the Custom Pins application.
+
+This module defines the PinIndex class, a uniform grid over latitude and longitude that
+answers bounding box and nearest pin queries without touching the database.
+
+Classes:
+    PinIndex: A grid index of pins keyed by their coordinates.
+"""
+import math
+from geo import pixel_distance, pixels_to_degrees
+
+class PinIndex:
+    """
+    A grid index of pins keyed by their coordinates.
+
+    Pins are stored as dictionaries with at least 'id', 'latitude' and 'longitude' keys.
+
+    Attributes:
+        cell_size (float): The size of a grid cell in degrees.
+        pins (dict): The indexed pins by ID.
+        cells (dict): The pin IDs in each grid cell.
+    """
+    def __init__(self, cell_size=0.01):
+        """
+        Initialize a PinIndex instance.
+
+        Args:
+            cell_size (float, optional): The size of a grid cell in degrees. Defaults to 0.01.
+        """
+        self.cell_size = cell_size
+        self.pins = {}
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.pins)
+
+    def __iter__(self):
+        return iter(self.pins.values())
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+
+    def clear(self):
+        """
+        Remove all pins from the index.
+        """
+        self.pins.clear()
+        self.cells.clear()
+
+    def insert(self, pin):
+        """
+        Add a pin to the index, replacing any pin with the same ID.
+
+        Args:
+            pin (dict): The pin to add.
+        """
+        self.remove(pin['id'])
+        self.pins[pin['id']] = pin
+        self.cells.setdefault(self._cell(pin['latitude'], pin['longitude']), set()).add(pin['id'])
+
+    def remove(self, pin_id):
+        """
+        Remove a pin from the index.
+
+        Args:
+            pin_id (int): The ID of the pin.
+
+        Returns:
+            dict: The removed pin, or None if it was not indexed.
+        """
+        pin = self.pins.pop(pin_id, None)
+        if pin is None:
+            return None
+        cell = self._cell(pin['latitude'], pin['longitude'])
+        ids = self.cells[cell]
+        ids.discard(pin_id)
+        if not ids:
+            del self.cells[cell]
+        return pin
+
+    def get(self, pin_id):
+        """
+        Get an indexed pin by its ID.
+
+        Args:
+            pin_id (int): The ID of the pin.
+
+        Returns:
+            dict: The pin, or None if it is not indexed.
+        """
+        return self.pins.get(pin_id)
+
+    def query_bbox(self, south, west, north, east):
+        """
+        Get the pins inside a bounding box.
+
+        Args:
+            south (float): The minimum latitude.
+            west (float): The minimum longitude.
+            north (float): The maximum latitude.
+            east (float): The maximum longitude.
+
+        Returns:
+            list: The pins inside the box.
+        """
+        min_i, min_j = self._cell(south, west)
+        max_i, max_j = self._cell(north, east)
+        # Walk the occupied cells instead of the range when the range is the larger of the two
+        if (max_i - min_i + 1) * (max_j - min_j + 1) > len(self.cells):
+            cells = [cell for cell in self.cells if min_i <= cell[0] <= max_i and min_j <= cell[1] <= max_j]
+        else:
+            cells = [(i, j) for i in range(min_i, max_i + 1) for j in range(min_j, max_j + 1) if (i, j) in self.cells]
+
+        result = []
+        for cell in cells:
+            for pin_id in self.cells[cell]:
+                pin = self.pins[pin_id]
+                if south <= pin['latitude'] <= north and west <= pin['longitude'] <= east:
+                    result.append(pin)
+        return result
+
+    def nearest(self, latitude, longitude, zoom, tolerance_px, accept=None):
+        """
+        Find the pin closest to a coordinate on screen.
+
+        Args:
+            latitude (float): The latitude of the coordinate.
+            longitude (float): The longitude of the coordinate.
+            zoom (float): The current zoom level of the map.
+            tolerance_px (float): The maximum distance in pixels.
+            accept (function, optional): Function called with a pin that returns whether it
+                can be found, to skip hidden pins. Defaults to None, accepting every pin.
+
+        Returns:
+            dict: The closest pin within the tolerance, or None.
+        """
+        lat_span, lng_span = pixels_to_degrees(tolerance_px, latitude, zoom)
+        candidates = self.query_bbox(latitude - lat_span, longitude - lng_span, latitude + lat_span, longitude + lng_span)
+
+        best, best_distance = None, tolerance_px
+        for pin in candidates:
+            if accept is not None and not accept(pin):
+                continue
+            distance = pixel_distance(latitude, longitude, pin['latitude'], pin['longitude'], zoom)
+            if distance <= best_distance:
+                best, best_distance = pin, distance
+        return best
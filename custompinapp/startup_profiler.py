@@ -0,0 +1,70 @@
+"""
+Startup profiler for the Custom Pins application.
+
+This module times the phases of a cold start: imports, database initialization and the
+time until the first frame is sent with page.update(). It is switched off unless the
+CUSTOMPINS_PROFILE_STARTUP environment variable is set, and then prints a report once
+startup is over. Times are measured from the moment this module is imported, which main
+does before anything else.
+
+It has no dependencies, so it can be imported before Flet and the database.
+
+Functions:
+    timed(name): Time a block of startup work.
+    mark(name): Record the time at which a startup milestone is reached.
+    report(): Print the recorded timings.
+
+Run with:
+    CUSTOMPINS_PROFILE_STARTUP=1 flet run main.py
+"""
+import contextlib
+import os
+import time
+
+enabled = os.environ.get('CUSTOMPINS_PROFILE_STARTUP', '') not in ('', '0')
+
+_origin = time.perf_counter()
+_phases = []
+_marks = []
+_reported = False
+
+@contextlib.contextmanager
+def timed(name):
+    """
+    Time a block of startup work.
+
+    Args:
+        name (str): The name of the phase, such as "import flet".
+    """
+    if not enabled:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases.append((name, (time.perf_counter() - started) * 1000))
+
+def mark(name):
+    """
+    Record the time at which a startup milestone is reached.
+
+    Args:
+        name (str): The name of the milestone, such as "first page.update()".
+    """
+    if enabled:
+        _marks.append((name, (time.perf_counter() - _origin) * 1000))
+
+def report():
+    """
+    Print the recorded timings, once per process.
+    """
+    global _reported
+    if not enabled or _reported:
+        return
+    _reported = True
+    print("Startup profile:")
+    for name, duration_ms in _phases:
+        print(f"  {name:<40} {duration_ms:>9.1f} ms")
+    for name, at_ms in _marks:
+        print(f"  {name:<40} {at_ms:>9.1f} ms after start")
@@ -0,0 +1,352 @@
+"""
+Timeline filter for the Custom Pins application.
+
+This module defines the TimelineFilter control, a range slider over the dates of the pins
+with a histogram of how many pins fall on each step, and a play button that moves the
+window through time. The histogram is drawn from the per-day counts kept by the database,
+and the pins in the window are read through the index on the date values. Moving the
+window only queries the days that entered or left it, so scrubbing and playing cost a few
+small queries per step however many pins have a date.
+
+Classes:
+    DateWindow: The pins with a date in a range of days.
+    TimelineFilter: A date range slider with a histogram and playback.
+
+Functions:
+    build_buckets(day_counts, max_buckets): Group per-day counts into histogram buckets.
+"""
+import bisect
+import datetime
+import threading
+import time
+import flet as ft
+import config
+
+UNITS = ('day', 'week', 'month', 'year')
+
+def _bucket_start(day, unit):
+    if unit == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if unit == 'month':
+        return day.replace(day=1)
+    if unit == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+def _next_bucket(start, unit):
+    if unit == 'day':
+        return start + datetime.timedelta(days=1)
+    if unit == 'week':
+        return start + datetime.timedelta(days=7)
+    if unit == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start.replace(year=start.year + 1)
+
+def build_buckets(day_counts, max_buckets):
+    """
+    Group per-day counts into histogram buckets.
+
+    The buckets are days, weeks, months or years, the smallest unit that fits the dates in
+    max_buckets buckets. Days that are not ISO dates are skipped.
+
+    Args:
+        day_counts (list): The (day, count) pairs, days as ISO date strings, sorted by day.
+        max_buckets (int): The maximum number of buckets, unless the dates span more years.
+
+    Returns:
+        tuple: The bucket boundaries as ISO date strings, one more than the buckets, the
+        last being the day after the last bucket, and the pin count of each bucket.
+    """
+    days = []
+    for day, count in day_counts:
+        try:
+            days.append((datetime.date.fromisoformat(day), count))
+        except (TypeError, ValueError):
+            continue
+    if not days:
+        return [], []
+
+    first, last = days[0][0], days[-1][0]
+    for unit in UNITS:
+        # Years are never too coarse
+        limit = max_buckets if unit != UNITS[-1] else None
+        boundaries = [_bucket_start(first, unit)]
+        while boundaries[-1] <= last and (limit is None or len(boundaries) <= limit):
+            boundaries.append(_next_bucket(boundaries[-1], unit))
+        if boundaries[-1] > last:
+            break
+
+    counts = [0] * (len(boundaries) - 1)
+    for day, count in days:
+        counts[bisect.bisect_right(boundaries, day) - 1] += count
+    return [boundary.isoformat() for boundary in boundaries], counts
+
+class DateWindow:
+    """
+    The pins with a date in a range of days.
+
+    Attributes:
+        field_name (str): The name of the date fields to look at, or None for every date field.
+        map_id (int): The ID of the map.
+        start (str): The first day of the window, as an ISO date string, or None.
+        end (str): The day after the window, as an ISO date string, or None.
+        matches (dict): The number of date values in the window of each pin by ID.
+    """
+    def __init__(self, field_name=None, map_id=None):
+        """
+        Initialize an empty DateWindow instance.
+
+        Args:
+            field_name (str, optional): The name of the date fields to look at. Defaults to
+                None, looking at every date field.
+            map_id (int, optional): The ID of the map. Defaults to the default map.
+        """
+        # Imported here so building the timeline does not open the database
+        from db.repository import get_repository, DEFAULT_MAP_ID
+        self._repository = get_repository()
+        self.field_name = field_name
+        self.map_id = DEFAULT_MAP_ID if map_id is None else map_id
+        self.start = None
+        self.end = None
+        self.matches = {}
+
+    def __contains__(self, pin_id):
+        return pin_id in self.matches
+
+    def __len__(self):
+        return len(self.matches)
+
+    def _query(self, start, end, pin_ids=None):
+        return self._repository.get_pin_ids_by_date(start, end, self.field_name, pin_ids=pin_ids, map_id=self.map_id)
+
+    def _add(self, start, end):
+        for pin_id in self._query(start, end):
+            self.matches[pin_id] = self.matches.get(pin_id, 0) + 1
+
+    def _remove(self, start, end):
+        for pin_id in self._query(start, end):
+            count = self.matches.get(pin_id, 0) - 1
+            if count > 0:
+                self.matches[pin_id] = count
+            else:
+                self.matches.pop(pin_id, None)
+
+    def move(self, start, end):
+        """
+        Move the window, querying only the days that entered or left it.
+
+        Args:
+            start (str): The first day of the window, as an ISO date string.
+            end (str): The day after the window, as an ISO date string.
+        """
+        if self.start is None or end <= self.start or start >= self.end:
+            self.start, self.end = start, end
+            self.reload()
+            return
+        if start > self.start:
+            self._remove(self.start, start)
+        if end < self.end:
+            self._remove(end, self.end)
+        if start < self.start:
+            self._add(start, self.start)
+        if end > self.end:
+            self._add(self.end, end)
+        self.start, self.end = start, end
+
+    def reload(self):
+        """
+        Query every pin in the window again, after pins were changed.
+        """
+        self.matches = {}
+        if self.start is not None:
+            self._add(self.start, self.end)
+
+    def refresh(self, pin_ids):
+        """
+        Query some pins in the window again, after they were added or changed.
+
+        Args:
+            pin_ids (list): The IDs of the pins.
+        """
+        for pin_id in pin_ids:
+            self.matches.pop(pin_id, None)
+        if self.start is None:
+            return
+        for pin_id in self._query(self.start, self.end, pin_ids):
+            self.matches[pin_id] = self.matches.get(pin_id, 0) + 1
+
+class TimelineFilter(ft.Container):
+    """
+    A date range slider with a histogram and playback.
+
+    Moves of the slider are applied by one thread at a time, and moves made while one is
+    applied are merged, so only the latest window is queried and drawn.
+
+    Attributes:
+        on_change (function): Callback function called with the DateWindow after it moved,
+            from a worker thread.
+        window (DateWindow): The pins in the selected window.
+        boundaries (list): The bucket boundaries as ISO date strings.
+        counts (list): The pin count of each bucket.
+        playing (bool): Whether the window is moving through time.
+    """
+    def __init__(self, on_change, max_buckets=config.TIMELINE_MAX_BUCKETS):
+        """
+        Initialize a TimelineFilter instance. It shows nothing until load() is called.
+
+        Args:
+            on_change (function): Callback function called with the DateWindow after it moved.
+            max_buckets (int, optional): The maximum number of histogram bars.
+                Defaults to config.TIMELINE_MAX_BUCKETS.
+        """
+        self.on_change = on_change
+        self.max_buckets = max_buckets
+        self.window = None
+        self.boundaries = []
+        self.counts = []
+        self.playing = False
+        self._pending = None
+        self._applying = False
+        self._lock = threading.Lock()
+        self._highlighted = []
+
+        self.field_dropdown = ft.Dropdown(width=160, dense=True, on_change=self._handle_field_change)
+        self.label = ft.Text(size=12, color=config.ICON_COLOR)
+        self.play_button = ft.IconButton(icon=ft.icons.PLAY_ARROW, selected_icon=ft.icons.PAUSE, selected=False,
+                                         icon_color=config.ICON_COLOR, tooltip="Play", on_click=self._handle_play)
+        self.histogram = ft.Row(height=config.TIMELINE_HISTOGRAM_HEIGHT, spacing=1,
+                                vertical_alignment=ft.CrossAxisAlignment.END)
+        self.slider = ft.RangeSlider(start_value=0, end_value=1, min=0, max=1, divisions=1,
+                                     active_color=config.DARK_COLOR, inactive_color=config.LIGHT_COLOR,
+                                     on_change=self._handle_slide)
+        super().__init__(
+            content=ft.Column([
+                ft.Row([self.play_button, self.field_dropdown, self.label]),
+                ft.Container(self.histogram, padding=ft.padding.symmetric(horizontal=24)),
+                self.slider,
+            ], spacing=0),
+            bgcolor=config.SECONDARY_COLOR,
+            padding=ft.padding.only(left=8, right=8, top=4),
+        )
+
+    def load(self, field_name=None):
+        """
+        Read the date fields and per-day counts, and select every date.
+
+        Args:
+            field_name (str, optional): The name of the date fields to filter by. Defaults
+                to None, filtering by every date field.
+        """
+        from db.repository import get_repository
+        repository = get_repository()
+        self.field_dropdown.options = [ft.dropdown.Option(key="", text="All dates")] + [
+            ft.dropdown.Option(name) for name in repository.get_date_field_names()
+        ]
+        self.field_dropdown.value = field_name or ""
+        self.window = DateWindow(field_name)
+        self.boundaries, self.counts = build_buckets(repository.get_date_counts(field_name), self.max_buckets)
+
+        peak = max(self.counts, default=0) or 1
+        self.histogram.controls = [
+            ft.Container(expand=True, height=max(2, config.TIMELINE_HISTOGRAM_HEIGHT * count / peak),
+                         bgcolor=config.DARK_COLOR, tooltip=f"{start}: {count}")
+            for start, count in zip(self.boundaries, self.counts)
+        ]
+        self._highlighted = [True] * len(self.counts)
+
+        buckets = max(1, len(self.counts))
+        self.slider.max = buckets
+        self.slider.divisions = buckets
+        self.slider.start_value = 0
+        self.slider.end_value = buckets
+        self.slider.disabled = not self.counts
+        self._select(0, len(self.counts))
+        if self.page:
+            self.update()
+
+    def stop(self):
+        """
+        Stop the playback.
+        """
+        self.playing = False
+        self.play_button.selected = False
+        if self.page:
+            self.play_button.update()
+
+    def will_unmount(self):
+        self.playing = False
+
+    def _select(self, first, last):
+        # Buckets first to last - 1 are selected
+        if not self.counts:
+            self.window.move("", "")
+            self.label.value = "No dates"
+        else:
+            self.window.move(self.boundaries[first], self.boundaries[last])
+            shown_end = datetime.date.fromisoformat(self.boundaries[last]) - datetime.timedelta(days=1)
+            self.label.value = f"{self.boundaries[first]} – {shown_end.isoformat()}: {len(self.window)} pins"
+
+        changed = []
+        for index, bar in enumerate(self.histogram.controls):
+            inside = first <= index < last
+            if inside != self._highlighted[index]:
+                self._highlighted[index] = inside
+                bar.bgcolor = config.DARK_COLOR if inside else config.LIGHT_COLOR
+                changed.append(bar)
+        if self.page:
+            for bar in changed:
+                bar.update()
+            self.label.update()
+
+    def _apply(self, first, last):
+        with self._lock:
+            self._pending = (first, last)
+            if self._applying:
+                # The thread applying a move picks up the latest one when it is done
+                return
+            self._applying = True
+        while True:
+            with self._lock:
+                selection, self._pending = self._pending, None
+                if selection is None:
+                    self._applying = False
+                    return
+            try:
+                self._select(*selection)
+                self.on_change(self.window)
+            except Exception as e:
+                print(f"Error: {e}")
+
+    def _handle_slide(self, e):
+        self._apply(round(self.slider.start_value), round(self.slider.end_value))
+
+    def _handle_field_change(self, e):
+        self.stop()
+        self.load(self.field_dropdown.value or None)
+        self.on_change(self.window)
+
+    def _handle_play(self, e):
+        if self.playing:
+            self.stop()
+            return
+        if not self.counts:
+            return
+        self.playing = True
+        self.play_button.selected = True
+        self.play_button.update()
+        threading.Thread(target=self._play, daemon=True).start()
+
+    def _play(self):
+        while self.playing:
+            first, last = round(self.slider.start_value), round(self.slider.end_value)
+            width = max(1, last - first)
+            if last >= len(self.counts):
+                # Start over from the first bucket
+                first, last = 0, width
+            else:
+                first, last = first + 1, last + 1
+            self.slider.start_value, self.slider.end_value = first, last
+            if self.page:
+                self.slider.update()
+            self._apply(first, last)
+            time.sleep(config.TIMELINE_STEP_S)
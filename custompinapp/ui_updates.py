@@ -0,0 +1,191 @@
+"""
+Batched, scoped page updates for the Custom Pins application.
+
+A page.update() without arguments compares every control of the page with what the
+browser already shows, the thousands of pin markers included, even when a handler changed
+a single text. Handlers that call it several times in a row also send several messages
+for one user action.
+
+The UpdateScheduler of a session collects the controls a handler changed and sends them
+in one message when the handler returns, as scoped updates of those controls only. A
+control inside another dirty control is sent with it. The whole page is only compared
+when its structure changed, such as views or overlays being added. Outside a batch,
+updates are sent at once.
+
+Set CUSTOMPINS_UI_STATS=1 to measure the size of each update the scheduler sends and
+print it.
+
+Classes:
+    UpdateScheduler: Collects the changed controls of a page and sends them together.
+
+Attributes:
+    measure_enabled (bool): Whether the size of each update is measured.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+from flet_core.protocol import CommandEncoder
+
+measure_enabled = os.environ.get('CUSTOMPINS_UI_STATS', '') not in ('', '0')
+
+# The sizes of the messages sent while a scheduler flushes, or None
+_measured = contextvars.ContextVar('measured_update_sizes', default=None)
+
+def _measure_connection(connection):
+    # Wrapped once per connection; measures only what a flushing scheduler sends
+    if connection is None or getattr(connection, '_custompins_measured', False):
+        return
+    send_commands = connection.send_commands
+
+    def measured_send_commands(session_id, commands):
+        sizes = _measured.get()
+        if sizes is not None:
+            sizes.append(len(json.dumps(commands, cls=CommandEncoder, separators=(",", ":")).encode('utf-8')))
+        return send_commands(session_id, commands)
+
+    connection.send_commands = measured_send_commands
+    connection._custompins_measured = True
+
+class UpdateScheduler:
+    """
+    Collects the changed controls of a page and sends them together.
+
+    Batches are per thread, since Flet runs handlers on a thread pool, and can be nested;
+    the outermost one sends the update. A batch holds the scheduler's lock, if it has one,
+    so the handlers of a page, and the callbacks of other threads changing the same page,
+    run one at a time.
+
+    Attributes:
+        page (ft.Page): The page.
+        lock (threading.RLock): The lock held by batches, or None.
+        sent_updates (int): The number of updates sent.
+        sent_controls (int): The number of controls sent in them, the page counting as one.
+        sent_bytes (int): The size of the updates sent, when measure_enabled is set.
+        last_bytes (int): The size of the last update sent, when measure_enabled is set.
+    """
+    def __init__(self, page, lock=None):
+        """
+        Initialize an UpdateScheduler instance.
+
+        Args:
+            page (ft.Page): The page.
+            lock (threading.RLock, optional): The lock to hold during batches. Defaults to None.
+        """
+        self.page = page
+        self.lock = lock
+        self.sent_updates = 0
+        self.sent_controls = 0
+        self.sent_bytes = 0
+        self.last_bytes = 0
+        self._local = threading.local()
+
+    def _state(self):
+        state = self._local.__dict__
+        if 'depth' not in state:
+            state.update(depth=0, dirty={}, page_dirty=False)
+        return state
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Collect the updates made inside the block and send them when it ends, holding the
+        lock until then.
+        """
+        if self.lock is not None:
+            self.lock.acquire()
+        state = self._state()
+        state['depth'] += 1
+        try:
+            yield self
+        finally:
+            state['depth'] -= 1
+            try:
+                if state['depth'] == 0:
+                    self.flush()
+            finally:
+                if self.lock is not None:
+                    self.lock.release()
+
+    def batched(self, handler):
+        """
+        Decorate a handler so that the updates it makes are sent together when it returns.
+
+        Args:
+            handler (function): The handler, which must not be a coroutine.
+
+        Returns:
+            function: The decorated handler.
+        """
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            with self.batch():
+                return handler(*args, **kwargs)
+        return wrapper
+
+    def update(self, *controls):
+        """
+        Send changed controls, at the end of the current batch or at once outside one.
+
+        Controls that are not on the page yet are skipped; they are sent with the control
+        they are added to.
+
+        Args:
+            *controls (ft.Control): The changed controls.
+        """
+        state = self._state()
+        for control in controls:
+            if control is not None and control.page is not None:
+                state['dirty'][id(control)] = control
+        if state['depth'] == 0:
+            self.flush()
+
+    def update_page(self):
+        """
+        Send the whole page, after its views or overlays changed, at the end of the
+        current batch or at once outside one.
+        """
+        state = self._state()
+        state['page_dirty'] = True
+        if state['depth'] == 0:
+            self.flush()
+
+    def flush(self):
+        """
+        Send the updates collected on this thread, in one message.
+        """
+        state = self._state()
+        dirty, state['dirty'] = state['dirty'], {}
+        page_dirty, state['page_dirty'] = state['page_dirty'], False
+        if page_dirty:
+            controls = []
+        else:
+            controls = [control for control in dirty.values() if not self._inside(control, dirty)]
+            if not controls:
+                return
+        sizes = [] if measure_enabled else None
+        if sizes is not None:
+            _measure_connection(self.page.connection)
+        token = _measured.set(sizes)
+        try:
+            self.page.update(*controls)
+        finally:
+            _measured.reset(token)
+        self.sent_updates += 1
+        self.sent_controls += len(controls) or 1
+        if sizes is not None:
+            self.last_bytes = sum(sizes)
+            self.sent_bytes += self.last_bytes
+            print(f"UI update: {len(controls) or 'page'} controls, {self.last_bytes} bytes "
+                  f"({self.sent_bytes / self.sent_updates:.0f} bytes per update)")
+
+    @staticmethod
+    def _inside(control, dirty):
+        parent = control.parent
+        while parent is not None:
+            if id(parent) in dirty:
+                return True
+            parent = parent.parent
+        return False
@@ -0,0 +1,227 @@
+"""
+Mapbox Vector Tiles of pins for the Custom Pins application.
+
+This module encodes pins as Mapbox Vector Tiles (MVT 2.1) so heavy maps can draw them as a
+tile overlay, with a payload bounded per tile instead of per dataset. Tiles are built from
+an in-memory spatial index and cached; the change journal is used to update the index and
+drop only the cached tiles that contain changed pins. Each map has its own source.
+
+Classes:
+    PinTileSource: A cached source of pin tiles.
+
+Functions:
+    encode_tile(layers, extent=4096): Encode point layers as an MVT tile.
+"""
+import threading
+from collections import OrderedDict
+from geo import lat_lng_to_world_pixel, tile_bounds, TILE_SIZE
+from spatial_index import PinIndex
+import db.crud as pins_crud
+from db.db import DEFAULT_MAP_ID
+from db.journal import get_data_version
+from db.sync import get_changes_since
+
+EXTENT = 4096
+BUFFER_PX = 8  # Points this close to a tile edge are drawn in both tiles
+PIN_LAYER = "pins"
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+def _key(field_number, wire_type):
+    return _varint((field_number << 3) | wire_type)
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _bytes_field(field_number, data):
+    return _key(field_number, 2) + _varint(len(data)) + data
+
+def _varint_field(field_number, value):
+    return _key(field_number, 0) + _varint(value)
+
+def _packed_field(field_number, values):
+    return _bytes_field(field_number, b''.join(_varint(value) for value in values))
+
+def _encode_value(value):
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int) and value >= 0:
+        return _varint_field(5, value)
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    return _bytes_field(1, str(value).encode('utf-8'))
+
+def _encode_layer(name, features, extent):
+    keys, values = {}, {}
+    encoded_features = []
+    for feature_id, x, y, properties in features:
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value), value), len(values)))
+        # One MoveTo command (id 1, count 1) followed by the zigzag encoded position
+        geometry = [(1 & 0x7) | (1 << 3), _zigzag(x), _zigzag(y)]
+        encoded_features.append(_bytes_field(2,
+            _varint_field(1, feature_id)
+            + _packed_field(2, tags)
+            + _varint_field(3, 1)  # POINT
+            + _packed_field(4, geometry)))
+
+    layer = _varint_field(15, 2) + _bytes_field(1, name.encode('utf-8'))
+    layer += b''.join(encoded_features)
+    layer += b''.join(_bytes_field(3, key.encode('utf-8')) for key in keys)
+    layer += b''.join(_bytes_field(4, _encode_value(value)) for _, value in values)
+    layer += _varint_field(5, extent)
+    return layer
+
+def encode_tile(layers, extent=EXTENT):
+    """
+    Encode point layers as an MVT tile.
+
+    Args:
+        layers (dict): The features of each layer by layer name. A feature is an
+            (id, x, y, properties) tuple, with x and y in tile coordinates.
+        extent (int, optional): The size of the tile in tile coordinates. Defaults to 4096.
+
+    Returns:
+        bytes: The encoded tile.
+    """
+    return b''.join(_bytes_field(3, _encode_layer(name, features, extent)) for name, features in layers.items())
+
+class PinTileSource:
+    """
+    A cached source of pin tiles.
+
+    Attributes:
+        map_id (int): The ID of the map whose pins are served.
+        index (PinIndex): The indexed pins.
+        cache_size (int): The maximum number of cached tiles.
+        seq (int): The last change journal entry applied to the index.
+        hits (int): The number of tiles served from the cache.
+        misses (int): The number of tiles encoded.
+    """
+    def __init__(self, cache_size=2048, map_id=DEFAULT_MAP_ID):
+        """
+        Initialize a PinTileSource instance.
+
+        Args:
+            cache_size (int, optional): The maximum number of cached tiles. Defaults to 2048.
+            map_id (int, optional): The ID of the map whose pins are served. Defaults to the default map.
+        """
+        self.map_id = map_id
+        self.index = PinIndex(cell_size=0.05)
+        self.cache_size = cache_size
+        self.seq = None
+        self.hits = 0
+        self.misses = 0
+        self._uids = {}
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _index_pin(self, pin):
+        previous = self.index.get(pin['id'])
+        self.index.insert(pin)
+        self._uids[pin['uid']] = pin['id']
+        return previous
+
+    def _invalidate_point(self, latitude, longitude):
+        for z in {key[0] for key in self._tiles}:
+            x, y = lat_lng_to_world_pixel(latitude, longitude, z)
+            # A point inside the buffer also appears in the neighbouring tiles
+            for tx in {int((x - BUFFER_PX) // TILE_SIZE), int((x + BUFFER_PX) // TILE_SIZE)}:
+                for ty in {int((y - BUFFER_PX) // TILE_SIZE), int((y + BUFFER_PX) // TILE_SIZE)}:
+                    self._tiles.pop((z, tx, ty), None)
+
+    def refresh(self):
+        """
+        Bring the index up to date with the change journal.
+
+        The first call loads every pin. Later calls apply only the journal entries written
+        since, dropping the cached tiles that contain moved, added or deleted pins. Pin type
+        changes drop the whole cache, since they can recolour any tile.
+        """
+        with self._lock:
+            if self.seq is None:
+                with pins_crud.database.use_map(self.map_id):
+                    self.seq = get_data_version()
+                for pin in pins_crud.iter_pins(with_fields=False, map_id=self.map_id):
+                    self._index_pin(pin)
+                return
+
+            while True:
+                with pins_crud.database.use_map(self.map_id):
+                    changes = get_changes_since(self.seq)
+                if not changes:
+                    return
+                self.seq = changes[-1]['seq']
+
+                changed_uids = set()
+                for change in changes:
+                    if change['entity'] == 'pin_type':
+                        # Types rename or recolour their pins; reload them all
+                        self.index.clear()
+                        self._uids.clear()
+                        self._tiles.clear()
+                        for pin in pins_crud.iter_pins(with_fields=False, map_id=self.map_id):
+                            self._index_pin(pin)
+                        changed_uids.clear()
+                        break
+                    changed_uids.add(change['entity_uid'])
+
+                for uid in changed_uids:
+                    pin_id = self._uids.pop(uid, None)
+                    previous = self.index.remove(pin_id) if pin_id is not None else None
+                    if previous is not None:
+                        self._invalidate_point(previous['latitude'], previous['longitude'])
+                for pin in pins_crud.iter_pins(uids=changed_uids, with_fields=False, map_id=self.map_id) if changed_uids else []:
+                    self._index_pin(pin)
+                    self._invalidate_point(pin['latitude'], pin['longitude'])
+
+    def get_tile(self, z, x, y):
+        """
+        Get the pin tile at a position, encoding it if it is not cached.
+
+        Args:
+            z (int): The zoom level of the tile.
+            x (int): The column of the tile.
+            y (int): The row of the tile.
+
+        Returns:
+            bytes: The encoded tile.
+        """
+        self.refresh()
+        key = (z, x, y)
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+
+            south, west, north, east = tile_bounds(z, x, y, buffer=BUFFER_PX)
+            scale = EXTENT / TILE_SIZE
+            features = []
+            for pin in self.index.query_bbox(south, west, north, east):
+                px, py = lat_lng_to_world_pixel(pin['latitude'], pin['longitude'], z)
+                features.append((
+                    pin['id'],
+                    round((px - x * TILE_SIZE) * scale),
+                    round((py - y * TILE_SIZE) * scale),
+                    {"id": pin['id'], "type": pin['pin_type'], "color": pin['color']},
+                ))
+
+            tile = encode_tile({PIN_LAYER: features})
+            self._tiles[key] = tile
+            if len(self._tiles) > self.cache_size:
+                self._tiles.popitem(last=False)
+            self.misses += 1
+            return tile